@@ -0,0 +1,52 @@
+"""Benchmark of many concurrent invocations through the asyncio invoker.
+
+A broker, a service and a client run in one process. The client gathers ``count`` invocations of the service at once and measures the time until all of them are resolved.
+
+Usage: python -m benchmarks.asyncInvoker [--count invocations]
+"""
+__license__ = "GNU General Public License v3"
+__author__ = 'Hwaipy'
+__email__ = 'hwaipy@gmail.com'
+
+import argparse
+import asyncio
+import time
+from interactionfreepy import IFBroker, IFWorker, IFLoop
+
+
+class Echo:
+  """The service for the benchmark."""
+
+  def echo(self, data):
+    return data
+
+
+async def gather(client, count):
+  """Invoke the service ``count`` times concurrently and return the elapsed time in seconds."""
+  invoker = client.asyncInvoker('AsyncEcho')
+  start = time.perf_counter()
+  results = await asyncio.gather(*[invoker.echo(i) for i in range(count)])
+  elapsed = time.perf_counter() - start
+  assert results == list(range(count))
+  return elapsed
+
+
+def run(count, port):
+  """Run the benchmark and print the throughput."""
+  broker = IFBroker(f'tcp://*:{port}')
+  service = IFWorker(f'tcp://127.0.0.1:{port}', 'AsyncEcho', Echo())
+  client = IFWorker(f'tcp://127.0.0.1:{port}')
+  loop = IFLoop.getInstance().asyncio_loop
+  asyncio.run_coroutine_threadsafe(gather(client, count // 10), loop).result()
+  elapsed = asyncio.run_coroutine_threadsafe(gather(client, count), loop).result()
+  print(f'{count} invocations in {elapsed:.2f} s, {count / elapsed:.0f} invocations/s')
+  client.close()
+  service.close()
+  IFLoop.getInstance().add_callback(broker.close)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark of concurrent invocations through the asyncio invoker.')
+  parser.add_argument('--count', type=int, default=20000, help='Number of concurrent invocations. Default is 20000.')
+  parser.add_argument('--port', type=int, default=21062, help='Port of the broker. Default is 21062.')
+  run(**vars(parser.parse_args()))
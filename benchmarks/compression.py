@@ -0,0 +1,74 @@
+"""Benchmark of payload compression, reporting the break-even size of each algorithm.
+
+The break-even size is the smallest invocation for which compressing, sending the compressed data and decompressing is faster than sending the data as is, at the given bandwidth.
+
+Usage: python -m benchmarks.compression [--bandwidth MBps]
+"""
+__license__ = "GNU General Public License v3"
+__author__ = 'Hwaipy'
+__email__ = 'hwaipy@gmail.com'
+
+import argparse
+import time
+from random import Random
+from interactionfreepy.core import Invocation, Compression
+
+
+def tablePayload(size, seed=0):
+  """Generate a CSV-like table of roughly ``size`` bytes, as a status dump of a lab instrument."""
+  rnd = Random(seed)
+  rows = []
+  length = 0
+  while length < size:
+    row = f'{len(rows)},{rnd.choice(["CH1", "CH2", "CH3", "CH4"])},{rnd.randint(0, 65535)},{rnd.random():.6f},OK\n'
+    rows.append(row)
+    length += len(row)
+  return ''.join(rows)[:size]
+
+
+def measure(function, minDuration=0.05):
+  """Measure the average duration of calling ``function``."""
+  count = 0
+  start = time.perf_counter()
+  while True:
+    result = function()
+    count += 1
+    duration = time.perf_counter() - start
+    if duration >= minDuration:
+      return duration / count, result
+
+
+def run(bandwidth):
+  """Run the benchmark and print a table of the costs.
+
+  Args:
+    bandwidth: The bandwidth of the link in bytes per second.
+  """
+  sizes = [2 ** i for i in range(8, 23)]
+  print(f'Bandwidth: {bandwidth / 1e6:.1f} MB/s')
+  print(f'{"size":>10} {"algorithm":>9} {"ratio":>7} {"compress":>10} {"decompress":>10} {"plain":>10} {"compressed":>10}')
+  breakEven = {}
+  for size in sizes:
+    data = Invocation.newResponse('0', tablePayload(size)).serialize()
+    plainCost = len(data) / bandwidth
+    for algorithm, (compress, decompress) in Compression.ALGORITHMS.items():
+      compressTime, compressed = measure(lambda: compress(data))
+      decompressTime, _ = measure(lambda: decompress(compressed))
+      compressedCost = compressTime + len(compressed) / bandwidth + decompressTime
+      if compressedCost < plainCost and algorithm not in breakEven:
+        breakEven[algorithm] = len(data)
+      if compressedCost >= plainCost:
+        breakEven.pop(algorithm, None)
+      print(f'{len(data):>10} {algorithm:>9} {len(data) / len(compressed):>7.2f} {compressTime * 1e3:>8.3f}ms {decompressTime * 1e3:>8.3f}ms {plainCost * 1e3:>8.3f}ms {compressedCost * 1e3:>8.3f}ms')
+  for algorithm in Compression.ALGORITHMS:
+    if algorithm in breakEven:
+      print(f'Break-even size of {algorithm}: {breakEven[algorithm]} bytes')
+    else:
+      print(f'Break-even size of {algorithm}: not reached')
+  print(f'Current default threshold: {Compression.DEFAULT_THRESHOLD} bytes')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark of payload compression.')
+  parser.add_argument('--bandwidth', type=float, default=10, help='Bandwidth of the link in MB/s. Default is 10.')
+  run(parser.parse_args().bandwidth * 1e6)
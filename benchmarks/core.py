@@ -0,0 +1,145 @@
+"""Micro-benchmark of the core, reporting messages per second for building, parsing and dispatching small invocations.
+
+The cases run in child processes, so that another checkout of the package can be measured in the same run. With ``--baseline``, e.g. a worktree made by ``git worktree add /tmp/baseline <commit>``, the rounds of the two trees are interleaved, the best round of each case is kept, and the ratio to the baseline is reported. The ratio of IF2 to IF1 is reported for the current tree. Cases that a tree does not support, e.g. IF2 before it was introduced, are reported as ``-``.
+
+Usage: python -m benchmarks.core [--duration seconds] [--rounds n] [--baseline path]
+"""
+__license__ = "GNU General Public License v3"
+__author__ = 'Hwaipy'
+__email__ = 'hwaipy@gmail.com'
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = ['build', 'parse', 'respond', 'dispatch', 'forward']
+
+
+def rate(function, duration):
+  """Call ``function`` repeatedly for ``duration`` seconds and return the number of calls per second."""
+  count = 0
+  batch = 1000
+  start = time.perf_counter()
+  while True:
+    for _ in range(batch):
+      function()
+    count += batch
+    elapsed = time.perf_counter() - start
+    if elapsed >= duration:
+      return count / elapsed
+
+
+class Device:
+  """A service object for the dispatch case."""
+
+  def readChannel(self, channel):
+    return channel * 0.5
+
+
+def cases(protocol):
+  """The benchmark cases for a protocol, as a list of (name, function). Written against the API of the trees since IF2 was introduced."""
+  from interactionfreepy import core
+  Message, Invocation = core.Message, core.Invocation
+  request = Message.newServiceMessage('Device', Invocation.newRequest('readChannel', [3], {}), protocol=protocol)
+  received = request.getContent()[:3] + [b'\x00k\x8bEg'] + request.getContent()[5:]
+  # The way a worker dispatches a request: by a cached Dispatcher if the tree has one, otherwise on the object.
+  target = core.Dispatcher(Device()) if hasattr(core, 'Dispatcher') else Device()
+
+  def build():
+    Message.newServiceMessage('Device', Invocation.newRequest('readChannel', [3], {}), protocol=protocol).getContent()
+
+  def parse():
+    invocation = Message(received, outgoing=False).getInvocation()
+    invocation.getFunction()
+    invocation.getArguments()
+    invocation.getKeywordArguments()
+
+  def respond():
+    message = Message(received, outgoing=False)
+    message.getInvocation()
+    replyID = message.replyID if hasattr(message, 'replyID') else message.messageID
+    Message.newDirectMessage(message.fromAddress, Invocation.newResponse(replyID, 1.5), message.serialization, protocol=protocol).getContent()
+
+  def dispatch():
+    coroutine = Message(received, outgoing=False).getInvocation().perform(target)
+    try:
+      coroutine.send(None)
+    except StopIteration:
+      pass
+
+  def forward():
+    message = Message(request.getContent(), outgoing=True)
+    message.isServiceMessage()
+
+  return [('build', build), ('parse', parse), ('respond', respond), ('dispatch', dispatch), ('forward', forward)]
+
+
+def measure(duration):
+  """Measure all cases of the tree on the path once, as ``{protocol: {case: messages/s}}``."""
+  from interactionfreepy.core import IFDefinition
+  return {str(protocol, encoding='UTF-8'): {name: rate(function, duration) for name, function in cases(protocol)} for protocol in IFDefinition.PROTOCOLS}
+
+
+def measureTree(path, duration):
+  """Measure the tree at ``path`` in a child process."""
+  environment = dict(os.environ, PYTHONPATH=os.pathsep.join([path, os.environ.get('PYTHONPATH', '')]))
+  output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', '--duration', str(duration)], env=environment, cwd=path, check=True, capture_output=True, text=True).stdout
+  return json.loads(output.strip().splitlines()[-1])
+
+
+def best(rounds):
+  """The best rate of each case over the rounds."""
+  result = {}
+  for rates in rounds:
+    for protocol, protocolRates in rates.items():
+      for name, value in protocolRates.items():
+        previous = result.setdefault(protocol, {}).get(name, 0)
+        result[protocol][name] = max(previous, value)
+  return result
+
+
+def run(duration, rounds=3, baseline=None):
+  """Run the benchmark and print the rates."""
+  currentRounds, baselineRounds = [], []
+  for _ in range(rounds):
+    currentRounds.append(measureTree(ROOT, duration))
+    if baseline:
+      baselineRounds.append(measureTree(os.path.abspath(baseline), duration))
+  current = best(currentRounds)
+  previous = best(baselineRounds) if baseline else {}
+
+  def formatRate(rates, protocol, name):
+    value = rates.get(protocol, {}).get(name)
+    return '-' if value is None else f'{value:.0f}'
+
+  def formatRatio(numerator, denominator):
+    return '-' if numerator is None or not denominator else f'{numerator / denominator:.2f}x'
+
+  header = f'{"protocol":>8} {"case":>8} {"messages/s":>12} {"vs IF1":>8}'
+  if baseline:
+    header += f' {"baseline":>12} {"vs baseline":>12}'
+  print(header)
+  for protocol in current:
+    for name in CASES:
+      value = current[protocol].get(name)
+      line = f'{protocol:>8} {name:>8} {formatRate(current, protocol, name):>12} {formatRatio(value, current.get("IF1", {}).get(name)):>8}'
+      if baseline:
+        line += f' {formatRate(previous, protocol, name):>12} {formatRatio(value, previous.get(protocol, {}).get(name)):>12}'
+      print(line)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Micro-benchmark of the core.')
+  parser.add_argument('--duration', type=float, default=1, help='Duration of each case in seconds. Default is 1.')
+  parser.add_argument('--rounds', type=int, default=3, help='Number of rounds, of which the best is reported. Default is 3.')
+  parser.add_argument('--baseline', help='Path of another checkout of the package to compare with, measured in interleaved rounds.')
+  parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.measure:
+    print(json.dumps(measure(args.duration)))
+  else:
+    run(args.duration, args.rounds, args.baseline)
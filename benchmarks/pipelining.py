@@ -0,0 +1,61 @@
+"""Benchmark of firing many non-blocking invocations with the in-flight window and the coalescing of small messages.
+
+A broker, a service and a client run in one process. The client fires ``count`` invocations through ``asynchronousInvoker`` from a thread and waits for all the results, with each of the configurations of the client.
+
+Usage: python -m benchmarks.pipelining [--count invocations] [--window slots]
+"""
+__license__ = "GNU General Public License v3"
+__author__ = 'Hwaipy'
+__email__ = 'hwaipy@gmail.com'
+
+import argparse
+import time
+from interactionfreepy import IFBroker, IFWorker, IFLoop
+
+
+class Echo:
+  """The service for the benchmark."""
+
+  def echo(self, data):
+    return data
+
+
+def fire(client, count):
+  """Fire ``count`` invocations and return the elapsed time in seconds until all the results arrive."""
+  invoker = client.asynchronousInvoker('PipelineEcho')
+  start = time.perf_counter()
+  futures = [invoker.echo(i) for i in range(count)]
+  results = [future.sync() for future in futures]
+  elapsed = time.perf_counter() - start
+  assert results == list(range(count))
+  return elapsed
+
+
+def run(count, window, port):
+  """Run the benchmark and print the throughput of each configuration."""
+  address = f'tcp://127.0.0.1:{port}'
+  broker = IFBroker(f'tcp://*:{port}')
+  service = IFWorker(address, 'PipelineEcho', Echo(), coalesce=True)
+  configurations = {
+      'plain': {},
+      'window': {'window': window},
+      'coalesce': {'coalesce': True},
+      'window+coalesce': {'window': window, 'coalesce': True},
+  }
+  print(f'{"client":>16} {"time/s":>8} {"calls/s":>10}')
+  for name, options in configurations.items():
+    client = IFWorker(address, **options)
+    fire(client, count // 10)
+    elapsed = fire(client, count)
+    print(f'{name:>16} {elapsed:>8.2f} {count / elapsed:>10.0f}')
+    client.close()
+  service.close()
+  IFLoop.getInstance().add_callback(broker.close)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark of the in-flight window and the coalescing of small messages.')
+  parser.add_argument('--count', type=int, default=20000, help='Number of invocations for each configuration. Default is 20000.')
+  parser.add_argument('--window', type=int, default=256, help='Size of the in-flight window. Default is 256.')
+  parser.add_argument('--port', type=int, default=21063, help='Port of the broker. Default is 21063.')
+  run(**vars(parser.parse_args()))
@@ -0,0 +1,60 @@
+"""Benchmark of the round-trip latency of invoking a service over the transports of ZeroMQ.
+
+A broker binds tcp, ipc and inproc endpoints at once, with a service connected over inproc. A client connects over each of the transports in turn and invokes the service synchronously.
+
+Usage: python -m benchmarks.transports [--count invocations]
+"""
+__license__ = "GNU General Public License v3"
+__author__ = 'Hwaipy'
+__email__ = 'hwaipy@gmail.com'
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from interactionfreepy import IFBroker, IFWorker, IFLoop
+
+
+class Echo:
+  """The service for the benchmark."""
+
+  def echo(self, data):
+    return data
+
+
+def latencies(client, count):
+  """Invoke the service ``count`` times and return the round-trip latencies in microseconds."""
+  results = []
+  for _ in range(count):
+    start = time.perf_counter()
+    client.TransportEcho.echo(1)
+    results.append((time.perf_counter() - start) * 1e6)
+  return results
+
+
+def run(count, port):
+  """Run the benchmark and print the latencies."""
+  addresses = {
+      'tcp': f'tcp://127.0.0.1:{port}',
+      'ipc': 'ipc://' + os.path.join(tempfile.mkdtemp(), 'broker'),
+      'inproc': 'inproc://TransportBenchmark',
+  }
+  broker = IFBroker([f'tcp://*:{port}', addresses['ipc'], addresses['inproc']])
+  service = IFWorker(addresses['inproc'], 'TransportEcho', Echo())
+  print(f'{"transport":>9} {"median/us":>10} {"mean/us":>10} {"p99/us":>10}')
+  for transport, address in addresses.items():
+    client = IFWorker(address)
+    latencies(client, count // 10)
+    results = sorted(latencies(client, count))
+    print(f'{transport:>9} {statistics.median(results):>10.1f} {statistics.mean(results):>10.1f} {results[int(len(results) * 0.99)]:>10.1f}')
+    client.close()
+  service.close()
+  IFLoop.getInstance().add_callback(broker.close)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark of the round-trip latency over the transports.')
+  parser.add_argument('--count', type=int, default=5000, help='Number of invocations for each transport. Default is 5000.')
+  parser.add_argument('--port', type=int, default=21061, help='Port of the tcp endpoint. Default is 21061.')
+  run(**vars(parser.parse_args()))
@@ -4,62 +4,108 @@ __author__ = 'Hwaipy'
 __email__ = 'hwaipy@gmail.com'
 
 import time
+import heapq
+import struct
+import uuid
 import logging
+from collections import OrderedDict, deque
 import traceback
 import ssl
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
 from tornado import websocket, web, httpserver
 from tornado.ioloop import IOLoop
-from interactionfreepy.core import IFDefinition, IFException, Invocation, Message, IFLoop, IFAddress
+from interactionfreepy.core import IFDefinition, IFException, Invocation, Message, IFLoop, IFAddress, CodecRegistry, Dispatcher, Chunking, PubSub, Expiry, Bundling
 
 
 class IFBroker:
   """
   IFBroker is the center server of InteractionFree.
   
-  :param binding: The address to bind. Default is ``'*'``. The full address is expected to be in the format of ``'tcp://ip:port'``, while ``tcp://`` can be omitted, and the default port is ``1061``.
-  :type binding: str
+  :param binding: The address to bind, or a list of addresses to bind all of them, e.g. ``['tcp://*:1061', 'ipc:///tmp/broker']``. Default is ``'*'``. The full address is expected to be in the format of ``'tcp://ip:port'``, while ``tcp://`` can be omitted, and the default port is ``1061``. The transports ``ipc`` and ``inproc`` are supported as well, see ``IFAddress``.
+  :type binding: str or list
   :param manager: The manager to use. If not given, a default manager will be created.
   :type manager: Manager
+  :param zeroCopy: If True, messages are received as ``zmq.Frame`` objects. Only the routing frames are copied into bytes, and the serialization, invocation and buffer frames are forwarded without being copied into Python. Messages to the broker itself are still copied. It saves the copies of large payloads, at the cost of some overhead for small messages. Default is False.
+  :type zeroCopy: bool
+  :param peerID: The ID of the broker in a federation, see ``peer``. A random ID is generated if not given.
+  :type peerID: str
+
+  Messages to a service with several replicas are sent to the replica with the least outstanding requests. The broker counts the requests that it sends to each replica and peeks at the ResponseIDs of the responses from the replica, see ``Message.peekInvocation``. Requests that are not responded in ``TRACKING_TIMEOUT`` seconds, e.g., those responded in chunks, are no longer counted.
   
   """
 
-  def __init__(self, binding='*', manager=None):
+  TRACKING_TIMEOUT = 3 * IFDefinition.HEARTBEAT_LIVETIME
+  WEBSOCKET_SEND_QUEUE_SIZE = 100
+
+  def __init__(self, binding='*', manager=None, zeroCopy=False, peerID=None):
 
-    self.address = IFAddress.parseAddress(binding)
-    socket = zmq.Context().socket(zmq.ROUTER)
-    socket.bind(f'{self.address[0]}://{self.address[1]}:{self.address[2]}')
+    self.addresses = [IFAddress.parseAddress(address) for address in ([binding] if isinstance(binding, str) else binding)]
+    if not self.addresses:
+      raise ValueError('No address to bind.')
+    self.address = self.addresses[0]
+    # inproc endpoints are only reachable in the same context, thus the context shared in the process is used.
+    context = zmq.Context.instance() if any(address[0] == 'inproc' for address in self.addresses) else zmq.Context()
+    socket = context.socket(zmq.ROUTER)
+    for address in self.addresses:
+      socket.bind(IFAddress.toEndpoint(address))
     self.main_stream = ZMQStream(socket, IOLoop.current())
-    self.main_stream.on_recv(self.__onMessage)
+    self.zeroCopy = zeroCopy
+    self.main_stream.on_recv(self.__onMessage, copy=not zeroCopy)
     if manager is None:
       self.manager = Manager(self)
     else:
       self.manager = manager
       self.manager.broker = self
+    self.__dispatcher = Dispatcher(self.manager)
+    self.__inFlight = {}
+    self.__pinned = {}
+    self.__queues = {}
+    self.__queueStatistics = {}
+    self.peerID = (uuid.uuid4().hex if peerID is None else peerID).encode('UTF-8')
+    if IFDefinition.PEER_SEPARATOR in self.peerID:
+      raise IFException(f'Bad peer ID: {peerID}')
+    self.__peers = {}
+    self.__peerStreams = []
+    self.__outboxes = {}
+    self.__inprocEndpoint = None
+    IOLoop.current().call_later(IFDefinition.HEARTBEAT_LIVETIME, self.__purge)
+    IOLoop.current().call_later(IFDefinition.HEARTBEAT_LIVETIME / 5, self.__advertiseLoop)
     IFLoop.tryStart()
 
   def close(self):
     """Close the server. All the connections will be closed."""
+    for stream in self.__peerStreams:
+      stream.close()
+    self.__peerStreams = []
     self.main_stream.on_recv(None)
     self.main_stream.socket.setsockopt(zmq.LINGER, 0)
     # self.main_stream.socket.close()
     self.main_stream.close()
     self.main_stream = None
 
-  def startWebSocket(self, port, path, sslOptions=None):
+  def startWebSocket(self, port, path, sslOptions=None, coalesce=False, sendQueueSize=WEBSOCKET_SEND_QUEUE_SIZE):
     '''Start a WebSocket server on the given port, with the given path. If sslOptions is given, the WebSocket server will use SSL.
 
+    The WebSocket clients are bridged to the broker over an inproc endpoint of the ROUTER, with the DEALERs of all the clients in the context of the broker.
+
     :param port: The port to listen.
     :type port: int
     :param path: The path to listen.
     :type path: str
     :param sslOptions: The SSL options. If not given, the WebSocket server will not use SSL. sslOptions should be a dict with two keys: ``'certfile'`` and ``'keyfile'``.
     :type sslOptions: dict
+    :param coalesce: If True, each multipart message is carried in one WebSocket binary message in both directions, see ``WebSocketZMQBridgeHandler.coalesceFrames``. Otherwise, each frame is carried in a WebSocket message prefixed by a byte, which is 1 if more frames follow and 0 for the last frame.
+    :type coalesce: bool
+    :param sendQueueSize: The maximum number of messages that are written to a client but not flushed yet. Beyond it, the bridge stops receiving for the client until the writes are flushed, and the messages wait in the DEALER, whose receiving high-water mark is the same size, and then in the ROUTER, which drops the messages to the client when its high-water mark is reached.
+    :type sendQueueSize: int
     :return: None
     '''
+    if self.__inprocEndpoint is None:
+      self.__inprocEndpoint = f'inproc://IFBroker-{uuid.uuid4().hex}'
+      self.main_stream.socket.bind(self.__inprocEndpoint)
     handlersArray = [
-        (path, WebSocketZMQBridgeHandler, {'port': self.address[2]}),
+        (path, WebSocketZMQBridgeHandler, {'endpoint': self.__inprocEndpoint, 'context': self.main_stream.socket.context, 'coalesce': coalesce, 'sendQueueSize': sendQueueSize}),
         (r"/(.+)", web.StaticFileHandler, {'path': 'interactionfreepy'}),
     ]
     app = web.Application(handlersArray)
@@ -70,62 +116,381 @@ class IFBroker:
     else:
       app.listen(port)
 
+  def peer(self, endpoint):
+    '''Peer with another broker, so that the workers of each broker can invoke the services of the other.
+
+    The brokers advertise their services to each other every ``IFDefinition.HEARTBEAT_LIVETIME / 5`` seconds, and ``Manager`` keeps a copy of the services of each peer. A message to a service of a peer is forwarded over the link of the two brokers, and the target sees the requester at the address ``b'IFPeer:<peerID>|<address>'``. Messages are forwarded over one link at most, thus every two brokers of a federation should be peered, in either direction.
+
+    :param endpoint: The address of the other broker, in the format of ``'tcp://ip:port'``.
+    :type endpoint: str
+    :return: None
+    '''
+    address = IFAddress.parseAddress(endpoint)
+    socket = (zmq.Context.instance() if address[0] == 'inproc' else zmq.Context()).socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, IFDefinition.PEER_PREFIX + self.peerID)
+    socket.setsockopt(zmq.LINGER, 0)
+    stream = ZMQStream(socket, IOLoop.current())
+    send = lambda frames: IFLoop.send(stream, frames, not self.zeroCopy)
+    stream.on_recv(lambda msg: self.__onPeerMessage(send, msg), copy=not self.zeroCopy)
+    stream.connect(IFAddress.toEndpoint(address))
+    self.__peerStreams.append(stream)
+    IOLoop.current().add_callback(self.__advertise, send)
+
+  def advertise(self):
+    """Advertise the services to the peers right away, e.g., when a service is registered or unregistered."""
+    IOLoop.current().add_callback(self.__advertiseAll)
+
+  def __advertiseLoop(self):
+    if self.main_stream is None:
+      return
+    expiry = time.time() - IFDefinition.HEARTBEAT_LIVETIME
+    for peerAddress in [peerAddress for peerAddress, peer in self.__peers.items() if peer[1] < expiry]:
+      self.__peers.pop(peerAddress)
+    self.__advertiseAll()
+    IOLoop.current().call_later(IFDefinition.HEARTBEAT_LIVETIME / 5, self.__advertiseLoop)
+
+  def __advertiseAll(self):
+    if self.main_stream is None:
+      return
+    # Each link is advertised once: by its stream on the connecting side, and by the peer identity on the bound side.
+    for stream in self.__peerStreams:
+      self.__advertise(lambda frames, stream=stream: IFLoop.send(stream, frames, not self.zeroCopy))
+    for peer in self.__peers.values():
+      if peer[2]:
+        self.__advertise(peer[0])
+
+  def __advertise(self, send):
+    message = Message.newBrokerMessage(Invocation.newRequest('updatePeerServices', [self.manager.exportServices(None)], {}))
+    send([b'', self.peerID, b''] + message.getContent()[1:])
+
   def __onMessage(self, msg):
     try:
+      if self.zeroCopy:
+        # Frames 0 to 6 are the routing frames: source, empty, protocol, message ID, distributing mode, address and serialization.
+        msg = [frame.bytes for frame in msg[:7]] + msg[7:]
       sourcePoint, msg = msg[0], msg[1:]
-      protocol = msg[1]
-      self.manager.statistics(sourcePoint, True, msg)
-      if protocol != IFDefinition.PROTOCOL:
-        raise IFException(f'Protocol {protocol} not supported.')
-      distributingMode = msg[3]
-      distributingAddress = msg[4]
-      if distributingMode == IFDefinition.DISTRIBUTING_MODE_BROKER:
-        IOLoop.current().add_callback(self.__onMessageDistributeLocal, sourcePoint, msg)
-      elif distributingMode == IFDefinition.DISTRIBUTING_MODE_DIRECT:
-        self.__onMessageDistributeDirect(sourcePoint, distributingAddress, msg)
-      elif distributingMode == IFDefinition.DISTRIBUTING_MODE_SERVICE:
-        self.__onMessageDistributeService(sourcePoint, distributingAddress, msg)
+      if sourcePoint.startswith(IFDefinition.PEER_PREFIX):
+        self.__onPeerMessage(lambda frames: IFLoop.send(self.main_stream, [sourcePoint] + frames, not self.zeroCopy), msg, True)
       else:
-        raise IFException(f'Distributing mode {distributingMode} not supported.')
+        self.__distribute(sourcePoint, msg)
     except BaseException as exception:
       logging.debug(exception)
 
+  def __onPeerMessage(self, send, msg, bound=False):
+    # Frames from a peer are: empty, the peer ID, the address of the source on the peer, and then the frames of an outgoing message without the leading empty frame.
+    try:
+      if self.zeroCopy:
+        msg = [bytes(frame) for frame in msg[:8]] + msg[8:]
+      peerID, origin = msg[1], msg[2]
+      peerAddress = IFDefinition.PEER_PREFIX + peerID
+      isNew = peerAddress not in self.__peers
+      self.__peers[peerAddress] = [send, time.time(), bound]
+      if isNew and bound:
+        self.__advertise(send)
+      sourcePoint = peerAddress + IFDefinition.PEER_SEPARATOR + origin if origin else peerAddress
+      self.__distribute(sourcePoint, [b''] + msg[3:], True)
+    except BaseException as exception:
+      logging.debug(exception)
+
+  def __distribute(self, sourcePoint, msg, fromPeer=False):
+    if msg[3] == Bundling.DISTRIBUTING_MODE and not fromPeer:
+      for frames in Bundling.unbundle(msg[6]):
+        self.__distribute(sourcePoint, frames)
+      return
+    protocol = msg[1]
+    self.manager.statistics(sourcePoint, True, msg)
+    if protocol not in IFDefinition.PROTOCOLS:
+      raise IFException(f'Protocol {protocol} not supported.')
+    distributingMode = msg[3]
+    distributingAddress = msg[4]
+    if distributingMode == IFDefinition.DISTRIBUTING_MODE_BROKER:
+      IOLoop.current().add_callback(self.__onMessageDistributeLocal, sourcePoint, msg)
+    elif distributingMode == IFDefinition.DISTRIBUTING_MODE_DIRECT:
+      # Messages from peers are only delivered locally. The empty address is of the peer broker itself, e.g., for the responses of advertisements.
+      if fromPeer and (not distributingAddress or distributingAddress.startswith(IFDefinition.PEER_PREFIX)):
+        return
+      self.__onMessageDistributeDirect(sourcePoint, distributingAddress, msg)
+    elif distributingMode == IFDefinition.DISTRIBUTING_MODE_SERVICE:
+      self.__onMessageDistributeService(sourcePoint, distributingAddress, msg, fromPeer)
+    elif distributingMode == IFDefinition.DISTRIBUTING_MODE_PUBLISH and not fromPeer:
+      self.__onMessageDistributePublish(sourcePoint, distributingAddress, msg)
+    else:
+      raise IFException(f'Distributing mode {distributingMode} not supported.')
+
   async def __onMessageDistributeLocal(self, sourcePoint, msg):
     try:
       message = None
-      message = Message(msg)
+      if self.zeroCopy:
+        msg = msg[:6] + [frame.bytes for frame in msg[6:]]
+      message = Message(msg, outgoing=True)
+      if not CodecRegistry.get(message.serialization).safe:
+        raise IFException(f'Serialization {str(message.serialization, encoding="UTF-8")} not accepted by the broker.')
       invocation = message.getInvocation()
+      if invocation.getFunction() == PubSub.FUNCTION_ACK:
+        # Acknowledgements of publications are not responded.
+        self.manager.acknowledgePublications(sourcePoint, *invocation.getArguments())
+        return
       result = self.manager.heartbeat(sourcePoint)
       if invocation.getFunction() != 'heartbeat':
-        result = await invocation.perform(self.manager, sourcePoint)
-      responseMessage = Message.newFromBrokerMessage(b'', Invocation.newResponse(message.messageID, result))
+        result = await invocation.perform(self.__dispatcher, sourcePoint)
+      responseMessage = Message.newFromBrokerMessage(b'', Invocation.newResponse(message.replyID, result), message.serialization, message.getProtocol())
       self.__sendMessage([sourcePoint] + responseMessage)
     except BaseException as exception:
       if message:
-        errorMsg = Message.newFromBrokerMessage(b'', Invocation.newError(message.messageID, str(exception)))
+        errorMsg = Message.newFromBrokerMessage(b'', Invocation.newError(message.replyID, str(exception)), protocol=message.getProtocol())
         self.__sendMessage([sourcePoint] + errorMsg)
 
-  def __onMessageDistributeService(self, sourcePoint, distributingAddress, msg):
+  def __onMessageDistributeService(self, sourcePoint, distributingAddress, msg, fromPeer=False):
     distributingAddress = str(distributingAddress, encoding='UTF-8')
     try:
-      targetAddress = self.manager.getAddressOfService(sourcePoint, distributingAddress)
-      if not targetAddress:
-        raise IFException(f'Service {distributingAddress} not exist.')
+      replicas = self.manager.getReplicasOfService(sourcePoint, distributingAddress)
+      if not replicas:
+        peerAddress = None if fromPeer else self.manager.getPeerOfService(sourcePoint, distributingAddress)
+        if peerAddress is None:
+          raise IFException(f'Service {distributingAddress} not exist.')
+        self.__sendToPeer(peerAddress, sourcePoint, msg)
+        return
+      limits = self.manager.getServiceLimits(sourcePoint, distributingAddress)
+      if len(replicas) > 1 or limits is not None:
+        message = Message(msg, outgoing=True)
+        peeked = message.peekInvocation()
+        if peeked == (Invocation.ValueTypeRequest, Expiry.FUNCTION_CANCEL):
+          self.__cancel(sourcePoint, distributingAddress, replicas, message)
+          return
+      if limits is not None:
+        self.__admit(sourcePoint, distributingAddress, replicas, limits, msg, peeked)
+        return
+      targetAddress = replicas[0] if len(replicas) == 1 else self.__chooseReplica(sourcePoint, distributingAddress, replicas, message, peeked)
       self.__sendMessage([targetAddress] + msg[:3] + [sourcePoint] + msg[5:])
     except BaseException as exception:
-      errorMsg = Message.newFromBrokerMessage(b'', Invocation.newError(Message(msg).messageID, str(exception)))
+      errorMsg = Message.newFromBrokerMessage(b'', Invocation.newError(Message(msg, outgoing=True).replyID, str(exception)), protocol=msg[1])
       self.__sendMessage([sourcePoint] + errorMsg)
 
+  def __onMessageDistributePublish(self, sourcePoint, topic, msg):
+    frames = msg[:3] + [sourcePoint] + msg[5:]
+    for subscriber in self.manager.publish(sourcePoint, str(topic, encoding='UTF-8')):
+      self.__sendMessage([subscriber] + frames)
+
   def __onMessageDistributeDirect(self, sourcePoint, distributingAddress, msg):
     try:
+      if sourcePoint in self.__inFlight:
+        self.__settle(sourcePoint, distributingAddress, Message(msg, outgoing=True))
       self.__sendMessage([distributingAddress] + msg[:3] + [sourcePoint] + msg[5:])
     except BaseException as exception:
-      errorMsg = Message.newFromBrokerMessage(b'', Invocation.newError(Message(msg).messageID, str(exception)))
+      errorMsg = Message.newFromBrokerMessage(b'', Invocation.newError(Message(msg, outgoing=True).replyID, str(exception)), protocol=msg[1])
       self.__sendMessage([sourcePoint] + errorMsg)
 
+  def __chooseReplica(self, sourcePoint, serviceName, replicas, message, peeked=False):
+    # Requests go to the replica with the least outstanding requests. All the chunks from a requester to a service go to the same replica, so that the transfers can be rebuilt.
+    if peeked is False:
+      peeked = message.peekInvocation()
+    pinKey = (sourcePoint, serviceName)
+    isChunk = peeked == (Invocation.ValueTypeRequest, Chunking.FUNCTION)
+    targetAddress = None
+    if isChunk and pinKey in self.__pinned:
+      targetAddress = self.__pinned[pinKey][0]
+      if targetAddress not in replicas:
+        targetAddress = None
+    idempotencyKey = message.idempotencyKey
+    if targetAddress is None and idempotencyKey is not None:
+      # A duplicate of an idempotent request, e.g., a hedged one, goes to a replica that is not running the same request, see ``Idempotency``.
+      candidates = [replica for replica in replicas if not any(key[0] == sourcePoint and entry[4] == idempotencyKey for key, entry in self.__inFlight.get(replica, {}).items())]
+      if candidates:
+        targetAddress = min(candidates, key=lambda replica: len(self.__inFlight.get(replica, ())))
+    if targetAddress is None:
+      targetAddress = min(replicas, key=lambda replica: len(self.__inFlight.get(replica, ())))
+    if isChunk:
+      self.__pinned[pinKey] = (targetAddress, time.time())
+    if peeked is None or peeked[0] == Invocation.ValueTypeRequest:
+      self.__inFlight.setdefault(targetAddress, OrderedDict())[(sourcePoint, message.idKey)] = (message.getProtocol(), message.replyID, time.time(), serviceName, idempotencyKey)
+    return targetAddress
+
+  def __settle(self, sourcePoint, requester, message):
+    # A response from a replica settles the request it replies to. Responses that can not be peeked, and responses sent in chunks, settle the earliest request of the requester instead.
+    inFlight = self.__inFlight[sourcePoint]
+    try:
+      peeked = message.peekInvocation()
+      if peeked is None or (peeked == (Invocation.ValueTypeRequest, Chunking.FUNCTION) and message.getInvocation().getArguments()[1] == 0):
+        key = next((key for key in inFlight if key[0] == requester), None)
+      elif peeked[0] == Invocation.ValueTypeResponse:
+        key = (requester, Message.toIDKey(peeked[1]))
+      else:
+        return
+    except BaseException as exception:
+      logging.debug(exception)
+      return
+    entry = inFlight.pop(key, None)
+    if not inFlight:
+      self.__inFlight.pop(sourcePoint)
+    if entry is not None and entry[3] in self.__queues:
+      self.__drain(entry[3])
+
+  def __cancel(self, sourcePoint, serviceName, replicas, message):
+    # A cancellation goes to the replica that the request is in flight on. A request still in the queue is dropped instead.
+    key = (sourcePoint, Message.toIDKey(message.getInvocation().getArguments()[0]))
+    queue = self.__queues.get(serviceName)
+    if queue is not None:
+      for entry in queue:
+        if entry[0] == sourcePoint and Message.toIDKey(entry[1][2]) == key[1]:
+          queue.remove(entry)
+          self.__queueStatistics[serviceName][3] += 1
+          if not queue:
+            self.__queues.pop(serviceName)
+          return
+    for replica in replicas:
+      if key in self.__inFlight.get(replica, ()):
+        self.__sendMessage([replica] + message.getContent()[:3] + [sourcePoint] + message.getContent()[5:])
+        return
+
+  def __inFlightOf(self, replicas):
+    return sum(len(self.__inFlight.get(replica, ())) for replica in replicas)
+
+  def __admit(self, sourcePoint, serviceName, replicas, limits, msg, peeked=False):
+    # Requests beyond the concurrency of a service wait in its queue, and are rejected if the queue is full.
+    concurrency, queueSize = limits
+    queue = self.__queues.get(serviceName)
+    if queue is None and self.__inFlightOf(replicas) < concurrency:
+      targetAddress = self.__chooseReplica(sourcePoint, serviceName, replicas, Message(msg, outgoing=True), peeked)
+      self.__sendMessage([targetAddress] + msg[:3] + [sourcePoint] + msg[5:])
+      return
+    statistics = self.__queueStatistics.setdefault(serviceName, [0, 0.0, 0, 0])
+    if queueSize == 0 or (queue is not None and len(queue) >= queueSize):
+      statistics[2] += 1
+      raise IFException(f'Service [{serviceName}] overloaded: {self.__inFlightOf(replicas)} requests in flight and {0 if queue is None else len(queue)} queued.')
+    self.__queues.setdefault(serviceName, deque()).append((sourcePoint, msg, time.time()))
+
+  def __drain(self, serviceName):
+    queue = self.__queues[serviceName]
+    replicas = self.manager.getReplicasOfService(None, serviceName)
+    limits = self.manager.getServiceLimits(None, serviceName)
+    statistics = self.__queueStatistics[serviceName]
+    while queue and (not replicas or limits is None or self.__inFlightOf(replicas) < limits[0]):
+      sourcePoint, msg, enqueuedTime = queue.popleft()
+      waited = time.time() - enqueuedTime
+      try:
+        timeout = Message(msg, outgoing=True).timeout
+        if timeout is not None and waited > timeout:
+          # The requester has given up on the request.
+          statistics[3] += 1
+          continue
+        statistics[0] += 1
+        statistics[1] += waited
+        if not replicas:
+          raise IFException(f'Service {serviceName} not exist.')
+        targetAddress = self.__chooseReplica(sourcePoint, serviceName, replicas, Message(msg, outgoing=True))
+        self.__sendMessage([targetAddress] + msg[:3] + [sourcePoint] + msg[5:])
+      except BaseException as exception:
+        errorMsg = Message.newFromBrokerMessage(b'', Invocation.newError(Message(msg, outgoing=True).replyID, str(exception)), protocol=msg[1])
+        self.__sendMessage([sourcePoint] + errorMsg)
+    if not queue:
+      self.__queues.pop(serviceName)
+
+  def queueStatus(self, serviceName):
+    """Get the status of the concurrency limit and the queue of a service, see ``Manager.registerAsService``.
+
+    :param serviceName: The name of the service.
+    :type serviceName: str
+    :return: A dict of the numbers of requests in flight, queued, dispatched from the queue, rejected, and expired or cancelled in the queue, and the wait times in seconds of the oldest queued request and of the requests dispatched from the queue on average. None if the service is not limited.
+    :rtype: dict
+    """
+    limits = self.manager.getServiceLimits(None, serviceName)
+    if limits is None:
+      return None
+    queue = self.__queues.get(serviceName, ())
+    dispatched, totalWait, rejected, expired = self.__queueStatistics.get(serviceName, [0, 0.0, 0, 0])
+    return {
+        "Concurrency": limits[0],
+        "Queue Size": limits[1],
+        "In Flight": self.__inFlightOf(self.manager.getReplicasOfService(None, serviceName) or []),
+        "Queued": len(queue),
+        "Dispatched": dispatched,
+        "Rejected": rejected,
+        "Expired": expired,
+        "Oldest Wait": time.time() - queue[0][2] if queue else 0.0,
+        "Average Wait": totalWait / dispatched if dispatched else 0.0,
+    }
+
+  def releaseWorker(self, address, error=None):
+    """Stop tracking the requests in flight on a replica of a service, e.g., when it is unregistered.
+
+    :param address: The address of the worker.
+    :type address: bytes
+    :param error: If given, the requests in flight on the worker are responded with this error, so that the requesters do not wait for a lost worker.
+    :type error: str
+    """
+    inFlight = self.__inFlight.pop(address, {})
+    for key in [key for key, pinned in self.__pinned.items() if pinned[0] == address]:
+      self.__pinned.pop(key)
+    if error is not None:
+      for (requester, _), (protocol, replyID, *_) in inFlight.items():
+        errorMsg = Message.newFromBrokerMessage(b'', Invocation.newError(replyID, error), protocol=protocol)
+        self.__sendMessage([requester] + errorMsg)
+    for serviceName in {entry[3] for entry in inFlight.values()}:
+      if serviceName in self.__queues:
+        IOLoop.current().add_callback(self.__drain, serviceName)
+
+  def __purge(self):
+    # Responses sent in chunks are not seen by the broker. The requests they reply to are forgotten here.
+    if self.main_stream is None:
+      return
+    expiry = time.time() - IFBroker.TRACKING_TIMEOUT
+    for address in list(self.__inFlight.keys()):
+      inFlight = self.__inFlight[address]
+      while inFlight and next(iter(inFlight.values()))[2] < expiry:
+        inFlight.popitem(last=False)
+      if not inFlight:
+        self.__inFlight.pop(address)
+    for serviceName in list(self.__queues.keys()):
+      self.__drain(serviceName)
+    for key in [key for key, pinned in self.__pinned.items() if pinned[1] < expiry]:
+      self.__pinned.pop(key)
+    IOLoop.current().call_later(IFDefinition.HEARTBEAT_LIVETIME, self.__purge)
+
   def __sendMessage(self, frames):
     self.manager.statistics(frames[0], False, frames)
-    self.main_stream.send_multipart(frames)
+    if frames[0].startswith(IFDefinition.PEER_PREFIX):
+      # The target is on a peer. The frames are converted to a direct message from the source.
+      peerAddress, _, address = frames[0].partition(IFDefinition.PEER_SEPARATOR)
+      self.__sendToPeer(peerAddress, frames[4], frames[1:4] + [IFDefinition.DISTRIBUTING_MODE_DIRECT, address] + frames[5:])
+    elif frames[0] in self.__outboxes:
+      # The messages to a worker that has asked for bundles are bundled once per iteration of the loop.
+      outbox = self.__outboxes[frames[0]]
+      outbox.append(frames[1:])
+      if len(outbox) == 1:
+        IOLoop.current().add_callback(self.__flushOutbox, frames[0])
+    else:
+      IFLoop.send(self.main_stream, frames, not self.zeroCopy)
+
+  def setBundling(self, address, enabled):
+    """Start or stop bundling the messages to a worker, see ``Bundling``. Messages already waiting in its outbox are sent first.
+
+    :param address: The address of the worker.
+    :type address: bytes
+    :param enabled: True to start bundling, False to stop.
+    :type enabled: bool
+    :return: True if the messages to the worker were bundled before.
+    """
+    if enabled:
+      if address in self.__outboxes:
+        return True
+      self.__outboxes[address] = []
+      return False
+    self.__flushOutbox(address)
+    return self.__outboxes.pop(address, None) is not None
+
+  def __flushOutbox(self, target):
+    outbox = self.__outboxes.get(target)
+    if not outbox:
+      return
+    self.__outboxes[target] = []
+    for frames in Bundling.bundle(outbox, False):
+      IFLoop.send(self.main_stream, [target] + frames, not self.zeroCopy)
+
+  def __sendToPeer(self, peerAddress, origin, msg):
+    peer = self.__peers.get(peerAddress)
+    if peer is None:
+      raise IFException(f'Peer {str(peerAddress, encoding="UTF-8")} not connected.')
+    peer[0]([b'', self.peerID, origin] + msg[1:])
 
 
 class Manager:
@@ -140,11 +505,15 @@ class Manager:
     self.__workers = {}
     self.__services = {}
     self.__activities = {}
+    self.__deadlines = []
     self.__nonservice = {}
+    self.__peerServices = {}
+    self.__subscriptions = {}
+    self.__subscribers = {}
     self.__previousGCTime = time.time()
     IOLoop.current().call_later(2, self.__check)
 
-  def registerAsService(self, sourcePoint, name, interfaces=None, force=False):
+  def registerAsService(self, sourcePoint, name, interfaces=None, force=False, codecs=None, replica=False, concurrency=None, queueSize=0):
     """Register a worker as a service.
 
     Args:
@@ -152,32 +521,153 @@ class Manager:
         name (str): The name of the service.
         interfaces (list): The interfaces of the service.
         force (bool): If True, the service will be registered even if the name is occupied. The old service will be replaced.
+        codecs (list): The names of the codecs that the service accepts. If not given, only the default codec ``'Msgpack'`` is accepted.
+        replica (bool): If True and the name is occupied, the worker joins the service as a replica, and the messages to the service are balanced among the replicas. The replicas are expected to serve the same object. The interfaces, the codecs and the limits of the first replica are kept.
+        concurrency (int): The maximum number of requests in flight on the service, over all its replicas. Requests beyond it wait in the queue of the service in the broker. None for no limit.
+        queueSize (int): The maximum number of requests waiting in the queue. Requests beyond it are rejected with an overload error right away. Only used with ``concurrency``.
     """
-    if name in self.__services and not force:
+    if name in self.__services and not force and not replica:
       raise IFException(f'Service name [{name}] occupied.')
     if sourcePoint in self.__workers:
       raise IFException(f'The current worker has registered as [{name}].')
+    if name in self.__services and not force:
+      self.__services[name][6].append(sourcePoint)
+      self.__workers[sourcePoint] = name
+      self.__nonservice.pop(sourcePoint, None)
+      logging.info(f'Service [{name}] registered with {len(self.__services[name][6])} replicas.')
+      self.__advertise()
+      return
     if interfaces is None:
       interfaces = []
-    self.__services[name] = [sourcePoint, interfaces, time.time(), [0] * 4]
-    self.__workers[sourcePoint] = name
+    if codecs is None:
+      codecs = [CodecRegistry.DEFAULT]
+    protocols = [str(IFDefinition.PROTOCOL, encoding='UTF-8')]
     if sourcePoint in self.__nonservice:
-      self.__nonservice.pop(sourcePoint)
+      protocols = self.__nonservice.pop(sourcePoint)[3]
+    limits = None if concurrency is None else (concurrency, queueSize)
+    self.__services[name] = [sourcePoint, interfaces, time.time(), [0] * 4, codecs, protocols, [sourcePoint], limits]
+    self.__workers[sourcePoint] = name
     loggingMsg = f'Service [{name}] registered as {interfaces}.' if interfaces else f'Service [{name}] registered.'
     logging.info(loggingMsg)
+    self.__advertise()
 
   def unregister(self, sourcePoint):
-    """Unregister a worker.
+    """Unregister a worker. Its subscriptions are removed, and the messages to it are no longer bundled.
 
     Args:
         sourcePoint (str): The source point of the invoker.
     """
+    if sourcePoint in self.__subscribers:
+      self.unsubscribe(sourcePoint)
+    if self.broker is not None:
+      self.broker.setBundling(sourcePoint, False)
     if sourcePoint in self.__workers:
       serviceName = self.__workers.pop(sourcePoint)
-      if serviceName in self.__services and self.__services[serviceName][0] == sourcePoint:
-        self.__services.pop(serviceName)
-        loggingMsg = f'Service [{serviceName}] unregistered.'
-        logging.info(loggingMsg)
+      if self.broker is not None:
+        self.broker.releaseWorker(sourcePoint)
+      meta = self.__services.get(serviceName)
+      if meta is not None and sourcePoint in meta[6]:
+        meta[6].remove(sourcePoint)
+        if meta[6]:
+          meta[0] = meta[6][0]
+          logging.info(f'A replica of service [{serviceName}] unregistered.')
+        else:
+          self.__services.pop(serviceName)
+          loggingMsg = f'Service [{serviceName}] unregistered.'
+          logging.info(loggingMsg)
+        self.__advertise()
+
+  def __advertise(self):
+    if self.broker is not None:
+      self.broker.advertise()
+
+  def subscribe(self, sourcePoint, topic, highWaterMark=None):
+    """Subscribe to the publications of the topics that start with a prefix, see ``PubSub``.
+
+    Args:
+        sourcePoint (str): The source point of the invoker.
+        topic (str): The prefix of the topics. '' for all topics.
+        highWaterMark (int): The maximum number of publications unacknowledged by the worker, over all its subscriptions. Publications beyond it are dropped for the worker. ``PubSub.HIGH_WATER_MARK`` if None.
+    """
+    subscriber = self.__subscribers.setdefault(sourcePoint, [PubSub.HIGH_WATER_MARK, 0, 0, 0, set()])
+    if highWaterMark is not None:
+      subscriber[0] = highWaterMark
+    subscriber[4].add(topic)
+    self.__subscriptions.setdefault(topic, set()).add(sourcePoint)
+
+  def unsubscribe(self, sourcePoint, topic=None):
+    """Unsubscribe from a prefix of topics.
+
+    Args:
+        sourcePoint (str): The source point of the invoker.
+        topic (str): The prefix that was subscribed to. None for all the subscriptions of the worker.
+    """
+    subscriber = self.__subscribers.get(sourcePoint)
+    if subscriber is None:
+      return
+    for prefix in list(subscriber[4]) if topic is None else [topic]:
+      subscriber[4].discard(prefix)
+      addresses = self.__subscriptions.get(prefix)
+      if addresses is not None:
+        addresses.discard(sourcePoint)
+        if not addresses:
+          self.__subscriptions.pop(prefix)
+    if not subscriber[4]:
+      self.__subscribers.pop(sourcePoint)
+
+  def publish(self, sourcePoint, topic):
+    """Select the subscribers to deliver a publication to. The publication is counted as unacknowledged for each of them, or as dropped for those at their high-water marks.
+
+    Args:
+        sourcePoint (str): The source point of the publisher. Not used.
+        topic (str): The topic of the publication.
+
+    Returns:
+        list: The addresses of the subscribers.
+    """
+    addresses = set()
+    for prefix, subscribed in self.__subscriptions.items():
+      if topic.startswith(prefix):
+        addresses |= subscribed
+    results = []
+    for address in addresses:
+      subscriber = self.__subscribers[address]
+      if subscriber[1] >= subscriber[0]:
+        subscriber[3] += 1
+      else:
+        subscriber[1] += 1
+        subscriber[2] += 1
+        results.append(address)
+    return results
+
+  def acknowledgePublications(self, sourcePoint, count):
+    """Acknowledge the publications handled by a subscriber. The Broker does not respond to it.
+
+    Args:
+        sourcePoint (str): The source point of the subscriber.
+        count (int): The number of publications handled since the last acknowledgement.
+    """
+    subscriber = self.__subscribers.get(sourcePoint)
+    if subscriber is not None:
+      subscriber[1] = max(0, subscriber[1] - count)
+
+  def listSubscribers(self, sourcePoint):
+    """List all subscribers with their subscriptions and statistics.
+
+    Args:
+        sourcePoint (str): The source point of the invoker. Not used.
+
+    Returns:
+        list: A list of subscriber informations.
+    """
+    return [{
+        "Address": address,
+        "Topics": sorted(subscriber[4]),
+        "High Water Mark": subscriber[0],
+        "Unacknowledged": subscriber[1],
+        "Delivered": subscriber[2],
+        "Dropped": subscriber[3],
+    } for address, subscriber in self.__subscribers.items()]
 
   def protocol(self, sourcePoint):
     """Get the protocol of IFBroker.
@@ -190,8 +680,36 @@ class Manager:
     """
     return str(IFDefinition.PROTOCOL, encoding='UTF-8')
 
+  def listProtocols(self, sourcePoint):
+    """Get all the protocols supported by IFBroker.
+
+    Args:
+        sourcePoint (str): The source point of the invoker. Not used.
+
+    Returns:
+        list: The protocols, e.g. ``['IF1', 'IF2']``.
+    """
+    return [str(protocol, encoding='UTF-8') for protocol in IFDefinition.PROTOCOLS]
+
+  def enableBundling(self, sourcePoint, enabled=True):
+    """Ask the IFBroker to bundle the messages to the worker, or to stop, see ``Bundling``.
+
+    The worker is tracked as by a heartbeat, so that bundling stops when the worker is lost.
+
+    Args:
+        sourcePoint (str): The source point of the invoker.
+        enabled (bool): False to stop bundling.
+
+    Returns:
+        bool: True if the messages to the worker were bundled before.
+    """
+    self.heartbeat(sourcePoint)
+    return self.broker is not None and self.broker.setBundling(sourcePoint, enabled)
+
   def heartbeat(self, sourcePoint):
     """Sending heartbeat package to the IFBroker.
+
+    A source point that has sent a heartbeat, or any other message to the IFBroker itself, is unregistered if no message is received from it in ``IFDefinition.HEARTBEAT_LIVETIME`` seconds. Every message received from it counts as a heartbeat, thus workers only send heartbeats when they are idle.
     
     Args:
         sourcePoint (str): The source point of the invoker.
@@ -199,7 +717,10 @@ class Manager:
     Returns:
         bool: True if the worker is registered as a service.
     """
-    self.__activities[sourcePoint] = time.time()
+    currentTime = time.time()
+    if sourcePoint not in self.__activities:
+      heapq.heappush(self.__deadlines, (currentTime + IFDefinition.HEARTBEAT_LIVETIME, sourcePoint))
+    self.__activities[sourcePoint] = currentTime
     return sourcePoint in self.__workers
 
   def getAddressOfService(self, sourcePoint, serviceName):
@@ -214,33 +735,58 @@ class Manager:
     """
     if serviceName in self.__services:
       return self.__services.get(serviceName)[0]
+    peerAddress = self.getPeerOfService(sourcePoint, serviceName)
+    if peerAddress is not None:
+      return peerAddress + IFDefinition.PEER_SEPARATOR + self.__peerServices[peerAddress][0][serviceName]['Address']
     return None
 
-  def listServiceNames(self, sourcePoint):
-    """List all service names.
-    
+  def getServiceLimits(self, sourcePoint, serviceName):
+    """Get the concurrency limit and the queue size of a service, see ``registerAsService``.
+
     Args:
         sourcePoint (str): The source point of the invoker. Not used.
+        serviceName (str): The name of the service.
+
+    Returns:
+        tuple: ``(concurrency, queueSize)``. None if the service does not exist or is not limited.
     """
-    return list(self.__services.keys())
+    meta = self.__services.get(serviceName)
+    return None if meta is None else meta[7]
+
+  def getPeerOfService(self, sourcePoint, serviceName):
+    """Get the peer broker that a service is registered to, see ``IFBroker.peer``.
 
-  def listServiceMeta(self, sourcePoint):
-    """List all service with meta informations.
-    
     Args:
         sourcePoint (str): The source point of the invoker. Not used.
-        
+        serviceName (str): The name of the service.
+
     Returns:
-        list: A list of service meta informations.
+        bytes: The address of the peer, ``b'IFPeer:<peerID>'``. None if the service is not registered to any peer.
     """
-    results = []
-    currentTime = time.time()
+    for peerAddress, (services, _) in self.__peerServices.items():
+      if serviceName in services:
+        return peerAddress
+    return None
+
+  def exportServices(self, sourcePoint):
+    """Get the meta informations of the services registered to this broker, to be advertised to the peers.
+
+    Args:
+        sourcePoint (str): The source point of the invoker. Not used.
 
+    Returns:
+        list: A list of service meta informations, in the format of ``listServiceMeta``.
+    """
+    currentTime = time.time()
+    results = []
     for serviceName, meta in self.__services.items():
       results.append({
           "ServiceName": serviceName,
           "Address": meta[0],
+          "Replicas": meta[6],
           "Interfaces": meta[1],
+          "Codecs": meta[4],
+          "Protocols": meta[5],
           "OnTime": currentTime - meta[2],
           "Statistics": {
               "Received Message": meta[3][0],
@@ -248,11 +794,110 @@ class Manager:
               "Sent Message": meta[3][2],
               "Sent Bytes": meta[3][3],
           }})
+      if meta[7] is not None and self.broker is not None:
+        results[-1]["Queue"] = self.broker.queueStatus(serviceName)
+    return results
+
+  def updatePeerServices(self, sourcePoint, services):
+    """Update the copy of the services of a peer broker. It is invoked by the peer periodically.
+
+    Args:
+        sourcePoint (bytes): The address of the peer, ``b'IFPeer:<peerID>'``.
+        services (list): The services of the peer, as returned by ``exportServices``.
+    """
+    if not sourcePoint.startswith(IFDefinition.PEER_PREFIX) or IFDefinition.PEER_SEPARATOR in sourcePoint:
+      raise IFException('Only peer brokers can update the services of peers.')
+    self.__peerServices[sourcePoint] = [{meta['ServiceName']: meta for meta in services}, time.time()]
+
+  def getReplicasOfService(self, sourcePoint, serviceName):
+    """Get the addresses of the replicas of a service.
+
+    Args:
+        sourcePoint (str): The source point of the invoker. Not used.
+        serviceName (str): The name of the service.
+
+    Returns:
+        list: The addresses of the replicas. None if the service does not exist.
+    """
+    if serviceName in self.__services:
+      return self.__services.get(serviceName)[6]
+    return None
+
+  def getServiceCodecs(self, sourcePoint, serviceName):
+    """Get the codecs that a service accepts.
+
+    Args:
+        sourcePoint (str): The source point of the invoker. Not used.
+        serviceName (str): The name of the service.
+
+    Returns:
+        list: The names of the codecs. None if the service does not exist.
+    """
+    if serviceName in self.__services:
+      return self.__services.get(serviceName)[4]
+    peerAddress = self.getPeerOfService(sourcePoint, serviceName)
+    if peerAddress is not None:
+      return self.__peerServices[peerAddress][0][serviceName]['Codecs']
+    return None
+
+  def getServiceCapabilities(self, sourcePoint, serviceName):
+    """Get the codecs and the protocols that a service accepts.
+
+    A service is regarded to accept a protocol once it has sent any message of that protocol.
+
+    Args:
+        sourcePoint (str): The source point of the invoker. Not used.
+        serviceName (str): The name of the service.
+
+    Returns:
+        dict: ``{'Codecs': [...], 'Protocols': [...]}``. None if the service does not exist.
+    """
+    if serviceName in self.__services:
+      meta = self.__services.get(serviceName)
+      return {'Codecs': meta[4], 'Protocols': meta[5]}
+    peerAddress = self.getPeerOfService(sourcePoint, serviceName)
+    if peerAddress is not None:
+      meta = self.__peerServices[peerAddress][0][serviceName]
+      return {'Codecs': meta['Codecs'], 'Protocols': meta['Protocols']}
+    return None
+
+  def listServiceNames(self, sourcePoint):
+    """List all service names, including those registered to the peer brokers.
+    
+    Args:
+        sourcePoint (str): The source point of the invoker. Not used.
+    """
+    names = list(self.__services.keys())
+    for services, _ in self.__peerServices.values():
+      names += [name for name in services if name not in names]
+    return names
+
+  def listServiceMeta(self, sourcePoint):
+    """List all service with meta informations. The services registered to the peer brokers are listed with the key ``"Peer"``, the ID of the peer, and with their addresses as seen from this broker.
+    
+    Args:
+        sourcePoint (str): The source point of the invoker. Not used.
+        
+    Returns:
+        list: A list of service meta informations.
+    """
+    results = self.exportServices(sourcePoint)
+    currentTime = time.time()
+
+    for peerAddress, (services, _) in self.__peerServices.items():
+      for meta in services.values():
+        meta = dict(meta)
+        meta["Peer"] = str(peerAddress[len(IFDefinition.PEER_PREFIX):], encoding='UTF-8')
+        meta["Address"] = peerAddress + IFDefinition.PEER_SEPARATOR + meta["Address"]
+        meta["Replicas"] = [peerAddress + IFDefinition.PEER_SEPARATOR + replica for replica in meta["Replicas"]]
+        results.append(meta)
     for serviceName, meta in self.__nonservice.items():
       results.append({
           "ServiceName": '',
           "Address": serviceName,
           "Interfaces": '',
+          "Codecs": '',
+          "Protocols": meta[3],
           "OnTime": currentTime - meta[0],
           "Statistics": {
               "Received Message": meta[2][0],
@@ -271,21 +916,31 @@ class Manager:
     Args:
         sourcePoint (str): The source point of the invoker.
         isReceived (bool): If True, the message is received.  
-        message (list): The message.
+        message (list): The message. The protocol of a received message is recorded as accepted by the service. Frames from index 6 on, i.e., the invocation and the out-of-band buffers, are counted as bytes.
         
     Returns:
         list: A list of statistics information.
     """
     offset = 0 if isReceived else 2
+    if isReceived and sourcePoint in self.__activities:
+      self.__activities[sourcePoint] = time.time()
     if sourcePoint in self.__workers:
-      statItem = self.__services[self.__workers[sourcePoint]][3]
+      meta = self.__services[self.__workers[sourcePoint]]
+      statItem = meta[3]
+      protocols = meta[5]
     else:
       if not sourcePoint in self.__nonservice:
-        self.__nonservice[sourcePoint] = [time.time(), 0, [0] * 4]
-      self.__nonservice[sourcePoint][1] = time.time()
-      statItem = self.__nonservice[sourcePoint][2]
+        self.__nonservice[sourcePoint] = [time.time(), 0, [0] * 4, [str(IFDefinition.PROTOCOL, encoding='UTF-8')]]
+      meta = self.__nonservice[sourcePoint]
+      meta[1] = time.time()
+      statItem = meta[2]
+      protocols = meta[3]
+    if isReceived and message[1] in IFDefinition.PROTOCOLS:
+      protocol = str(message[1], encoding='UTF-8')
+      if protocol not in protocols:
+        protocols.append(protocol)
     statItem[offset] += 1
-    statItem[offset + 1] += len(message[-1])
+    statItem[offset + 1] += sum(len(frame) for frame in message[6:])
 
     if time.time() - self.__previousGCTime > 10:
       try:
@@ -318,42 +973,106 @@ class Manager:
   def __check(self):
     # try:
     currentTime = time.time()
-    tobeRemoved = []
-    for key, lastActiviteTime in self.__activities.items():
-      timeDiff = currentTime - lastActiviteTime
-      if timeDiff > IFDefinition.HEARTBEAT_LIVETIME:
-        tobeRemoved.append(key)
-        print('unreg in check', key)
-        self.unregister(key)
-    for tbr in tobeRemoved:
-      self.__activities.pop(tbr)
+    # Each tracked source point has one entry in the heap. Activities only update __activities, and an entry that is due with a later activity is pushed back with the new deadline.
+    while self.__deadlines and self.__deadlines[0][0] <= currentTime:
+      key = heapq.heappop(self.__deadlines)[1]
+      lastActiviteTime = self.__activities.get(key)
+      if lastActiviteTime is None:
+        continue
+      if currentTime - lastActiviteTime <= IFDefinition.HEARTBEAT_LIVETIME:
+        heapq.heappush(self.__deadlines, (lastActiviteTime + IFDefinition.HEARTBEAT_LIVETIME, key))
+        continue
+      self.__activities.pop(key)
+      logging.info(f'Worker [{key}] lost: no heartbeat in {IFDefinition.HEARTBEAT_LIVETIME} s.')
+      if self.broker is not None:
+        self.broker.releaseWorker(key, 'Worker lost before responding.')
+      self.unregister(key)
+    for peerAddress in [peerAddress for peerAddress, peer in self.__peerServices.items() if currentTime - peer[1] > IFDefinition.HEARTBEAT_LIVETIME]:
+      self.__peerServices.pop(peerAddress)
     # except BaseException as e:
     #     print('error in check', e)
     IOLoop.current().call_later(2, self.__check)
 
 
 class WebSocketZMQBridgeHandler(websocket.WebSocketHandler):
-  """The handler for WebSocket connection to the IFBroker."""
+  """The handler for WebSocket connection to the IFBroker.
+
+  Each WebSocket client is bridged to the IFBroker by a DEALER. Publications delivered to the client are acknowledged by the handler, see ``PubSub``, thus the clients should not acknowledge them.
+  The messages to a client are written with at most ``sendQueueSize`` of them unflushed. Beyond it, the DEALER is not read until the writes are flushed, thus a slow client does not grow the memory of the broker without limit.
+  """
 
   def __init__(self, *args, **kwargs):
     super().__init__(*args)
-    self.port = kwargs['port']
     self.currentMessage = []
-    self.__endpoint = f'tcp://localhost:{self.port}'
+    self.__endpoint = kwargs['endpoint']
+    self.__context = kwargs['context']
+    self.__coalesce = kwargs.get('coalesce', False)
+    self.__sendQueueSize = kwargs.get('sendQueueSize', IFBroker.WEBSOCKET_SEND_QUEUE_SIZE)
     self.__stream = None
+    self.__unacknowledged = 0
+    self.__unflushed = 0
+
+  @classmethod
+  def coalesceFrames(cls, frames):
+    """Pack the frames of a multipart message into one WebSocket message.
+
+    Args:
+        frames (list): The frames.
+
+    Returns:
+        bytes: The frames, each prefixed by its length as a 4-byte big-endian unsigned integer.
+    """
+    parts = []
+    for frame in frames:
+      parts.append(struct.pack('>I', len(frame)))
+      parts.append(frame)
+    return b''.join(parts)
+
+  @classmethod
+  def splitFrames(cls, data):
+    """Unpack the frames of a multipart message from a WebSocket message, see ``coalesceFrames``.
+
+    Args:
+        data (bytes): The WebSocket message.
+
+    Returns:
+        list: The frames.
+    """
+    frames = []
+    view = memoryview(data)
+    position = 0
+    while position < len(view):
+      if position + 4 > len(view):
+        raise IFException('Truncated WebSocket message.')
+      length = struct.unpack_from('>I', view, position)[0]
+      position += 4
+      if position + length > len(view):
+        raise IFException('Truncated WebSocket message.')
+      frames.append(view[position:position + length].tobytes())
+      position += length
+    return frames
 
   def open(self, *args, **kwargs):
     """Open the WebSocket connection."""
-    socket = zmq.Context().socket(zmq.DEALER)
+    socket = self.__context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.RCVHWM, self.__sendQueueSize)
+    socket.setsockopt(zmq.LINGER, 0)
     self.__stream = ZMQStream(socket, IOLoop.current())
     self.__stream.on_recv(self.__onReceive)
-    self.__stream.socket.setsockopt(zmq.LINGER, 0)
     self.__stream.connect(self.__endpoint)
 
   def on_close(self, *_args, **_kwargs):
-    self.__stream.close()
+    # The DEALER does not heartbeat, so its subscriptions are removed here.
+    self.__stream.socket.send_multipart(Message.newBrokerMessage(Invocation.newRequest('unregister', [], {})).getContent())
+    self.__stream.close(linger=100)
 
   def on_message(self, message):
+    if self.__coalesce:
+      try:
+        self.__stream.send_multipart(WebSocketZMQBridgeHandler.splitFrames(message))
+      except IFException as exception:
+        logging.debug(exception)
+      return
     hasMore = message[0]
     self.currentMessage.append(message[1:])
     if not hasMore:
@@ -362,9 +1081,37 @@ class WebSocketZMQBridgeHandler(websocket.WebSocketHandler):
       self.__stream.send_multipart(sendingMessage)
 
   def __onReceive(self, msg):
-    for frame in msg[:-1]:
-      self.write_message(b'\x01' + frame, binary=True)
-    self.write_message(b'\x00' + msg[-1], binary=True)
+    try:
+      if self.__coalesce:
+        flushed = self.write_message(WebSocketZMQBridgeHandler.coalesceFrames(msg), binary=True)
+      else:
+        for frame in msg[:-1]:
+          self.write_message(b'\x01' + frame, binary=True)
+        flushed = self.write_message(b'\x00' + msg[-1], binary=True)
+    except websocket.WebSocketClosedError:
+      return
+    self.__unflushed += 1
+    flushed.add_done_callback(self.__onFlushed)
+    if self.__unflushed >= self.__sendQueueSize:
+      self.__stream.stop_on_recv()
+    # Publications are acknowledged for the WebSocket client once they are flushed to it, so that a slow client reaches its high-water mark.
+    if Message(msg, outgoing=False).peekInvocation() == (Invocation.ValueTypeRequest, PubSub.FUNCTION):
+      flushed.add_done_callback(lambda _: self.__acknowledge())
+
+  def __onFlushed(self, _future):
+    self.__unflushed -= 1
+    if self.__unflushed == self.__sendQueueSize - 1 and not self.__stream.closed():
+      self.__stream.on_recv(self.__onReceive)
+
+  def __acknowledge(self):
+    self.__unacknowledged += 1
+    if self.__unacknowledged == 1:
+      IOLoop.current().add_callback(self.__sendAcknowledgement)
+
+  def __sendAcknowledgement(self):
+    count, self.__unacknowledged = self.__unacknowledged, 0
+    if self.__stream is not None and not self.__stream.closed():
+      self.__stream.send_multipart(Message.newBrokerMessage(Invocation.newRequest(PubSub.FUNCTION_ACK, [count], {})).getContent())
 
   def check_origin(self, origin):
     return True
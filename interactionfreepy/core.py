@@ -3,12 +3,32 @@ __license__ = "GNU General Public License v3"
 __author__ = 'Hwaipy'
 __email__ = 'hwaipy@gmail.com'
 
+import abc
 import threading
-import re
+import itertools
+import functools
 import types
+import inspect
+import asyncio
+import traceback
+import array
+import pickle
+import zlib
+import lzma
+import mmap
+import struct
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
 from threading import Thread
 from tornado.ioloop import IOLoop
+import zmq
 import msgpack
+try:
+  import numpy
+except ImportError:
+  numpy = None
 # import nest_asyncio
 
 
@@ -16,10 +36,15 @@ class IFDefinition:
   """Some definitions of Interaction Free."""
 
   PROTOCOL = b'IF1'
+  PROTOCOL_IF2 = b'IF2'
+  PROTOCOLS = [PROTOCOL, PROTOCOL_IF2]
   DISTRIBUTING_MODE_BROKER = b'Broker'
   DISTRIBUTING_MODE_DIRECT = b'Direct'
   DISTRIBUTING_MODE_SERVICE = b'Service'
+  DISTRIBUTING_MODE_PUBLISH = b'Publish'
   HEARTBEAT_LIVETIME = 10
+  PEER_PREFIX = b'IFPeer:'
+  PEER_SEPARATOR = b'|'
   DEFAULT_PORT_TCP = 1061
   DEFAULT_PORT_WEBSOCKET_SSL = 1062
   DEFAULT_PORT_WEBSOCKET = 1063
@@ -91,6 +116,11 @@ class IFLoop:
     """Join the thread of Interaction Free loop."""
     IFLoop.__loopingThread.join()
 
+  @classmethod
+  def isLoopThread(cls):
+    """Check whether the current thread is the thread of Interaction Free loop. False if the loop is not started."""
+    return IFLoop.__loopingThread is not None and threading.current_thread() is IFLoop.__loopingThread
+
   @classmethod
   def getInstance(cls):
     """Get the instance of Interaction Free loop."""
@@ -98,34 +128,71 @@ class IFLoop:
       IFLoop.__INSTANCE = IOLoop.current()
     return IFLoop.__INSTANCE
 
+  @classmethod
+  def send(cls, stream, frames, copy=True):
+    """Send a multipart message on a ZMQStream of the loop. Must be called on the loop thread.
+
+    ``ZMQStream.send_multipart`` only queues the message, and the stream sends it on a later iteration of the loop, which costs several callbacks per message. Here the message is sent on the socket right away, unless the stream still has queued messages or the socket would block. In both cases it is queued on the stream, so that the order of messages is kept.
+
+    The file descriptor of a ZeroMQ socket is edge-triggered, and the send may consume the edge of messages that arrived meanwhile. If messages are waiting, the stream is asked to receive them on the next iteration of the loop.
+
+    Args:
+      stream: The ZMQStream.
+      frames: The frames of the message.
+      copy: Whether to copy the frames.
+    """
+    if not stream.sending():
+      try:
+        stream.socket.send_multipart(frames, zmq.NOBLOCK, copy=copy)
+      except zmq.Again:
+        pass
+      else:
+        if stream.socket.get(zmq.EVENTS) & zmq.POLLIN:
+          IFLoop.getInstance().add_callback(stream.flush, zmq.POLLIN)
+        return
+    stream.send_multipart(frames, copy=copy)
+
 
 class Message:
   """A Message represent the content of Remote Procedure Call."""
 
-  MessageIDs = 0
-  __mutex__ = threading.Lock()
+  MessageIDs = itertools.count()
+  PEEK_SIZE = 1024
+  PLAIN_HEADERS_SIZE = 64
+  __PLAIN_HEADERS = {}
+  DISTRIBUTING_MODES = frozenset([IFDefinition.DISTRIBUTING_MODE_BROKER, IFDefinition.DISTRIBUTING_MODE_DIRECT, IFDefinition.DISTRIBUTING_MODE_SERVICE, IFDefinition.DISTRIBUTING_MODE_PUBLISH])
+  __slots__ = ('__content', '__outgoing', '__header', '__invocation')
 
   @classmethod
-  def newBrokerMessage(cls, invocation, serialization='Msgpack'):
+  def newBrokerMessage(cls, invocation, serialization='Msgpack', compression=None, compressionThreshold=None, protocol=None, timeout=None):
     """Create a new message to send to broker.
 
     Args:
       invocation: The Invocation object to send.
-      serialization: The serialization method of the message. Can be 'Msgpack', 'Plain' or 'Default'. 'Msgpack' is the default.
+      serialization: The serialization method of the message. Can be the name of a codec in ``CodecRegistry``. 'Msgpack' is the default.
+      compression: The compression algorithm of the invocation, 'zlib' or 'lzma'. None for no compression.
+      compressionThreshold: The invocation is compressed only if its serialized size is not smaller than this threshold. ``Compression.DEFAULT_THRESHOLD`` is used if None.
+      protocol: The protocol of the message, ``b'IF1'`` or ``b'IF2'``. ``IFDefinition.PROTOCOL`` is used if None.
+      timeout: The timeout of a request in seconds, carried in the serialization frame, see ``Expiry``. None for no timeout.
 
     Returns:
       A Message object.
     """
-    return Message.newMessage(IFDefinition.DISTRIBUTING_MODE_BROKER, b'', invocation, serialization)
+    return Message.newMessage(IFDefinition.DISTRIBUTING_MODE_BROKER, b'', invocation, serialization, compression, compressionThreshold, protocol, timeout)
 
   @classmethod
-  def newServiceMessage(cls, serviceName, invocation, serialization='Msgpack'):
+  def newServiceMessage(cls, serviceName, invocation, serialization='Msgpack', compression=None, compressionThreshold=None, protocol=None, timeout=None, idempotencyKey=None):
     """Create a new message to send to a service.
 
     Args:
       serviceName: The name of the service.
       invocation: The Invocation object to send.
-      serialization: The serialization method of the message. Can be 'Msgpack', 'Plain' or 'Default'. 'Msgpack' is the default.
+      serialization: The serialization method of the message. Can be the name of a codec in ``CodecRegistry``. 'Msgpack' is the default.
+      compression: The compression algorithm of the invocation, 'zlib' or 'lzma'. None for no compression.
+      compressionThreshold: The invocation is compressed only if its serialized size is not smaller than this threshold. ``Compression.DEFAULT_THRESHOLD`` is used if None.
+      protocol: The protocol of the message, ``b'IF1'`` or ``b'IF2'``. ``IFDefinition.PROTOCOL`` is used if None.
+      timeout: The timeout of a request in seconds, carried in the serialization frame, see ``Expiry``. None for no timeout.
+      idempotencyKey: The idempotency key of a request, carried in the serialization frame, see ``Idempotency``. None if the request is not idempotent.
 
     Returns:
       A Message object.
@@ -134,16 +201,20 @@ class Message:
       IFException: If the service name is not a valid service name.
     """
 
-    return Message.newMessage(IFDefinition.DISTRIBUTING_MODE_SERVICE, serviceName, invocation, serialization)
+    return Message.newMessage(IFDefinition.DISTRIBUTING_MODE_SERVICE, serviceName, invocation, serialization, compression, compressionThreshold, protocol, timeout, idempotencyKey)
 
   @classmethod
-  def newDirectMessage(cls, address, invocation, serialization='Msgpack'):
+  def newDirectMessage(cls, address, invocation, serialization='Msgpack', compression=None, compressionThreshold=None, protocol=None, timeout=None):
     """Create a new message to send to a direct address.
 
     Args:
       address: The address of the target.
       invocation: The Invocation object to send.
-      serialization: The serialization method of the message. Can be 'Msgpack', 'Plain' or 'Default'. 'Msgpack' is the default.
+      serialization: The serialization method of the message. Can be the name of a codec in ``CodecRegistry``. 'Msgpack' is the default.
+      compression: The compression algorithm of the invocation, 'zlib' or 'lzma'. None for no compression.
+      compressionThreshold: The invocation is compressed only if its serialized size is not smaller than this threshold. ``Compression.DEFAULT_THRESHOLD`` is used if None.
+      protocol: The protocol of the message, ``b'IF1'`` or ``b'IF2'``. ``IFDefinition.PROTOCOL`` is used if None.
+      timeout: The timeout of a request in seconds, carried in the serialization frame, see ``Expiry``. None for no timeout.
 
     Returns:
       A Message object.
@@ -152,72 +223,203 @@ class Message:
       IFException: If the address is not a valid address.
     """
 
-    return Message.newMessage(IFDefinition.DISTRIBUTING_MODE_DIRECT, address, invocation, serialization)
+    return Message.newMessage(IFDefinition.DISTRIBUTING_MODE_DIRECT, address, invocation, serialization, compression, compressionThreshold, protocol, timeout)
+
+  @classmethod
+  def newPublishMessage(cls, topic, data, serialization='Msgpack', compression=None, compressionThreshold=None):
+    """Create a new message to publish to a topic, see ``PubSub``.
+
+    Args:
+      topic: The topic.
+      data: The data to publish.
+      serialization: The serialization method of the message. Can be the name of a codec in ``CodecRegistry``. 'Msgpack' is the default.
+      compression: The compression algorithm of the invocation, 'zlib' or 'lzma'. None for no compression.
+      compressionThreshold: The invocation is compressed only if its serialized size is not smaller than this threshold. ``Compression.DEFAULT_THRESHOLD`` is used if None.
+
+    Returns:
+      A Message object.
+    """
+    return Message.newMessage(IFDefinition.DISTRIBUTING_MODE_PUBLISH, topic, Invocation.newRequest(PubSub.FUNCTION, [topic, data], {}), serialization, compression, compressionThreshold)
 
   @classmethod
-  def newMessage(cls, distributingMode, distributingAddress, invocation, serialization='Msgpack'):
+  def newMessage(cls, distributingMode, distributingAddress, invocation, serialization='Msgpack', compression=None, compressionThreshold=None, protocol=None, timeout=None, idempotencyKey=None):
     """Create a new message object.
 
     Args:
-      distributingMode: The distributing mode of the message. Can be 'Broker', 'Direct' or 'Service'.
+      distributingMode: The distributing mode of the message. Can be 'Broker', 'Direct', 'Service' or 'Publish'.
       distributingAddress: The address of the target. If the distributing mode is 'Broker', this should be empty. If the distributing mode is 'Direct', this should be the address of the target. If the distributing mode is 'Service', this should be the name of the service.
       invocation: The Invocation object to send.
-      serialization: The serialization method of the message. Can be 'Msgpack', 'Plain' or 'Default'. 'Msgpack' is the default.
+      serialization: The serialization method of the message. Can be the name of a codec in ``CodecRegistry``. 'Msgpack' is the default.
+      compression: The compression algorithm of the invocation, 'zlib' or 'lzma'. None for no compression.
+      compressionThreshold: The invocation is compressed only if its serialized size is not smaller than this threshold. ``Compression.DEFAULT_THRESHOLD`` is used if None.
+      protocol: The protocol of the message, ``b'IF1'`` or ``b'IF2'``. ``IFDefinition.PROTOCOL`` is used if None.
+      timeout: The timeout of a request in seconds, carried in the serialization frame, see ``Expiry``. None for no timeout.
+      idempotencyKey: The idempotency key of a request, carried in the serialization frame, see ``Idempotency``. None if the request is not idempotent.
 
     Returns:
       A Message object.
     """
-    if distributingMode not in [IFDefinition.DISTRIBUTING_MODE_BROKER, IFDefinition.DISTRIBUTING_MODE_DIRECT, IFDefinition.DISTRIBUTING_MODE_SERVICE]:
+    # One-off messages, e.g. the responses of services, are encoded directly. The invokers reuse the shared frames by ``MessageTemplate``.
+    if distributingMode not in Message.DISTRIBUTING_MODES:
+      raise IFException(f'Bad DistributingMode: {distributingMode}')
+    if distributingMode == IFDefinition.DISTRIBUTING_MODE_BROKER:
+      distributingAddress = b''
+    if protocol is None:
+      protocol = IFDefinition.PROTOCOL
+    buffers = []
+    header, content = Compression.compress(serialization, invocation.serialize(serialization, buffers, protocol), compression, compressionThreshold)
+    if timeout is not None:
+      header = Expiry.attach(header, timeout)
+    if idempotencyKey is not None:
+      header = Idempotency.attach(header, idempotencyKey)
+    msg = [b'', protocol, b'%d' % next(Message.MessageIDs), distributingMode, Message.__messagePartToBytes(distributingAddress), Message.__messagePartToBytes(header), content]
+    if buffers:
+      msg += buffers
+    return Message(msg, outgoing=True)
+
+  @classmethod
+  def newTemplate(cls, distributingMode, distributingAddress, serialization='Msgpack', compression=None, compressionThreshold=None, protocol=None, timeout=None):
+    """Create a template for the messages to a target, see ``MessageTemplate``. The arguments are the same as ``newMessage``, except for the invocation and the idempotency key, which are given for each message.
+
+    Returns:
+      A MessageTemplate object.
+    """
+    if distributingMode not in Message.DISTRIBUTING_MODES:
       raise IFException(f'Bad DistributingMode: {distributingMode}')
     if distributingMode == IFDefinition.DISTRIBUTING_MODE_BROKER:
       distributingAddress = b''
     # if serialization == 'Plain' or serialization == 'Default' or serialization == 'ZMQ': serialization = b''
-    msg = [b'', IFDefinition.PROTOCOL, str(Message.__getAndIncrementID()), distributingMode, distributingAddress, serialization, invocation.serialize(serialization)]
-    return Message([Message.__messagePartToBytes(m) for m in msg])
+    if protocol is None:
+      protocol = IFDefinition.PROTOCOL
+    header = Message.__messagePartToBytes(serialization if timeout is None else Expiry.attach(serialization, timeout))
+    return MessageTemplate(protocol, distributingMode, Message.__messagePartToBytes(distributingAddress), serialization, header, compression, compressionThreshold, timeout)
 
   @classmethod
-  def newFromBrokerMessage(cls, fromAddress, invocation, serialization='Msgpack'):
+  def newFromBrokerMessage(cls, fromAddress, invocation, serialization='Msgpack', protocol=None):
     """Create a new message that is from broker, i.e., from another worker."""
-    msg = [b'', IFDefinition.PROTOCOL, str(Message.__getAndIncrementID()), fromAddress, serialization, invocation.serialize(serialization)]
-    return [Message.__messagePartToBytes(m) for m in msg]
+    if protocol is None:
+      protocol = IFDefinition.PROTOCOL
+    buffers = []
+    msg = [b'', protocol, b'%d' % next(Message.MessageIDs), fromAddress, serialization, invocation.serialize(serialization, buffers, protocol)]
+    return [Message.__messagePartToBytes(m) for m in msg] + buffers
 
   @classmethod
-  def __getAndIncrementID(cls):
-    Message.__mutex__.acquire()
-    mid = Message.MessageIDs
-    Message.MessageIDs += 1
-    Message.__mutex__.release()
-    return mid
+  def toIDKey(cls, messageID):
+    """Normalize a message ID, or the ResponseID of a response, to the key for matching responses with requests.
+
+    IDs are generated from ``itertools.count``, whose ``next`` is atomic, so that no lock is taken for each message. They are sent as decimal digits, thus the str IDs of IF1 peers and the int ResponseIDs of IF2 peers are both matched by int keys.
+
+    Args:
+      messageID: The message ID as int, str or bytes.
+
+    Returns:
+      The ID as int if it is an integer, or the ID unchanged otherwise.
+    """
+    if type(messageID) is int:
+      return messageID
+    try:
+      return int(messageID)
+    except (TypeError, ValueError):
+      return messageID
 
   @classmethod
   def __messagePartToBytes(cls, part):
     if isinstance(part, bytes):
       return part
     if isinstance(part, str):
-      return bytes(part, 'UTF-8')
+      return part.encode('UTF-8')
     if part is None:
       return b''
     raise IFException(f'Data type not transportable: {type(part)}')
 
-  def __init__(self, msgc):
+  def __init__(self, msgc, outgoing=None):
+    """Wrap the frames of a message.
+
+    The frames are parsed lazily: the message ID, the addresses and the serialization frame are only decoded when they are accessed, so that the Broker forwards a message by peeking at its distributing mode only.
+
+    Args:
+      msgc: The frames of the message.
+      outgoing: True if the frames are of an outgoing message (sent to the broker), False if they are of a message sent from the broker. If None, it is inferred from the number of frames, which is only reliable for messages without out-of-band buffers.
+    """
     self.__content = msgc
-    self.__protocol = msgc[1]
-    self.messageID = msgc[2].decode('UTF-8')
-    if self.isOutgoingMessage():
-      self.__distributingMode = msgc[3]
-      self.distributingAddress = msgc[4]
-      self.serialization = msgc[5]
-      self.__invocationContent = msgc[6]
-    else:
-      self.__distributingMode = b'Received'
-      self.fromAddress = msgc[3]
-      self.serialization = msgc[4]
-      self.__invocationContent = msgc[5]
+    self.__outgoing = len(msgc) == 7 if outgoing is None else outgoing
+    self.__header = None
     self.__invocation = None
 
+  @property
+  def messageID(self):
+    """The ID of the message as str."""
+    return self.__content[2].decode('UTF-8')
+
+  @property
+  def idKey(self):
+    """The ID of the message as the key for matching responses, see ``Message.toIDKey``."""
+    return Message.toIDKey(self.__content[2])
+
+  @property
+  def replyID(self):
+    """The ResponseID for replying the message: the int ID in IF2 and the str ID in IF1."""
+    if self.__content[1] == IFDefinition.PROTOCOL_IF2:
+      return Message.toIDKey(self.__content[2])
+    return self.messageID
+
+  @property
+  def distributingAddress(self):
+    """The address of the target of an outgoing message. None for a message sent from the broker."""
+    return self.__content[4] if self.__outgoing else None
+
+  @property
+  def fromAddress(self):
+    """The address of the source of a message sent from the broker. None for an outgoing message."""
+    return None if self.__outgoing else self.__content[3]
+
+  @property
+  def serialization(self):
+    """The serialization method of the message in bytes."""
+    return self.__parseHeader()[0]
+
+  @property
+  def compression(self):
+    """The compression algorithm of the message in bytes. None if not compressed."""
+    return self.__parseHeader()[1]
+
+  @property
+  def timeout(self):
+    """The timeout of the request in seconds, see ``Expiry``. None if not given."""
+    return self.__parseHeader()[2]
+
+  @property
+  def idempotencyKey(self):
+    """The idempotency key of the request in bytes, see ``Idempotency``. None if not given."""
+    return self.__parseHeader()[3]
+
+  def __parseHeader(self):
+    parsed = self.__header
+    if parsed is None:
+      frame = self.__content[5 if self.__outgoing else 4]
+      # Serialization frames without compression, timeout or key, e.g. ``b'Msgpack'``, are parsed once.
+      plain = type(frame) is bytes
+      parsed = Message.__PLAIN_HEADERS.get(frame) if plain else None
+      if parsed is None:
+        header, key = Idempotency.parseHeader(frame)
+        header, timeout = Expiry.parseHeader(header)
+        parsed = Compression.parseHeader(header) + (timeout, key)
+        if plain and parsed[1:] == (None, None, None) and len(Message.__PLAIN_HEADERS) < Message.PLAIN_HEADERS_SIZE:
+          Message.__PLAIN_HEADERS[frame] = parsed
+      self.__header = parsed
+    return parsed
+
   def isProtocolValid(self):
     """Check if the protocol of the message is valid."""
-    return self.__protocol == IFDefinition.PROTOCOL
+    return self.__content[1] in IFDefinition.PROTOCOLS
+
+  def getProtocol(self):
+    """Get the protocol of the message.
+
+    Returns:
+      The protocol frame, e.g. ``b'IF1'``.
+    """
+    return self.__content[1]
 
   def isOutgoingMessage(self):
     """Check if the message is an outgoing message.
@@ -225,7 +427,7 @@ class Message:
     Returns:
       True if the message is an outgoing message, False otherwise.
     """
-    return len(self.__content) == 7
+    return self.__outgoing
 
   def isBrokerMessage(self):
     """Check if the message is a broker message.
@@ -233,7 +435,7 @@ class Message:
     Returns:
       True if the message is a broker message, False otherwise.
     """
-    return self.isOutgoingMessage() and self.__distributingMode == IFDefinition.DISTRIBUTING_MODE_BROKER
+    return self.__outgoing and self.__content[3] == IFDefinition.DISTRIBUTING_MODE_BROKER
 
   def isServiceMessage(self):
     """Check if the message is a service message.
@@ -241,7 +443,7 @@ class Message:
     Returns:
       True if the message is a service message, False otherwise.
     """
-    return self.isOutgoingMessage() and self.__distributingMode == IFDefinition.DISTRIBUTING_MODE_SERVICE
+    return self.__outgoing and self.__content[3] == IFDefinition.DISTRIBUTING_MODE_SERVICE
 
   def isDirectMessage(self):
     """Check if the message is a direct message.
@@ -249,22 +451,81 @@ class Message:
     Returns:
       True if the message is a direct message, False otherwise.
     """
-    return self.isOutgoingMessage() and self.__distributingMode == IFDefinition.DISTRIBUTING_MODE_DIRECT
+    return self.__outgoing and self.__content[3] == IFDefinition.DISTRIBUTING_MODE_DIRECT
+
+  def getDistributingMode(self):
+    """Get the distributing mode of an outgoing message.
+
+    Returns:
+      The distributing mode frame, e.g. ``b'Service'``. None for a message sent from the broker.
+    """
+    return self.__content[3] if self.__outgoing else None
 
   def getInvocation(self, decoded=True):
     """Get the invocation of the message.
     
     Args:
-      decoded: If True, the invocation object will be deserialized as an Invocation object. If False, the raw content will be returned.
+      decoded: If True, the invocation object will be deserialized as an Invocation object. If False, the raw content will be returned, which is still compressed if the message is compressed.
       
     Returns:
       The invocation object or the raw content of the invocation.
     """
+    content = self.__content
+    body = content[6 if self.__outgoing else 5]
     if not decoded:
-      return self.__invocationContent
-    if not self.__invocation:
-      self.__invocation = Invocation.deserialize(self.__invocationContent, self.serialization)
-    return self.__invocation
+      return body
+    invocation = self.__invocation
+    if invocation is None:
+      serialization, compression = self.__parseHeader()[:2]
+      if compression:
+        body = Compression.decompress(body, compression)
+      invocation = self.__invocation = Invocation.deserialize(body, serialization, buffers=content[7 if self.__outgoing else 6:], protocol=content[1])
+    return invocation
+
+  def peekInvocation(self):
+    """Peek at the type of the invocation, and at its function or ResponseID, without deserializing the arguments or the result.
+
+    Only the first ``Message.PEEK_SIZE`` bytes of the body are read, so that the Broker can look into a message it forwards at a constant cost.
+
+    Returns:
+      ``(Type, Function)`` for a request or ``(Type, ResponseID)`` for a response. None if the invocation can not be peeked, i.e., it is compressed, serialized by a codec other than the Msgpack ones, or the keys are not found in the bytes read.
+    """
+    try:
+      serialization, compression = self.__parseHeader()[:2]
+      if compression or not isinstance(CodecRegistry.get(serialization), MsgpackCodec):
+        return None
+      unpacker = msgpack.Unpacker(raw=False)
+      unpacker.feed(memoryview(self.getInvocation(decoded=False))[:Message.PEEK_SIZE])
+      if self.__content[1] == IFDefinition.PROTOCOL_IF2:
+        unpacker.read_array_header()
+        tag = unpacker.unpack()
+        if tag == Invocation.TagRequest:
+          return Invocation.ValueTypeRequest, unpacker.unpack()
+        if tag in (Invocation.TagResponse, Invocation.TagError):
+          return Invocation.ValueTypeResponse, unpacker.unpack()
+        return None
+      peeked = {}
+      for _ in range(unpacker.read_map_header()):
+        key = unpacker.unpack()
+        if key in (Invocation.KeyType, Invocation.KeyFunciton, Invocation.KeyRespopnseID):
+          peeked[key] = unpacker.unpack()
+        else:
+          unpacker.skip()
+        invocationType = peeked.get(Invocation.KeyType)
+        key = Invocation.KeyFunciton if invocationType == Invocation.ValueTypeRequest else Invocation.KeyRespopnseID
+        if invocationType is not None and key in peeked:
+          return invocationType, peeked[key]
+    except (IFException, msgpack.OutOfData, ValueError):
+      pass
+    return None
+
+  def getBuffers(self):
+    """Get the out-of-band buffer frames that follow the invocation frame.
+
+    Returns:
+      A list of the buffer frames. Empty if the message carries no out-of-band buffer.
+    """
+    return self.__content[7 if self.__outgoing else 6:]
 
   def getContent(self):
     """Get the raw content of the message.
@@ -284,6 +545,49 @@ class Message:
     return f'Receive from [{"Broker" if self.fromAddress == b"" else self.fromAddress}]: [id={self.messageID}] {self.getInvocation()}'
 
 
+class MessageTemplate:
+  """The frames shared by the messages to one target, encoded once. Only the message ID and the invocation are encoded for each message.
+
+  The template is created by ``Message.newTemplate`` and is immutable, so that it can be cached and shared by threads.
+  """
+
+  __slots__ = ('protocol', 'distributingMode', 'distributingAddress', 'serialization', 'compression', 'compressionThreshold', 'timeout', '__header')
+
+  def __init__(self, protocol, distributingMode, distributingAddress, serialization, header, compression, compressionThreshold, timeout):
+    self.protocol = protocol
+    self.distributingMode = distributingMode
+    self.distributingAddress = distributingAddress
+    self.serialization = serialization
+    self.compression = compression
+    self.compressionThreshold = compressionThreshold
+    self.timeout = timeout
+    self.__header = header
+
+  def newMessage(self, invocation, idempotencyKey=None, compression=None):
+    """Create a new message of an invocation.
+
+    Args:
+      invocation: The Invocation object to send.
+      idempotencyKey: The idempotency key of the request, see ``Idempotency``. None if the request is not idempotent.
+      compression: The compression algorithm of this message, see ``Compression``. None to follow the template, False for no compression.
+
+    Returns:
+      A Message object.
+    """
+    buffers = []
+    header, content = Compression.compress(self.serialization, invocation.serialize(self.serialization, buffers, self.protocol), self.compression if compression is None else compression, self.compressionThreshold)
+    if header is self.serialization:
+      header = self.__header
+    else:
+      header = header if self.timeout is None else Expiry.attach(header, self.timeout)
+    if idempotencyKey is not None:
+      header = Idempotency.attach(header, idempotencyKey)
+    msg = [b'', self.protocol, b'%d' % next(Message.MessageIDs), self.distributingMode, self.distributingAddress, header, content]
+    if buffers:
+      msg += buffers
+    return Message(msg, outgoing=True)
+
+
 class Invocation:
   """The Invocation class represents an invocation of a function."""
 
@@ -295,13 +599,34 @@ class Invocation:
   KeyResult = 'Result'
   KeyError = 'Error'
   KeyWarning = 'Warning'
+  KeyStream = 'Stream'
+  KeyStreamEnd = 'StreamEnd'
   ValueTypeRequest = 'Request'
   ValueTypeResponse = 'Response'
+  FunctionBatch = 'IFBatch'
   Preserved = [KeyType, KeyFunciton, KeyArguments, KeyKeyworkArguments, KeyRespopnseID, KeyResult, KeyError,
-               KeyWarning]
+               KeyWarning, KeyStream, KeyStreamEnd]
+  TagRequest = 0
+  TagResponse = 1
+  TagError = 2
+  TagOther = 3
+  PositionalKeys = {
+      TagRequest: [KeyFunciton, KeyArguments, KeyKeyworkArguments],
+      TagResponse: [KeyRespopnseID, KeyResult, KeyWarning],
+      TagError: [KeyRespopnseID, KeyError, KeyWarning],
+  }
+  EmptyTypes = (list, dict, tuple)
+  PositionalKeySets = {
+      TagRequest: frozenset([KeyType, KeyFunciton, KeyArguments, KeyKeyworkArguments]),
+      TagResponse: frozenset([KeyType, KeyRespopnseID, KeyResult, KeyWarning]),
+      TagError: frozenset([KeyType, KeyRespopnseID, KeyError, KeyWarning]),
+  }
+  __slots__ = ('__content', '__type')
 
   def __init__(self, content=None):
     self.__content = content if content is not None else {}
+    # The type is read once, as every getter checks it.
+    self.__type = self.__content.get(Invocation.KeyType) if isinstance(self.__content, dict) else None
 
   def get(self, key, nilValid=True, nonKeyValid=True):
     """Get the value of the key.
@@ -331,7 +656,7 @@ class Invocation:
     Returns:
       True if the invocation is a request.
     """
-    return self.get(Invocation.KeyType) == Invocation.ValueTypeRequest
+    return self.__type == Invocation.ValueTypeRequest
 
   def isResponse(self):
     """Check if the invocation is a response.
@@ -339,7 +664,7 @@ class Invocation:
     Returns:
       True if the invocation is a response.
     """
-    return self.get(Invocation.KeyType) == Invocation.ValueTypeResponse
+    return self.__type == Invocation.ValueTypeResponse
 
   def isError(self):
     """Check if the invocation is an error.
@@ -357,6 +682,33 @@ class Invocation:
     """
     return self.isResponse() and Invocation.KeyWarning in self.__content
 
+  def isStream(self):
+    """Check if the invocation is a response of a stream, i.e., an item or the end of a stream.
+
+    Returns:
+      True if the invocation is a response of a stream.
+    """
+    content = self.__content
+    return self.isResponse() and (Invocation.KeyStream in content or Invocation.KeyStreamEnd in content)
+
+  def getStreamIndex(self):
+    """Get the index of a stream item. Only valid for response.
+
+    Returns:
+      The index of the item in the stream. None if the invocation is not a stream item.
+    """
+    if self.isResponse():
+      return self.get(Invocation.KeyStream)
+    return None
+
+  def isStreamEnd(self):
+    """Check if the invocation is the end of a stream.
+
+    Returns:
+      True if the invocation is the end of a stream.
+    """
+    return self.isResponse() and Invocation.KeyStreamEnd in self.__content
+
   def getResponseID(self):
     """Get the response ID of the invocation. Only valid for response.
     
@@ -403,8 +755,8 @@ class Invocation:
     Returns:
       The function name of the invocation. If the invocation is not a request, None will be returned.
     """
-    if self.isRequest():
-      return self.get(Invocation.KeyFunciton)
+    if self.__type == Invocation.ValueTypeRequest:
+      return self.__content.get(Invocation.KeyFunciton)
     return None
 
   def getArguments(self):
@@ -413,8 +765,8 @@ class Invocation:
     Returns:
       The list of arguments of the invocation. If the invocation is not a request, None will be returned. If the invocation has no arguments, an empty list will be returned.
     """
-    if self.isRequest():
-      args = self.get(Invocation.KeyArguments)
+    if self.__type == Invocation.ValueTypeRequest:
+      args = self.__content.get(Invocation.KeyArguments)
       if args:
         return args if isinstance(args, list) else [args]
       return []
@@ -426,8 +778,8 @@ class Invocation:
     Returns:
       The dictionary of keyword arguments of the invocation. If the invocation is not a request, None will be returned. If the invocation has no keyword arguments, an empty dictionary will be returned.
     """
-    if self.isRequest():
-      kwargs = self.get(Invocation.KeyKeyworkArguments)
+    if self.__type == Invocation.ValueTypeRequest:
+      kwargs = self.__content.get(Invocation.KeyKeyworkArguments)
       return kwargs if kwargs else {}
     return None
 
@@ -484,81 +836,1182 @@ class Invocation:
         Invocation.KeyError: description
     })
 
-  def serialize(self, serialization='Msgpack'):
+  @classmethod
+  def newStreamItem(cls, messageID, index, item):
+    """Create a new response invocation that carries an item of the stream produced by the request message with specified messageID.
+
+    Args:
+      messageID: The ID of the request.
+      index: The index of the item in the stream, starting from 0.
+      item: The item.
+
+    Returns:
+      The new response invocation.
+    """
+    return Invocation({
+        Invocation.KeyType: Invocation.ValueTypeResponse,
+        Invocation.KeyRespopnseID: messageID,
+        Invocation.KeyResult: item,
+        Invocation.KeyStream: index
+    })
+
+  @classmethod
+  def newStreamEnd(cls, messageID, count):
+    """Create a new response invocation that ends the stream produced by the request message with specified messageID.
+
+    Args:
+      messageID: The ID of the request.
+      count: The number of items in the stream.
+
+    Returns:
+      The new response invocation.
+    """
+    return Invocation({
+        Invocation.KeyType: Invocation.ValueTypeResponse,
+        Invocation.KeyRespopnseID: messageID,
+        Invocation.KeyResult: None,
+        Invocation.KeyStreamEnd: count
+    })
+
+  @classmethod
+  def newBatchRequest(cls, calls, concurrent=False):
+    """Create a new request invocation that packs several calls to the same target.
+
+    The calls are performed in order, or concurrently if ``concurrent`` is True. The result of the batch is a list of ``[result, error]`` pairs, one for each call, in which ``error`` is None if the call succeeded. A call to a function that returns a stream fails.
+
+    Args:
+      calls: The list of calls, each as ``(functionName, args, kwargs)``.
+      concurrent: If True, the coroutine functions among the calls are awaited concurrently.
+
+    Returns:
+      The new request invocation.
+    """
+    return Invocation.newRequest(Invocation.FunctionBatch, [[[name, list(args), kwargs] for name, args, kwargs in calls]], {'Concurrent': concurrent} if concurrent else {})
+
+  def serialize(self, serialization='Msgpack', buffers=None, protocol=None):
     """Serialize the invocation.
     
     Args:
-      serialization: The serialization method. Currently only 'Msgpack' is supported.
+      serialization: The serialization method, i.e., the name of a codec in ``CodecRegistry``. 'Msgpack' is the default.
+      buffers: A list to collect out-of-band buffers. If given, large ``numpy.ndarray``, ``array.array`` and ``memoryview`` objects are appended to it instead of being copied into the serialized data. If None, they are embedded.
+      protocol: The protocol of the message. With ``b'IF2'``, the invocation is packed as a positional array. Otherwise, it is packed as a map.
     
     Returns:
       The serialized binary data.
     """
-    if serialization == 'Msgpack':
-      return msgpack.packb(self.__content, use_bin_type=True)
-    raise IFException(f'Bad serialization: {serialization}')
+    content = Invocation.toPositional(self.__content) if protocol == IFDefinition.PROTOCOL_IF2 else self.__content
+    return CodecRegistry.get(serialization).encode(content, buffers)
 
   def __str__(self):
     content = ', '.join([f'{k}: {self.__content[k]}' for k in self.__content.keys()])
     return f"Invocation [{content}]"
 
   @classmethod
-  def deserialize(cls, data, serialization='Msgpack', contentOnly=False):
+  def deserialize(cls, data, serialization='Msgpack', contentOnly=False, buffers=None, protocol=None):
     """Deserialize the invocation.
     
     Args:
       data: The serialized binary data.
-      serialization: The serialization method. Currently only 'Msgpack' is supported.
+      serialization: The serialization method, i.e., the name of a codec in ``CodecRegistry``. 'Msgpack' is the default.
       contentOnly: If True, only the content will be returned. Otherwise, an Invocation object will be returned.
+      buffers: The out-of-band buffers referred by the serialized data. Arrays are rebuilt on these buffers without copying.
+      protocol: The protocol of the message. With ``b'IF2'``, the invocation is expected to be a positional array.
       
     Returns:
       The content of the invocation. If contentOnly is False, an Invocation object will be returned.
     """
-    if isinstance(serialization, bytes):
-      serialization = str(serialization, encoding='UTF-8')
-    if serialization == 'Msgpack':
-      unpacker = msgpack.Unpacker(raw=False)
-      unpacker.feed(data)
-      content = unpacker.unpack()
-      return content if contentOnly else Invocation(content)
-    raise IFException(f'Bad serialization: {serialization}')
+    content = CodecRegistry.get(serialization).decode(data, buffers)
+    if protocol == IFDefinition.PROTOCOL_IF2:
+      content = Invocation.fromPositional(content)
+    return content if contentOnly else Invocation(content)
+
+  @classmethod
+  def toPositional(cls, content):
+    """Convert the content of an invocation to the positional array of IF2.
 
-  async def perform(self, target, sourcePoint=None):
+    A request is packed as ``[0, Function, Arguments, KeyworkArguments, extra]``, a response as ``[1, ResponseID, Result, Warning, extra]``, and an error as ``[2, ResponseID, Error, Warning, extra]``, where ``extra`` is a map of the other keys. Trailing empty elements after the first two (for requests) or three (for responses) are omitted. Content of other types is packed as ``[3, content]``.
+
+    Args:
+      content: The content of an invocation as a map.
+
+    Returns:
+      The positional array.
+    """
+    invocationType = content.get(Invocation.KeyType)
+    if invocationType == Invocation.ValueTypeRequest:
+      tag = Invocation.TagRequest
+    elif invocationType == Invocation.ValueTypeResponse:
+      tag = Invocation.TagError if Invocation.KeyError in content else Invocation.TagResponse
+    else:
+      return [Invocation.TagOther, content]
+    keys = Invocation.PositionalKeys[tag]
+    positional = [tag, content.get(keys[0]), content.get(keys[1]), content.get(keys[2])]
+    keySet = Invocation.PositionalKeySets[tag]
+    if not keySet.issuperset(content):
+      positional.append({key: value for key, value in content.items() if key not in keySet})
+    minimal = 2 if tag == Invocation.TagRequest else 3
+    while len(positional) > minimal:
+      last = positional[-1]
+      if last is not None and (type(last) not in Invocation.EmptyTypes or last):
+        break
+      positional.pop()
+    return positional
+
+  @classmethod
+  def fromPositional(cls, positional):
+    """Convert the positional array of IF2 back to the content of an invocation.
+
+    Args:
+      positional: The positional array.
+
+    Returns:
+      The content of the invocation as a map.
+    """
+    tag = positional[0]
+    keys = Invocation.PositionalKeys.get(tag)
+    if keys is None:
+      if tag == Invocation.TagOther:
+        return positional[1]
+      raise IFException(f'Bad invocation tag: {tag}')
+    # The Function of a request, and the ResponseID and the Result or Error of a response, are always present.
+    if tag == Invocation.TagRequest:
+      content = {Invocation.KeyType: Invocation.ValueTypeRequest, keys[0]: positional[1]}
+      start = 2
+    else:
+      content = {Invocation.KeyType: Invocation.ValueTypeResponse, keys[0]: positional[1], keys[1]: positional[2]}
+      start = 3
+    count = len(positional)
+    for index in range(start, min(count, 4)):
+      value = positional[index]
+      if value is not None:
+        content[keys[index - 1]] = value
+    if count > 4:
+      content.update(positional[4])
+    return content
+
+  async def perform(self, target, sourcePoint=None, performer=None):
     """Perform the invocation on the target object. The target object must have a function with the same name as the invocation function. The arguments of the invocation will be passed to the function.
     
     Args:
-      target: The target object.
+      target: The target object, or a ``Dispatcher`` of it to reuse the cached methods.
       sourcePoint: The source point of the invocation. Only available for Broker.
+      performer: For a batch, a coroutine function that performs each call given its request invocation, e.g., in the executor that the method is marked to run in. The call is performed on the target by default.
       
     Returns:
       The result of the invocation."""
+    if self.getFunction() == Invocation.FunctionBatch:
+      return await self.__performBatch(target, sourcePoint, performer)
+    result = (target if isinstance(target, Dispatcher) else Dispatcher(target)).call(self, sourcePoint)
+    if isinstance(result, types.CoroutineType):
+      return await result
+    return result
+
+  async def __performBatch(self, target, sourcePoint, performer):
+    calls = self.getArguments()[0] if self.getArguments() else []
+
+    async def performCall(call):
+      try:
+        invocation = Invocation.newRequest(*call)
+        result = await (invocation.perform(target, sourcePoint) if performer is None else performer(invocation))
+        if inspect.isgenerator(result) or inspect.isasyncgen(result):
+          # The items of a stream can not be packed in the result of a batch.
+          if inspect.isasyncgen(result):
+            await result.aclose()
+          else:
+            result.close()
+          raise IFException(f'Function [{invocation.getFunction()}] returns a stream, which is not supported in a batch.')
+        return [result, None]
+      except asyncio.CancelledError:
+        raise
+      except BaseException as exception:
+        return [None, str(exception) if isinstance(exception, IFException) else traceback.format_exc()]
+
+    if self.getKeywordArguments().get('Concurrent'):
+      return list(await asyncio.gather(*[performCall(call) for call in calls]))
+    return [await performCall(call) for call in calls]
+
+
+class Dispatcher:
+  """Dispatch request invocations to the methods of a target object.
+
+  The bound method, its ``inspect.Signature`` and whether it is a coroutine function are looked up once for each function name and cached. The arguments are checked against the cached signature before the call, so that an argument error is reported without calling the method, and an exception raised by the method is passed through as is.
+  """
+
+  def __init__(self, target):
+    """Create a dispatcher for a target object.
+
+    Args:
+      target: The target object.
+    """
+    self.target = target
+    self.__entries = {}
+
+  def invalidate(self):
+    """Clear the cache, for a target whose methods are changed at runtime."""
+    self.__entries = {}
+
+  def isSynchronous(self, functionName):
+    """Check whether the function is known to be a synchronous method of the target.
+
+    Args:
+      functionName: The name of the function.
+
+    Returns:
+      True if the function is available and is not a coroutine function.
+    """
+    try:
+      return not self.__lookup(functionName)[1]
+    except IFException:
+      return False
+
+  def executionOf(self, functionName):
+    """Get the executor that the method of the function is marked to run in, see ``Execution``.
+
+    Args:
+      functionName: The name of the function.
+
+    Returns:
+      ``Execution.THREAD``, ``Execution.PROCESS``, or None if the method is not marked or not available.
+    """
     try:
-      method = getattr(target, self.getFunction())
-    except BaseException as exception:
-      raise IFException(f'Function [{self.getFunction()}] not available.') from exception
-    if not callable(method):
-      raise IFException(f'Function [{self.getFunction()}] not available.')
-    args = self.getArguments()
-    kwargs = self.getKeywordArguments()
+      return self.__lookup(functionName)[3]
+    except IFException:
+      return None
+
+  def bind(self, invocation, sourcePoint=None):
+    """Bind the method of a request invocation to its arguments without calling it, e.g., to call it in an executor.
+
+    Args:
+      invocation: The request invocation.
+      sourcePoint: The source point of the invocation, passed as the first argument if given. Only available for Broker.
+
+    Returns:
+      A callable without arguments that calls the method.
+
+    Raises:
+      IFException: If the function is not available or the arguments do not match.
+    """
+    method, _, check, _ = self.__lookup(invocation.getFunction())
+    args = invocation.getArguments()
+    kwargs = invocation.getKeywordArguments()
+    if sourcePoint:
+      args = [sourcePoint] + args
+    if check is not None:
+      check(args, kwargs, 1 if sourcePoint else 0)
+    return functools.partial(method, *args, **kwargs)
+
+  def call(self, invocation, sourcePoint=None):
+    """Call the method of a request invocation.
+
+    Args:
+      invocation: The request invocation.
+      sourcePoint: The source point of the invocation, passed as the first argument if given. Only available for Broker.
+
+    Returns:
+      The result of the method, which is a coroutine for coroutine functions.
+
+    Raises:
+      IFException: If the function is not available or the arguments do not match.
+    """
+    functionName = invocation.getFunction()
+    if functionName == Invocation.FunctionBatch:
+      return invocation.perform(self, sourcePoint)
+    method, _, check, _ = self.__lookup(functionName)
+    args = invocation.getArguments()
+    kwargs = invocation.getKeywordArguments()
     if sourcePoint:
       args = [sourcePoint] + args
+    if check is not None:
+      check(args, kwargs, 1 if sourcePoint else 0)
+    return method(*args, **kwargs)
+
+  def __lookup(self, functionName):
+    entry = self.__entries.get(functionName)
+    if entry is None:
+      try:
+        method = getattr(self.target, functionName)
+      except BaseException as exception:
+        raise IFException(f'Function [{functionName}] not available.') from exception
+      if not callable(method):
+        raise IFException(f'Function [{functionName}] not available.')
+      try:
+        signature = inspect.signature(method)
+      except (TypeError, ValueError):
+        signature = None
+      entry = (method, inspect.iscoroutinefunction(method), None if signature is None else Dispatcher.__newChecker(functionName, signature), getattr(method, Execution.ATTRIBUTE, None))
+      self.__entries[functionName] = entry
+    return entry
+
+  @classmethod
+  def __newChecker(cls, functionName, signature):
+    parameters = list(signature.parameters.values())
+    kinds = [parameter.kind for parameter in parameters]
+    positional = [parameter for parameter in parameters if parameter.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)]
+    maxPositional = None if inspect.Parameter.VAR_POSITIONAL in kinds else len(positional)
+    keywords = None if inspect.Parameter.VAR_KEYWORD in kinds else frozenset(parameter.name for parameter in parameters if parameter.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY))
+    required = [(index, parameter.name) for index, parameter in enumerate(positional) if parameter.default is inspect.Parameter.empty]
+    requiredKeywords = [parameter.name for parameter in parameters if parameter.kind == inspect.Parameter.KEYWORD_ONLY and parameter.default is inspect.Parameter.empty]
+
+    def check(args, kwargs, implicit):
+      if maxPositional is not None and len(args) > maxPositional:
+        raise IFException(f'Function [{functionName}] expects [{maxPositional - implicit}] arguments, but [{len(args) - implicit}] were given.')
+      if keywords is not None:
+        for key in kwargs:
+          if key not in keywords:
+            raise IFException(f'Keyword Argument [{key}] not availabel for function [{functionName}].')
+      for index, name in required:
+        if index >= len(args) and name not in kwargs:
+          raise IFException(f'Argument [{name}] missing for function [{functionName}].')
+      for name in requiredKeywords:
+        if name not in kwargs:
+          raise IFException(f'Argument [{name}] missing for function [{functionName}].')
+
+    return check
+
+
+class BufferSerialization:
+  """A utility class for transporting buffer-like objects, i.e., ``numpy.ndarray``, ``array.array`` and ``memoryview``.
+
+  A buffer is packed as a msgpack extension type that records how to rebuild it. If a list of out-of-band buffers is provided and the buffer is not smaller than ``OUT_OF_BAND_THRESHOLD`` bytes, the raw memory is appended to that list, and is transported as a separate ZMQ frame following the invocation frame. Otherwise, the raw memory is embedded in the extension type.
+  On the receiving side, ``numpy.ndarray`` and ``memoryview`` are rebuilt on the received frames without copying, thus they are read-only.
+  """
+
+  EXT_TYPE_BUFFER = 1
+  OUT_OF_BAND_THRESHOLD = 1024
+  KIND_NDARRAY = 'ndarray'
+  KIND_ARRAY = 'array'
+  KIND_MEMORYVIEW = 'memoryview'
+  __CONTAINERS = frozenset([memoryview, list, tuple, dict])
+
+  class MemoryviewBox:
+    """Wrap a memoryview so that it reaches the ``default`` hook of msgpack, which packs memoryview natively as bytes."""
+
+    def __init__(self, view):
+      self.view = view
+
+  @classmethod
+  def boxMemoryviews(cls, content):
+    """Box the memoryview objects at any depth of the invocation content, e.g., in the arguments, keyword arguments and result, in the containers among them, and in the calls of a batch, in either the map of IF1 or the positional array of IF2.
+
+    A list, tuple or dict is walked only if it holds a memoryview or another container, and only the containers on the way to a memoryview are copied.
+
+    Args:
+      content: The content of an invocation.
+
+    Returns:
+      The content with memoryview objects boxed. The original content is not modified.
+    """
+    boxed = BufferSerialization.__box(content, content.items() if isinstance(content, dict) else enumerate(content))
+    return content if boxed is None else boxed
+
+  @classmethod
+  def __box(cls, container, items):
+    # The boxed copy of the container, or None if it holds no memoryview. A nested container is walked only if it holds a memoryview or another container.
+    boxed = None
+    for key, value in items:
+      valueType = type(value)
+      if valueType is memoryview:
+        value = BufferSerialization.MemoryviewBox(value)
+      elif valueType is list or valueType is tuple:
+        if not value or BufferSerialization.__CONTAINERS.isdisjoint(map(type, value)):
+          continue
+        value = BufferSerialization.__box(value, enumerate(value))
+        if value is None:
+          continue
+      elif valueType is dict:
+        if not value or BufferSerialization.__CONTAINERS.isdisjoint(map(type, value.values())):
+          continue
+        value = BufferSerialization.__box(value, value.items())
+        if value is None:
+          continue
+      else:
+        continue
+      if boxed is None:
+        boxed = dict(container) if type(container) is dict else list(container)
+      boxed[key] = value
+    return boxed
+
+  @classmethod
+  def pack(cls, obj, buffers):
+    """The ``default`` hook of msgpack.
+
+    Args:
+      obj: The object that msgpack can not pack natively.
+      buffers: The list to collect out-of-band buffers, or None.
+
+    Returns:
+      A msgpack ExtType.
+
+    Raises:
+      TypeError: If the object is not a supported buffer-like object.
+    """
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+      if obj.dtype.hasobject:
+        raise TypeError(f'Can not serialize ndarray with dtype {obj.dtype}.')
+      obj = numpy.ascontiguousarray(obj)
+      meta = [BufferSerialization.KIND_NDARRAY, obj.dtype.str, list(obj.shape)]
+      view = memoryview(obj.reshape(-1)).cast('B') if obj.size > 0 else memoryview(b'')
+    elif isinstance(obj, array.array):
+      meta = [BufferSerialization.KIND_ARRAY, obj.typecode]
+      view = memoryview(obj).cast('B')
+    elif isinstance(obj, BufferSerialization.MemoryviewBox):
+      view = obj.view if obj.view.c_contiguous else memoryview(obj.view.tobytes())
+      meta = [BufferSerialization.KIND_MEMORYVIEW, obj.view.format, list(obj.view.shape)]
+      view = view.cast('B')
+      try:
+        view.cast(meta[1], meta[2])
+      except (TypeError, ValueError):
+        meta = [BufferSerialization.KIND_MEMORYVIEW, 'B', [view.nbytes]]
+    else:
+      raise TypeError(f'Can not serialize {type(obj)}.')
+    if buffers is not None and view.nbytes >= BufferSerialization.OUT_OF_BAND_THRESHOLD:
+      meta.append(len(buffers))
+      buffers.append(view)
+    else:
+      meta.append(view)
+    return msgpack.ExtType(BufferSerialization.EXT_TYPE_BUFFER, msgpack.packb(meta, use_bin_type=True))
+
+  @classmethod
+  def unpack(cls, code, data, buffers):
+    """The ``ext_hook`` of msgpack.
+
+    Args:
+      code: The code of the extension type.
+      data: The data of the extension type.
+      buffers: The out-of-band buffers, or None.
+
+    Returns:
+      The rebuilt object.
+    """
+    if code != BufferSerialization.EXT_TYPE_BUFFER:
+      return msgpack.ExtType(code, data)
+    meta = msgpack.unpackb(data, raw=False)
+    kind, reference = meta[0], meta[-1]
+    if isinstance(reference, int):
+      if buffers is None or reference >= len(buffers):
+        raise IFException(f'Out-of-band buffer {reference} not available.')
+      reference = buffers[reference]
+    view = memoryview(reference)
+    if kind == BufferSerialization.KIND_NDARRAY:
+      if numpy is None:
+        raise IFException('numpy is required to deserialize ndarray.')
+      return numpy.frombuffer(view, dtype=numpy.dtype(meta[1])).reshape(meta[2])
+    if kind == BufferSerialization.KIND_ARRAY:
+      rebuilt = array.array(meta[1])
+      rebuilt.frombytes(view)
+      return rebuilt
+    if kind == BufferSerialization.KIND_MEMORYVIEW:
+      return view.cast('B').cast(meta[1], meta[2])
+    raise IFException(f'Bad buffer kind: {kind}')
+
+
+class Codec(abc.ABC):
+  """The abstract base class of codecs that serialize the content of invocations.
+
+  A codec is identified by its ``name``, which is carried in the serialization frame of messages. ``priority`` ranks the codecs by speed: when two peers both support several codecs, the one with the highest priority is used.
+  A codec that is not ``safe`` may execute arbitrary code on decoding. It is never used unless both peers list it explicitly.
+  Subclasses must implement ``encode`` and ``decode``; a subclass missing either cannot be instantiated.
+  """
+
+  name = None
+  priority = 0
+  safe = True
+
+  @abc.abstractmethod
+  def encode(self, content, buffers=None):
+    """Encode the content of an invocation.
+
+    Args:
+      content: The content to encode.
+      buffers: A list to collect out-of-band buffers, or None.
+
+    Returns:
+      The encoded binary data.
+    """
+
+  @abc.abstractmethod
+  def decode(self, data, buffers=None):
+    """Decode the content of an invocation.
+
+    Args:
+      data: The encoded binary data.
+      buffers: The out-of-band buffers, or None.
+
+    Returns:
+      The decoded content.
+    """
+
+
+class MsgpackCodec(Codec):
+  """The default codec. Buffer-like objects are supported by ``BufferSerialization``.
+
+  Each thread reuses its own ``msgpack.Packer`` and ``msgpack.Unpacker``, so that no packer or unpacker is created per message. The out-of-band buffers of the current call are handed to the hooks through the thread-local state. Data larger than ``CACHED_UNPACK_LIMIT`` is decoded by ``msgpack.unpackb`` instead, which reads it in place rather than copying it into the buffer of the cached unpacker.
+  """
+
+  name = 'Msgpack'
+  priority = 0
+  PACK_OPTIONS = {'use_bin_type': True}
+  UNPACK_OPTIONS = {'raw': False}
+  CACHED_UNPACK_LIMIT = 65536
+
+  class ThreadState(threading.local):
+    """The packer, the unpacker and the out-of-band buffers of the current call, of a thread."""
+
+    def __init__(self, codec):
+      self.buffers = None
+      self.packer = codec._newPacker(self)
+      self.unpacker = codec._newUnpacker(self)
+
+  def __init__(self):
+    self.__state = MsgpackCodec.ThreadState(self)
+
+  def encode(self, content, buffers=None):
+    state = self.__state
+    if buffers is None:
+      return state.packer.pack(content)
+    content = BufferSerialization.boxMemoryviews(content)
+    state.buffers = buffers
     try:
-      result = method(*args, **kwargs)
-      if isinstance(result, types.CoroutineType):
-        return await result
-      return result
-    except BaseException as exception:
-      matchEargs = re.search("takes ([0-9]+) positional arguments but ([0-9]+) were given", str(exception))
-      if matchEargs:
-        minus = 2 if sourcePoint else 1
-        raise IFException(f'Function [{self.getFunction()}] expects [{int(matchEargs.group(1)) - minus}] arguments, but [{int(matchEargs.group(2)) - minus}] were given.') from exception
-      matchEkwargs = re.search("got an unexpected keyword argument '(.+)'", str(exception))
-      if matchEkwargs:
-        raise IFException(f'Keyword Argument [{matchEkwargs.group(1)}] not availabel for function [{self.getFunction()}].') from exception
-      raise exception
+      return state.packer.pack(content)
+    finally:
+      state.buffers = None
+
+  def decode(self, data, buffers=None):
+    length = len(data)
+    if length > self.CACHED_UNPACK_LIMIT:
+      return self._unpackb(data, buffers)
+    state = self.__state
+    unpacker = state.unpacker
+    if buffers:
+      state.buffers = buffers
+    try:
+      unpacker.feed(data)
+      content = unpacker.unpack()
+    except BaseException:
+      state.unpacker = self._newUnpacker(state)
+      raise
+    finally:
+      if buffers:
+        state.buffers = None
+    # The position of the unpacker is tracked, so that trailing bytes are detected by one ``tell``.
+    position = state.position = state.position + length
+    if unpacker.tell() != position:
+      state.unpacker = self._newUnpacker(state)
+    return content
+
+  def _newPacker(self, state):
+    return msgpack.Packer(default=lambda obj: self._pack(obj, state.buffers), **self.PACK_OPTIONS)
+
+  def _newUnpacker(self, state):
+    state.position = 0
+    return msgpack.Unpacker(ext_hook=lambda code, extData: self._unpack(code, extData, state.buffers), **self.UNPACK_OPTIONS)
+
+  def _packb(self, obj, buffers):
+    """Pack with a new packer, for the nested content of extension types, as the cached packer is in use."""
+    return msgpack.packb(obj, default=lambda item: self._pack(item, buffers), **self.PACK_OPTIONS)
+
+  def _unpackb(self, data, buffers):
+    """Unpack with a new unpacker, for large data and for the nested content of extension types."""
+    return msgpack.unpackb(data, ext_hook=lambda code, extData: self._unpack(code, extData, buffers), **self.UNPACK_OPTIONS)
+
+  def _pack(self, obj, buffers):
+    return BufferSerialization.pack(obj, buffers)
+
+  def _unpack(self, code, data, buffers):
+    return BufferSerialization.unpack(code, data, buffers)
+
+
+class MsgpackExtCodec(MsgpackCodec):
+  """Msgpack with extension types for ``set``, ``frozenset``, ``complex`` and ``datetime``.
+
+  ``set`` and ``frozenset`` are both decoded as ``set``. ``datetime`` is packed as the msgpack timestamp and decoded as a UTC ``datetime``; a naive ``datetime`` is regarded as local time.
+  """
+
+  name = 'MsgpackExt'
+  priority = 10
+  PACK_OPTIONS = {'use_bin_type': True, 'datetime': True}
+  UNPACK_OPTIONS = {'raw': False, 'timestamp': 3}
+  EXT_TYPE_SET = 2
+  EXT_TYPE_COMPLEX = 3
+
+  def _pack(self, obj, buffers):
+    if isinstance(obj, (set, frozenset)):
+      return msgpack.ExtType(MsgpackExtCodec.EXT_TYPE_SET, self._packb(list(obj), buffers))
+    if isinstance(obj, complex):
+      return msgpack.ExtType(MsgpackExtCodec.EXT_TYPE_COMPLEX, msgpack.packb([obj.real, obj.imag]))
+    if isinstance(obj, datetime):
+      return obj.astimezone(timezone.utc)
+    return super()._pack(obj, buffers)
+
+  def _unpack(self, code, data, buffers):
+    if code == MsgpackExtCodec.EXT_TYPE_SET:
+      return set(self._unpackb(data, buffers))
+    if code == MsgpackExtCodec.EXT_TYPE_COMPLEX:
+      return complex(*msgpack.unpackb(data))
+    return super()._unpack(code, data, buffers)
+
+
+class Pickle5Codec(Codec):
+  """Pickle protocol 5 with out-of-band buffers. Only for trusted peers, as unpickling may execute arbitrary code."""
+
+  name = 'Pickle5'
+  priority = 20
+  safe = False
+
+  def encode(self, content, buffers=None):
+    if buffers is None:
+      return pickle.dumps(content, protocol=5)
+    return pickle.dumps(content, protocol=5, buffer_callback=lambda buffer: buffers.append(buffer.raw()))
+
+  def decode(self, data, buffers=None):
+    return pickle.loads(data, buffers=buffers)
+
+
+class CodecRegistry:
+  """The registry of codecs, from which the codec of a message is dispatched by the value of its serialization frame."""
+
+  DEFAULT = 'Msgpack'
+  __codecs = {}
+  __encodedNames = {}
+
+  @classmethod
+  def register(cls, codec):
+    """Register a codec. A registered codec with the same name will be replaced.
+
+    Args:
+      codec: The Codec object.
+
+    Raises:
+      IFException: If the codec is not a named Codec object.
+    """
+    if not isinstance(codec, Codec) or not isinstance(codec.name, str):
+      raise IFException(f'Bad codec: {codec!r}')
+    CodecRegistry.__codecs[codec.name] = codec
+    CodecRegistry.__encodedNames[bytes(codec.name, 'UTF-8')] = codec
+
+  @classmethod
+  def get(cls, name):
+    """Get a registered codec.
+
+    Args:
+      name: The name of the codec, as str or bytes.
+
+    Returns:
+      The Codec object.
+
+    Raises:
+      IFException: If the codec is not registered.
+    """
+    # The serialization frames of messages are looked up as bytes, without decoding.
+    codec = (CodecRegistry.__encodedNames if type(name) is bytes else CodecRegistry.__codecs).get(name)
+    if codec is None:
+      raise IFException(f'Bad serialization: {str(name, encoding="UTF-8", errors="replace") if isinstance(name, bytes) else name}')
+    return codec
+
+  @classmethod
+  def names(cls, safeOnly=False):
+    """List the names of the registered codecs, ordered by priority from high to low.
+
+    Args:
+      safeOnly: If True, codecs that are not safe are excluded.
+
+    Returns:
+      A list of codec names.
+    """
+    codecs = sorted(CodecRegistry.__codecs.values(), key=lambda codec: -codec.priority)
+    return [codec.name for codec in codecs if codec.safe or not safeOnly]
+
+  @classmethod
+  def choose(cls, localCodecs, remoteCodecs):
+    """Choose the codec with the highest priority that both peers support.
+
+    Args:
+      localCodecs: The names of the codecs that the local peer accepts.
+      remoteCodecs: The names of the codecs that the remote peer accepts. None if unknown.
+
+    Returns:
+      The name of the chosen codec. The default codec if nothing in common.
+    """
+    if not remoteCodecs:
+      return CodecRegistry.DEFAULT
+    common = [name for name in localCodecs if name in remoteCodecs and name in CodecRegistry.__codecs]
+    if not common:
+      return CodecRegistry.DEFAULT
+    return max(common, key=lambda name: CodecRegistry.__codecs[name].priority)
+
+
+CodecRegistry.register(MsgpackCodec())
+CodecRegistry.register(MsgpackExtCodec())
+CodecRegistry.register(Pickle5Codec())
+
+
+class Compression:
+  """A utility class for compressing the serialized invocations with stdlib codecs.
+
+  The compression algorithm is recorded in the serialization frame as ``<serialization>+<algorithm>``, e.g. ``Msgpack+zlib``, so that the Broker routes compressed messages without decompressing them. Out-of-band buffers are never compressed.
+  The algorithm is chosen for a worker, and can be overridden for an invoker, or for a call by the keyword argument ``KEYWORD``, e.g. ``invoker.dump(table, IFCompression='lzma')``, which is removed before the request is sent. False disables compression.
+  """
+
+  DEFAULT_THRESHOLD = 16384
+  SEPARATOR = b'+'
+  KEYWORD = 'IFCompression'
+  ALGORITHMS = {
+      'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+      'lzma': (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+  }
+
+  @classmethod
+  def compress(cls, serialization, data, algorithm, threshold=None):
+    """Compress the serialized invocation if it is large enough.
+
+    Args:
+      serialization: The serialization method of the invocation.
+      data: The serialized invocation.
+      algorithm: The compression algorithm, 'zlib' or 'lzma'. None for no compression.
+      threshold: The data is compressed only if its size is not smaller than the threshold. ``DEFAULT_THRESHOLD`` if None.
+
+    Returns:
+      A tuple of the serialization frame and the (compressed) data. The data is left uncompressed if compression does not make it smaller.
+    """
+    if not algorithm:
+      return serialization, data
+    if algorithm not in Compression.ALGORITHMS:
+      raise IFException(f'Bad compression: {algorithm}')
+    if len(data) < (Compression.DEFAULT_THRESHOLD if threshold is None else threshold):
+      return serialization, data
+    compressed = Compression.ALGORITHMS[algorithm][0](data)
+    if len(compressed) >= len(data):
+      return serialization, data
+    if isinstance(serialization, str):
+      serialization = bytes(serialization, 'UTF-8')
+    return serialization + Compression.SEPARATOR + bytes(algorithm, 'UTF-8'), compressed
+
+  @classmethod
+  def parseHeader(cls, header):
+    """Split the serialization frame into the serialization method and the compression algorithm.
+
+    Args:
+      header: The serialization frame.
+
+    Returns:
+      A tuple of the serialization method and the compression algorithm, both in bytes. The algorithm is None if not compressed.
+    """
+    serialization, _, algorithm = header.partition(Compression.SEPARATOR)
+    return serialization, algorithm or None
+
+  @classmethod
+  def decompress(cls, data, algorithm):
+    """Decompress the serialized invocation.
+
+    Args:
+      data: The (compressed) data.
+      algorithm: The compression algorithm as str or bytes. None if not compressed.
+
+    Returns:
+      The decompressed data.
+    """
+    if not algorithm:
+      return data
+    if isinstance(algorithm, bytes):
+      algorithm = str(algorithm, encoding='UTF-8')
+    if algorithm not in Compression.ALGORITHMS:
+      raise IFException(f'Bad compression: {algorithm}')
+    return Compression.ALGORITHMS[algorithm][1](data)
+
+
+class Chunking:
+  """A utility class for transferring large messages in sequenced chunks.
+
+  The body and the out-of-band buffer frames of a message are split into chunks of at most the chunk size. Each chunk is sent to the target of the message as a request of ``FUNCTION`` with the arguments ``[transferID, index, data]``, in which ``data`` is sent out-of-band. The first chunk also carries the protocol, the message ID, the serialization frame and the sizes of the frames as keyword arguments. The receiver acknowledges each chunk after it is stored, and the sender keeps at most ``WINDOW`` chunks unacknowledged. Thus neither the Broker nor the receiver holds more than ``WINDOW`` chunks of a transfer at a time.
+  The receiver rejects a transfer whose declared size exceeds its limit, ``MAX_TRANSFER_SIZE`` by default, by an error response to the first chunk. Transfers larger than ``SPOOL_THRESHOLD`` are spooled to a temporary file instead of memory.
+  """
+
+  FUNCTION = 'IFChunk'
+  WINDOW = 4
+  IDLE_TIMEOUT = 3 * IFDefinition.HEARTBEAT_LIVETIME
+  MAX_TRANSFER_SIZE = 1 << 32
+  SPOOL_THRESHOLD = 1 << 26
+
+  @classmethod
+  def payloadSize(cls, message):
+    """Get the total size of the body and the out-of-band buffer frames of an outgoing message.
+
+    Args:
+      message: The outgoing Message.
+
+    Returns:
+      The size in bytes.
+    """
+    return sum(memoryview(frame).nbytes for frame in message.getContent()[6:])
+
+  @classmethod
+  def split(cls, message, chunkSize):
+    """Split an outgoing message into chunk invocations lazily. The chunks are views of the frames, without copying.
+
+    Args:
+      message: The outgoing Message.
+      chunkSize: The maximum size of each chunk in bytes.
+
+    Yields:
+      The request invocations of the chunks.
+    """
+    frames = [memoryview(frame).cast('B') for frame in message.getContent()[6:]]
+    meta = {
+        'Protocol': message.getProtocol(),
+        'MessageID': message.messageID,
+        'Header': message.getContent()[5],
+        'Sizes': [frame.nbytes for frame in frames],
+    }
+    index = 0
+    for frame in frames:
+      for start in range(0, frame.nbytes, chunkSize):
+        yield Invocation.newRequest(Chunking.FUNCTION, [message.idKey, index, frame[start:start + chunkSize]], meta if index == 0 else {})
+        index += 1
+
+
+class Streaming:
+  """Definitions of streaming results.
+
+  If a service method returns a generator or an async generator, its items are sent back as responses that share the ResponseID of the request, each with the index of the item in ``Stream``. The stream is ended by a response with the number of items in ``StreamEnd``, or by an error response. The producer sends at most ``WINDOW`` items ahead of the consumer: the consumer grants credits by requests of ``FUNCTION_CREDIT`` with the arguments ``[requestID, credits]`` as it consumes the items, or stops the stream with ``FUNCTION_CANCEL``. A producer without credits for ``IDLE_TIMEOUT`` seconds stops the stream.
+  """
+
+  FUNCTION_CREDIT = 'IFStreamCredit'
+  FUNCTION_CANCEL = 'IFStreamCancel'
+  WINDOW = 16
+  IDLE_TIMEOUT = 3 * IFDefinition.HEARTBEAT_LIVETIME
+
+
+class PubSub:
+  """Definitions of topic publish/subscribe.
+
+  A publication is sent to the Broker once, in the distributing mode ``'Publish'`` with the topic as the address, as a request of ``FUNCTION`` with the arguments ``[topic, data]``. The Broker delivers it to every worker that subscribed to a prefix of the topic, as a message from the publisher that is not responded. Each subscriber acknowledges the publications it has handled by ``FUNCTION_ACK`` requests to the Broker, which are not responded either. Publications to a subscriber with ``highWaterMark`` publications unacknowledged are dropped for that subscriber only.
+  """
+
+  FUNCTION = 'IFPublish'
+  FUNCTION_ACK = 'acknowledgePublications'
+  HIGH_WATER_MARK = 1000
+
+
+class Expiry:
+  """Definitions of the expiry and the cancellation of requests.
+
+  A request sent with a timeout carries it in seconds at the end of the serialization frame, as ``<serialization>[+<algorithm>]@<timeout>``. The timeout is relative, thus the clocks of the hosts do not need to agree. The Broker drops the requests whose timeouts pass while they wait in the queue of a service. A service aborts a coroutine method whose timeout passes after the request is received, and responds with an error.
+  Peers of earlier versions reject a serialization frame with a timeout, thus ``IFWorker`` attaches it only to the requests to the targets that it has negotiated IF2 with, see ``IFWorker.protocolFor``, and never to heartbeats. The requests to other targets are expired by the requester alone.
+  The requester expires its requests when their timeouts pass, and asks the target to abort them by a request of ``FUNCTION_CANCEL`` with the arguments ``[requestID]``, which is not responded. The service then aborts the coroutine method or the stream of the request, and the Broker drops the request if it is still queued.
+  """
+
+  FUNCTION_CANCEL = 'IFCancel'
+  SEPARATOR = b'@'
+  EXPIRED = 'Request expired.'
+
+  @classmethod
+  def attach(cls, header, timeout):
+    """Append a timeout to the serialization frame.
+
+    Args:
+      header: The serialization frame, in str or bytes.
+      timeout: The timeout in seconds.
+
+    Returns:
+      The serialization frame with the timeout, in bytes.
+    """
+    if isinstance(header, str):
+      header = bytes(header, 'UTF-8')
+    return header + b'@%.3f' % timeout
+
+  @classmethod
+  def parseHeader(cls, header):
+    """Split the timeout from the serialization frame.
+
+    Args:
+      header: The serialization frame.
+
+    Returns:
+      A tuple of the serialization frame without the timeout, and the timeout in seconds, which is None if not given.
+    """
+    if Expiry.SEPARATOR not in header:
+      return header, None
+    header, _, timeout = header.partition(Expiry.SEPARATOR)
+    try:
+      return header, float(timeout)
+    except ValueError as exception:
+      raise IFException(f'Bad timeout: {timeout}') from exception
+
+
+class Idempotency:
+  """Definitions of idempotent requests, and of their retries and hedging.
+
+  An idempotent request carries a key at the end of its serialization frame, as ``<serialization>[+<algorithm>][@<timeout>]#<key>``. A service performs the requests with the same key once. A duplicate that arrives while the first request is running is responded when it finishes, and one that arrives within ``TTL`` seconds after it succeeded is responded with the remembered result at once. Errors are not remembered, so that a retry after a failure runs again. At most ``CACHE_SIZE`` results are remembered. A method that returns a generator is closed without producing items, and the request is responded with an error, since a stream can not be replayed to the duplicates.
+  A requester may retry an idempotent request with the same key after a timeout, or hedge it by sending a duplicate after a delay and taking the response that arrives first. The Broker sends a request to a replica other than those that the requests of the same key from the same requester are in flight on, if there is one, so that a hedged duplicate runs on another replica. The delay of hedging defaults to the 95th percentile of the latencies of the recent calls to the target, and to ``HEDGE_DELAY`` seconds until ``SAMPLES`` calls are measured.
+  """
+
+  SEPARATOR = b'#'
+  TTL = 60
+  CACHE_SIZE = 1024
+  HEDGE_DELAY = 0.1
+  SAMPLES = 20
+
+  @classmethod
+  def newKey(cls):
+    """Generate a new idempotency key.
+
+    Returns:
+      The key in bytes.
+    """
+    return uuid.uuid4().hex.encode('UTF-8')
+
+  @classmethod
+  def attach(cls, header, key):
+    """Append an idempotency key to the serialization frame.
+
+    Args:
+      header: The serialization frame, in str or bytes.
+      key: The key, in str or bytes.
+
+    Returns:
+      The serialization frame with the key, in bytes.
+    """
+    if isinstance(header, str):
+      header = bytes(header, 'UTF-8')
+    if isinstance(key, str):
+      key = bytes(key, 'UTF-8')
+    return header + Idempotency.SEPARATOR + key
+
+  @classmethod
+  def parseHeader(cls, header):
+    """Split the idempotency key from the serialization frame.
+
+    Args:
+      header: The serialization frame.
+
+    Returns:
+      A tuple of the serialization frame without the key, and the key in bytes, which is None if not given.
+    """
+    if Idempotency.SEPARATOR not in header:
+      return header, None
+    header, _, key = header.partition(Idempotency.SEPARATOR)
+    return header, key
+
+
+class Bundling:
+  """A utility class for packing small messages into one transport message.
+
+  A bundle sent to the Broker is an outgoing message of the distributing mode ``DISTRIBUTING_MODE``, with empty address and serialization frames. A bundle sent from the Broker has an empty source address and ``DISTRIBUTING_MODE`` as the serialization frame. The body of a bundle holds the frames of the bundled messages: for each message the number of its frames, and then each frame prefixed by its length, all as 4-byte big-endian unsigned integers. The receiver unpacks a bundle and handles the messages in order as if they were sent one by one. Only messages without out-of-band buffers and not larger than ``MESSAGE_SIZE`` are bundled, and a bundle holds at most ``BUNDLE_SIZE`` bytes.
+  Bundling is negotiated by a request of ``FUNCTION`` to the Broker. A worker sends bundles only after the Broker has accepted the request, and the Broker bundles the messages to the worker from then on, until the worker is unregistered, e.g., when it is lost. The worker repeats the request with its heartbeats, so that a Broker that has restarted or forgotten it bundles again.
+  """
+
+  DISTRIBUTING_MODE = b'Bundle'
+  FUNCTION = 'enableBundling'
+  MESSAGE_SIZE = 1024
+  BUNDLE_SIZE = 65536
+
+  @classmethod
+  def bundle(cls, messages, outgoing=True):
+    """Pack the small messages among the frames of messages into bundles. The order of the messages is kept.
+
+    Args:
+      messages: A list of the frames of messages.
+      outgoing: True if the messages are sent to the Broker, False if they are sent from the Broker.
+
+    Returns:
+      A list of the frames to send, in which the runs of small messages are replaced by bundles. A run of one message is left as it is.
+    """
+    packed = []
+    run, size = [], 0
+    frameCount = 7 if outgoing else 6
+    for frames in messages:
+      messageSize = sum(len(frame) + 4 for frame in frames) + 4 if len(frames) == frameCount and all(isinstance(frame, bytes) for frame in frames) else None
+      if messageSize is None or messageSize > Bundling.MESSAGE_SIZE:
+        if run:
+          packed.append(Bundling.__pack(run, outgoing))
+          run, size = [], 0
+        packed.append(frames)
+        continue
+      if size + messageSize > Bundling.BUNDLE_SIZE:
+        packed.append(Bundling.__pack(run, outgoing))
+        run, size = [], 0
+      run.append(frames)
+      size += messageSize
+    if run:
+      packed.append(Bundling.__pack(run, outgoing))
+    return packed
+
+  @classmethod
+  def __pack(cls, run, outgoing):
+    if len(run) == 1:
+      return run[0]
+    parts = []
+    for frames in run:
+      parts.append(struct.pack('>I', len(frames)))
+      for frame in frames:
+        parts.append(struct.pack('>I', len(frame)))
+        parts.append(frame)
+    if outgoing:
+      return [b'', IFDefinition.PROTOCOL, b'%d' % next(Message.MessageIDs), Bundling.DISTRIBUTING_MODE, b'', b'', b''.join(parts)]
+    return [b'', IFDefinition.PROTOCOL, b'%d' % next(Message.MessageIDs), b'', Bundling.DISTRIBUTING_MODE, b''.join(parts)]
+
+  @classmethod
+  def unbundle(cls, body):
+    """Unpack the frames of the messages in the body of a bundle.
+
+    Args:
+      body: The body frame of the bundle.
+
+    Returns:
+      A list of the frames of the messages.
+
+    Raises:
+      IFException: If the body is truncated.
+    """
+    view = memoryview(body)
+    messages = []
+    position = 0
+    while position < len(view):
+      frames = []
+      count, position = Bundling.__readLength(view, position)
+      for _ in range(count):
+        length, position = Bundling.__readLength(view, position)
+        if position + length > len(view):
+          raise IFException('Truncated bundle.')
+        frames.append(view[position:position + length].tobytes())
+        position += length
+      messages.append(frames)
+    return messages
+
+  @classmethod
+  def __readLength(cls, view, position):
+    if position + 4 > len(view):
+      raise IFException('Truncated bundle.')
+    return struct.unpack_from('>I', view, position)[0], position + 4
+
+
+class Execution:
+  """Decorators to run the synchronous methods of a service in executors of the worker, instead of on the loop, see ``IFWorker``.
+
+  Methods on the loop block every other request of the worker, and the responses of the invocations of the worker, until they return. Methods that block on I/O, e.g., reading an instrument, can be marked by ``inThread`` to run in a thread pool. CPU-bound methods can be marked by ``inProcess`` to run in a process pool. The method, including the object it is bound to, and the arguments are pickled to the process, thus such methods should not depend on the state of the service, e.g., staticmethods.
+  """
+
+  THREAD = 'thread'
+  PROCESS = 'process'
+  ATTRIBUTE = '__ifExecution__'
+
+  @classmethod
+  def inThread(cls, method):
+    """Mark a method to run in the thread pool of the worker."""
+    setattr(method, cls.ATTRIBUTE, cls.THREAD)
+    return method
+
+  @classmethod
+  def inProcess(cls, method):
+    """Mark a method to run in the process pool of the worker."""
+    setattr(method, cls.ATTRIBUTE, cls.PROCESS)
+    return method
+
+
+class ChunkAssembler:
+  """Rebuild a message from its chunks incrementally, see ``Chunking``.
+
+  The chunks are stored in a preallocated bytearray, or spooled to an anonymous temporary file that is memory-mapped when the transfer completes. In the latter case, the buffer-like objects of the rebuilt invocation are views of the mapping, so that the transfer does not hold the payload in memory. The declared size is checked against a limit before anything is allocated.
+  """
+
+  def __init__(self, meta, directory=None, maxSize=None, spoolThreshold=None):
+    """Start a transfer with the keyword arguments of its first chunk.
+
+    Args:
+      meta: The keyword arguments of the first chunk.
+      directory: The directory to spool the chunks to. If given, every transfer is spooled. Otherwise, only transfers larger than the spool threshold are spooled, to the default temporary directory.
+      maxSize: The maximum total size of a transfer in bytes. ``Chunking.MAX_TRANSFER_SIZE`` if None.
+      spoolThreshold: Transfers larger than this size in bytes are spooled. ``Chunking.SPOOL_THRESHOLD`` if None.
+
+    Raises:
+      IFException: If the sizes are invalid or exceed the maximum.
+    """
+    sizes = meta.get('Sizes')
+    if not isinstance(sizes, list) or not all(type(size) is int and size >= 0 for size in sizes):
+      raise IFException('Bad sizes of the chunked transfer.')
+    total = sum(sizes)
+    maxSize = Chunking.MAX_TRANSFER_SIZE if maxSize is None else maxSize
+    if total > maxSize:
+      raise IFException(f'Chunked transfer of {total} bytes exceeds the limit of {maxSize} bytes.')
+    self.protocol = meta['Protocol']
+    self.messageID = meta['MessageID']
+    self.header = meta['Header']
+    self.sizes = sizes
+    self.total = total
+    self.received = 0
+    self.nextIndex = 0
+    self.lastTime = time.time()
+    spoolThreshold = Chunking.SPOOL_THRESHOLD if spoolThreshold is None else spoolThreshold
+    if total > 0 and (directory is not None or total > spoolThreshold):
+      self.__file = tempfile.TemporaryFile(dir=directory)
+      self.__storage = None
+    else:
+      self.__file = None
+      self.__storage = bytearray(total)
+
+  def feed(self, index, data):
+    """Store a chunk.
+
+    Args:
+      index: The index of the chunk, which must be the next one expected.
+      data: The data of the chunk.
+
+    Returns:
+      True if all the chunks are received.
+
+    Raises:
+      IFException: If the chunk is out of order or exceeds the declared size.
+    """
+    if index != self.nextIndex:
+      raise IFException(f'Chunk {index} received while chunk {self.nextIndex} expected.')
+    size = memoryview(data).nbytes
+    if self.received + size > self.total:
+      raise IFException('Chunks exceed the declared size.')
+    if self.__file is None:
+      self.__storage[self.received:self.received + size] = data
+    else:
+      self.__file.write(data)
+    self.received += size
+    self.nextIndex += 1
+    self.lastTime = time.time()
+    return self.received == self.total
+
+  def frames(self, fromAddress):
+    """Get the frames of the rebuilt message, as they were sent by the broker.
+
+    Args:
+      fromAddress: The address of the sender.
+
+    Returns:
+      The list of frames.
+    """
+    if self.__file is None:
+      storage = memoryview(self.__storage)
+    else:
+      self.__file.flush()
+      storage = memoryview(mmap.mmap(self.__file.fileno(), self.total, access=mmap.ACCESS_READ))
+      self.close()
+    frames = [b'', self.protocol, self.messageID.encode('UTF-8'), fromAddress, self.header]
+    position = 0
+    for size in self.sizes:
+      frames.append(storage[position:position + size])
+      position += size
+    return frames
+
+  def close(self):
+    """Release the temporary file. The mapping of a completed transfer stays valid."""
+    if self.__file is not None:
+      self.__file.close()
+      self.__file = None
 
 
 class IFAddress:
-  """A utility class for parsing address."""
+  """A utility class for parsing address.
+
+  The transports of ZeroMQ ``tcp``, ``ipc`` and ``inproc`` are supported. ``ipc`` connects processes on the same host over Unix domain sockets, with the address in the format of ``'ipc:///path/of/socket'``. ``inproc`` connects the broker and the workers in the same process, with the address in the format of ``'inproc://name'``, and is the fastest.
+  """
+
+  PROTOCOLS = ['tcp', 'ipc', 'inproc']
 
   @classmethod
   def parseAddress(cls, address):
@@ -568,18 +2021,35 @@ class IFAddress:
       address: The address to be parsed.
       
     Returns:
-      A list of [protocol, ip, port]. If the address is invalid, an exception will be raised.
+      A list of [protocol, ip, port]. For ``ipc`` and ``inproc``, it is [protocol, path, None]. If the address is invalid, an exception will be raised.
     """
     sp1 = address.split('://')
     if len(sp1) > 2:
       raise ValueError(f'Invalid address: {address}')
     protocol = sp1[0] if len(sp1) == 2 else 'tcp'
-    if protocol != 'tcp':
+    if protocol not in cls.PROTOCOLS:
       raise ValueError(f'Invalid protocol "{protocol}" of address "{address}"')
+    if protocol != 'tcp':
+      if not sp1[1]:
+        raise ValueError(f'Invalid address: {address}')
+      return [protocol, sp1[1], None]
     sp2 = sp1[-1].split(':')
     port = IFDefinition().DEFAULT_PORT_TCP if len(sp2) == 1 else sp2[1]
     return [protocol, sp2[0], port]
 
+  @classmethod
+  def toEndpoint(cls, address):
+    """Format a parsed address as the endpoint of ZeroMQ.
+
+    Args:
+      address: The address as returned by ``parseAddress``.
+
+    Returns:
+      The endpoint, e.g. ``'tcp://127.0.0.1:1061'`` or ``'ipc:///tmp/broker'``.
+    """
+    protocol, host, port = address
+    return f'{protocol}://{host}' if port is None else f'{protocol}://{host}:{port}'
+
 
 if __name__ == '__main__':
   print('test Core')
@@ -8,44 +8,133 @@ import threading
 import asyncio
 import logging
 import traceback
+import types
+import inspect
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
-from interactionfreepy.core import IFException, Message, Invocation, IFLoop, IFDefinition, IFAddress, IFRemoteException
+from interactionfreepy.core import IFException, Message, Invocation, IFLoop, IFDefinition, IFAddress, IFRemoteException, CodecRegistry, Chunking, ChunkAssembler, Dispatcher, Streaming, PubSub, Execution, Expiry, Bundling, Idempotency, Compression
 
 
 class IFWorker:
-  """InteractionFreePy Worker class. """
+  """InteractionFreePy Worker class.
 
-  def __init__(self, endpoint, serviceName=None, serviceObject=None, interfaces=None, blocking=True, timeout=None, force=False):
+  :param endpoint: The address of the broker, in the format of ``'tcp://ip:port'``, ``'ipc:///path'`` or ``'inproc://name'``, see ``IFAddress``.
+  :type endpoint: str
+  :param codecs: The names of the codecs that the worker accepts, see ``CodecRegistry``. The default codec ``'Msgpack'`` is always accepted. When invoking a service, the codec with the highest priority that both sides accept is used. Codecs that are not safe, e.g. ``'Pickle5'``, should only be listed if all peers are trusted.
+  :type codecs: list
+  :param compression: The compression algorithm, ``'zlib'`` or ``'lzma'``, for the invocations sent by the worker, including the responses of the service. None for no compression. It can be overridden for each invoker, and for each call, see ``Compression``.
+  :type compression: str
+  :param compressionThreshold: Invocations are compressed only if their serialized sizes are not smaller than this threshold. ``Compression.DEFAULT_THRESHOLD`` if None.
+  :type compressionThreshold: int
+  :param protocols: The protocols that the worker may send, ``IFDefinition.PROTOCOLS`` by default. The compact ``IF2`` is used for the broker and for services only after they are known to support it, so that the worker can share a broker with ``IF1``-only peers.
+  :type protocols: list
+  :param chunkSize: Messages to services or workers whose payloads are larger than this size in bytes, including the responses of the service, are sent in chunks of this size with flow control, see ``Chunking``. None for no chunking. The receivers must support chunked transfer.
+  :type chunkSize: int
+  :param chunkDirectory: The directory to spool incoming chunked transfers to. The rebuilt buffer-like objects are then backed by memory-mapped files instead of memory. None to spool only the transfers larger than ``Chunking.SPOOL_THRESHOLD``, to the default temporary directory, and to rebuild the others in memory.
+  :type chunkDirectory: str
+  :param maxTransferSize: The maximum size in bytes of an incoming chunked transfer. Larger transfers are rejected before anything is allocated. ``Chunking.MAX_TRANSFER_SIZE`` if None.
+  :type maxTransferSize: int
+  :param replica: If True, the worker joins the service as a replica if the service name is occupied, see ``Manager.registerAsService``. The broker balances the messages to the service among its replicas.
+  :type replica: bool
+  :param concurrency: The maximum number of requests in flight on the service. The broker queues the requests beyond it, see ``Manager.registerAsService``. None for no limit.
+  :type concurrency: int
+  :param queueSize: The maximum number of requests queued in the broker when ``concurrency`` is reached. Requests beyond it are rejected with an overload error.
+  :type queueSize: int
+  :param executions: The executors to run the methods of the service in, as a dict from the function names to ``Execution.THREAD`` or ``Execution.PROCESS``. It overrides the methods marked by ``Execution.inThread`` and ``Execution.inProcess``. Other methods run on the loop.
+  :type executions: dict
+  :param poolSize: The maximum number of methods running at the same time in each of the thread pool and the process pool. The defaults of ``concurrent.futures`` if None. The pools are created at the first request that needs them.
+  :type poolSize: int
+  :param window: The maximum number of requests to services and workers in flight, see ``InFlightWindow``. A blocking or non-blocking invocation blocks, and an async invocation awaits, until a response frees a slot. Invocations on the loop thread are never blocked, but are counted. None for no limit.
+  :type window: int
+  :param coalesce: If True, the small messages sent in the same iteration of the loop are packed into bundles, which the broker unpacks, see ``Bundling``. Bundles are sent only after the broker has agreed to exchange them, which is asked at start and again with each heartbeat. Until then, and with a broker that does not support bundles, the messages are sent one by one.
+  :type coalesce: bool
+  """
+
+  __DEFAULT_CAPABILITIES = (CodecRegistry.DEFAULT, IFDefinition.PROTOCOL)
+
+  def __init__(self, endpoint, serviceName=None, serviceObject=None, interfaces=None, blocking=True, timeout=None, force=False, codecs=None, compression=None, compressionThreshold=None, protocols=None, chunkSize=None, chunkDirectory=None, maxTransferSize=None, replica=False, concurrency=None, queueSize=0, executions=None, poolSize=None, window=None, coalesce=False):
     self.address = IFAddress.parseAddress(endpoint)
-    self.socket = zmq.Context().socket(zmq.DEALER)
+    self.socket = (zmq.Context.instance() if self.address[0] == 'inproc' else zmq.Context()).socket(zmq.DEALER)
     self.__stream = ZMQStream(self.socket, IFLoop.getInstance())
     self.__stream.on_recv(self.__onMessage)
     self.__stream.socket.setsockopt(zmq.LINGER, 0)
-    self.__stream.connect(f'{self.address[0]}://{self.address[1]}:{self.address[2]}')
+    self.__stream.connect(IFAddress.toEndpoint(self.address))
     self.__waitingMap = {}
     self.__waitingMapLock = threading.Lock()
+    self.__submissions = []
+    self.__defaultInvokers = {}
+    self.__submissionLock = threading.Lock()
+    self.__flushScheduled = False
     self.blocking = blocking
     self.timeout = timeout
+    self.codecs = [CodecRegistry.DEFAULT] if codecs is None else list(codecs)
+    if CodecRegistry.DEFAULT not in self.codecs:
+      self.codecs.append(CodecRegistry.DEFAULT)
+    self.protocols = list(IFDefinition.PROTOCOLS) if protocols is None else [bytes(p, 'UTF-8') if isinstance(p, str) else p for p in protocols]
+    self.__capabilities = {}
+    self.__brokerProtocol = IFDefinition.PROTOCOL
+    self.compression = compression
+    self.compressionThreshold = compressionThreshold
+    self.chunkSize = chunkSize
+    self.chunkDirectory = chunkDirectory
+    self.maxTransferSize = maxTransferSize
+    self.replica = replica
+    self.concurrency = concurrency
+    self.queueSize = queueSize
+    self.executions = {} if executions is None else dict(executions)
+    self.poolSize = poolSize
+    self.window = window
+    self.coalesce = coalesce
+    self.__bundling = False
+    self.__window = InFlightWindow(window) if window else None
+    self.__pools = {}
+    self.__transfers = {}
+    self.__streams = {}
+    self.__running = {}
+    self.__expiries = {}
+    self.__idempotent = OrderedDict()
+    self.__latencies = {}
+    self.__subscriptions = {}
+    self.__unacknowledged = 0
     self.__isService = False
+    self.__dispatcher = Dispatcher(None)
     if serviceName is not None:
       self.bindService(serviceName, serviceObject, [] if interfaces is None else interfaces)
     self.__hbTimeoutCount = 0
     self.__latestHBTime = time.time()
+    self.__sentCount = 0
     self.logging = logging.getLogger('InteractionFreePy')
     threading.Thread(target=self.__hbLoop, daemon=True).start()
     IFLoop.tryStart()
+    if IFDefinition.PROTOCOL_IF2 in self.protocols:
+      self.__negotiateBrokerProtocol()
+    if self.coalesce:
+      self.__negotiateBundling()
     if self.__isService:
-      self.registerAsService(self.__serviceName, self.__interfaces, force)
+      self.__registerAsService(force)
 
   def __hbLoop(self):
+    sentCount = self.__sentCount
     while True:
       time.sleep(IFDefinition.HEARTBEAT_LIVETIME / 5)
+      if self.__transfers:
+        IFLoop.getInstance().add_callback(self.__purgeTransfers)
+      # Every message to the broker counts as a heartbeat. While messages are flowing, a heartbeat is only sent every HEARTBEAT_LIVETIME to check the registration.
+      if self.__sentCount != sentCount and time.time() - self.__latestHBTime < IFDefinition.HEARTBEAT_LIVETIME:
+        sentCount = self.__sentCount
+        continue
       try:
-        if not self.blockingInvoker(timeout=IFDefinition.HEARTBEAT_LIVETIME / 5).heartbeat() and self.__isService:
-          self.registerAsService(self.__serviceName, self.__interfaces)
+        if not self.__heartbeat() and self.__isService:
+          self.__registerAsService()
+        if self.coalesce:
+          self.__negotiateBundling()
         self.__hbTimeoutCount = 0
+        self.__latestHBTime = time.time()
+        sentCount = self.__sentCount
       except BaseException as exception:
         if str(exception) == 'TIMEOUT':
           self.__hbTimeoutCount += 1
@@ -58,39 +147,314 @@ class IFWorker:
         else:
           self.logging.warning('Error in Heartbeat: %s', exception)
 
+  def __heartbeat(self):
+    # The heartbeat never carries a timeout in its serialization frame, so that it is accepted by brokers of any version. It is expired by the worker alone.
+    timeout = IFDefinition.HEARTBEAT_LIVETIME / 5
+    message = Message.newBrokerMessage(Invocation.newRequest('heartbeat', [], {}), protocol=self.protocolFor(None))
+    return self.send(message, timeout=timeout).sync(timeout)
+
+  def __registerAsService(self, force=False):
+    options = {} if self.codecs == [CodecRegistry.DEFAULT] else {'codecs': self.codecs}
+    if self.replica:
+      options['replica'] = True
+    if self.concurrency is not None:
+      options['concurrency'] = self.concurrency
+      options['queueSize'] = self.queueSize
+    self.registerAsService(self.__serviceName, self.__interfaces, force, **options)
+
   def __onMessage(self, msg):
     try:
-      message = Message(msg)
+      if msg[4] == Bundling.DISTRIBUTING_MODE:
+        for frames in Bundling.unbundle(msg[5]):
+          self.__onMessage(frames)
+        return
+      message = Message(msg, outgoing=False)
+      if str(message.serialization, encoding='UTF-8') not in self.codecs:
+        errorMsg = Message.newDirectMessage(message.fromAddress, Invocation.newError(message.replyID, f'Serialization {str(message.serialization, encoding="UTF-8")} not accepted.'), protocol=message.getProtocol())
+        self.__sendFrames(errorMsg.getContent())
+        return
       invocation = message.getInvocation()
-      if invocation.isRequest():
-        IFLoop.getInstance().add_callback(self.__onRequest, message)
+      if invocation.isRequest() and invocation.getFunction() == PubSub.FUNCTION:
+        self.__onPublication(message)
+      elif invocation.isRequest() and invocation.getFunction() == Chunking.FUNCTION:
+        self.__onChunk(message)
+      elif invocation.isRequest() and invocation.getFunction() in (Streaming.FUNCTION_CREDIT, Streaming.FUNCTION_CANCEL):
+        self.__onStreamControl(message)
+      elif invocation.isRequest() and invocation.getFunction() == Expiry.FUNCTION_CANCEL:
+        self.__onCancel(message)
+      elif invocation.isRequest() and message.idempotencyKey is not None and self.__deduplicate(message):
+        return
+      elif invocation.isRequest():
+        execution = self.executions.get(invocation.getFunction()) or self.__dispatcher.executionOf(invocation.getFunction())
+        if execution is not None:
+          IFLoop.getInstance().add_callback(self.__onRequest, message, self.__execute(execution, invocation))
+        elif invocation.getFunction() != 'stopService' and self.__dispatcher.isSynchronous(invocation.getFunction()):
+          self.__onSynchronousRequest(message)
+        else:
+          IFLoop.getInstance().add_callback(self.__onRequest, message)
       elif invocation.isResponse():
         self.__onResponse(message)
     except BaseException:
       exstr = traceback.format_exc()
       logging.debug(exstr)
 
-  async def __onRequest(self, message):
-    sourcePoint = message.fromAddress
+  def __onPublication(self, message):
+    topic, data = message.getInvocation().getArguments()
+    pending = []
+    for prefix, callback in list(self.__subscriptions.items()):
+      if topic.startswith(prefix):
+        try:
+          result = callback(topic, data)
+          if isinstance(result, types.CoroutineType):
+            pending.append(result)
+        except BaseException:
+          self.logging.warning('Error in the callback of topic %s: %s', prefix, traceback.format_exc())
+    if pending:
+      IFLoop.getInstance().add_callback(self.__awaitPublication, pending)
+    else:
+      self.__acknowledge()
+
+  async def __awaitPublication(self, pending):
+    for coroutine in pending:
+      try:
+        await coroutine
+      except BaseException:
+        self.logging.warning('Error in the callback of a publication: %s', traceback.format_exc())
+    self.__acknowledge()
+
+  def __acknowledge(self):
+    # Acknowledgements are sent once for the publications handled in the same iteration of the loop.
+    self.__unacknowledged += 1
+    if self.__unacknowledged == 1:
+      IFLoop.getInstance().add_callback(self.__sendAcknowledgement)
+
+  def __sendAcknowledgement(self):
+    count, self.__unacknowledged = self.__unacknowledged, 0
+    self.__sendFrames(Message.newBrokerMessage(Invocation.newRequest(PubSub.FUNCTION_ACK, [count], {})).getContent())
+
+  def __onSynchronousRequest(self, message):
+    # Synchronous methods are called right away, without scheduling a coroutine on the loop.
+    try:
+      result = self.__dispatcher.call(message.getInvocation())
+      if isinstance(result, types.CoroutineType) or inspect.isgenerator(result) or inspect.isasyncgen(result):
+        IFLoop.getInstance().add_callback(self.__onRequest, message, result)
+        return
+      self.__respond(message, result)
+    except BaseException:
+      self.__respondError(message, traceback.format_exc())
+
+  async def __execute(self, execution, invocation):
+    call = self.__dispatcher.bind(invocation)
+    return await asyncio.get_running_loop().run_in_executor(self.__poolOf(execution), call)
+
+  async def __performCall(self, invocation):
+    # A call of a batch runs where the same call would run alone.
+    execution = self.executions.get(invocation.getFunction()) or self.__dispatcher.executionOf(invocation.getFunction())
+    if execution is not None:
+      return await self.__execute(execution, invocation)
+    return await invocation.perform(self.__dispatcher)
+
+  def __poolOf(self, execution):
+    pool = self.__pools.get(execution)
+    if pool is None:
+      if execution == Execution.THREAD:
+        pool = ThreadPoolExecutor(self.poolSize, thread_name_prefix='IFWorker')
+      elif execution == Execution.PROCESS:
+        # Forking a process with the threads of the loop and ZeroMQ is not safe.
+        pool = ProcessPoolExecutor(self.poolSize, mp_context=multiprocessing.get_context('spawn'))
+      else:
+        raise IFException(f'Execution [{execution}] not supported.')
+      self.__pools[execution] = pool
+    return pool
+
+  async def __onRequest(self, message, pending=None):
     invocation = message.getInvocation()
+    receivedTime = time.time()
     try:
-      if 'stopService' == invocation.getFunction():
+      if pending is not None:
+        result = pending
+      elif 'stopService' == invocation.getFunction():
         self.__isService = False
-        result = await self.asyncInvoker().unregister()
+        result = self.asyncInvoker().unregister()
       else:
-        result = await invocation.perform(self.__serviceObject)
-      responseMessage = Message.newDirectMessage(sourcePoint, Invocation.newResponse(message.messageID, result))
-      self.__stream.send_multipart(responseMessage.getContent())
+        result = invocation.perform(self.__dispatcher, performer=self.__performCall)
+      if isinstance(result, types.CoroutineType):
+        result = await self.__run(message, result, receivedTime)
+      if (inspect.isgenerator(result) or inspect.isasyncgen(result)) and message.idempotencyKey is not None:
+        # The items of a stream can not be replayed to the duplicates of the request, see ``Idempotency``.
+        if inspect.isasyncgen(result):
+          await result.aclose()
+        else:
+          result.close()
+        raise IFException('Streams are not supported for idempotent requests.')
+      if inspect.isgenerator(result) or inspect.isasyncgen(result):
+        await self.__produceStream(message, result)
+      else:
+        self.__respond(message, result)
+    except BaseException:
+      self.__respondError(message, traceback.format_exc())
+
+  async def __run(self, message, coroutine, receivedTime):
+    # The coroutine runs as a task, so that it can be aborted when the request expires or is cancelled, see ``Expiry``.
+    key = (message.fromAddress, message.idKey)
+    task = asyncio.ensure_future(coroutine)
+    self.__running[key] = task
+    try:
+      timeout = message.timeout
+      if timeout is None:
+        return await task
+      return await asyncio.wait_for(task, max(timeout - (time.time() - receivedTime), 0))
+    except asyncio.TimeoutError as exception:
+      raise IFException(Expiry.EXPIRED) from exception
+    except asyncio.CancelledError as exception:
+      raise IFException('Request cancelled.') from exception
+    finally:
+      if self.__running.get(key) is task:
+        self.__running.pop(key)
+
+  def __onCancel(self, message):
+    # Cancellations are not responded. The cancelled request is responded with an error.
+    arguments = message.getInvocation().getArguments()
+    key = (message.fromAddress, Message.toIDKey(arguments[0]))
+    task = self.__running.get(key)
+    if task is not None:
+      task.cancel()
+    credits = self.__streams.pop(key, None)
+    if credits is not None:
+      credits.release()
+
+  async def __produceStream(self, message, generator):
+    key = (message.fromAddress, message.idKey)
+    credits = asyncio.Semaphore(Streaming.WINDOW)
+    self.__streams[key] = credits
+    index = 0
+    try:
+      while True:
+        await asyncio.wait_for(credits.acquire(), Streaming.IDLE_TIMEOUT)
+        if self.__streams.get(key) is not credits:
+          break
+        try:
+          item = await generator.__anext__() if inspect.isasyncgen(generator) else next(generator)
+        except (StopIteration, StopAsyncIteration):
+          break
+        self.__transmit(Message.newDirectMessage(message.fromAddress, Invocation.newStreamItem(message.replyID, index, item), message.serialization, self.compression, self.compressionThreshold, message.getProtocol()))
+        index += 1
+      self.__transmit(Message.newDirectMessage(message.fromAddress, Invocation.newStreamEnd(message.replyID, index), message.serialization, protocol=message.getProtocol()))
+    except asyncio.TimeoutError:
+      self.logging.warning('Stream of message %s to %s stopped without credits.', message.messageID, message.fromAddress)
+      self.__respondError(message, 'Stream stopped without credits.')
+    finally:
+      if self.__streams.get(key) is credits:
+        self.__streams.pop(key)
+      if inspect.isasyncgen(generator):
+        await generator.aclose()
+      else:
+        generator.close()
+
+  def __onStreamControl(self, message):
+    # Credits and cancellations are not responded.
+    invocation = message.getInvocation()
+    arguments = invocation.getArguments()
+    key = (message.fromAddress, Message.toIDKey(arguments[0]))
+    credits = self.__streams.get(key)
+    if credits is None:
+      return
+    if invocation.getFunction() == Streaming.FUNCTION_CANCEL:
+      self.__streams.pop(key)
+      credits.release()
+    else:
+      for _ in range(arguments[1]):
+        credits.release()
+
+  def __sendStreamControl(self, address, function, arguments, protocol):
+    controlMessage = Message.newDirectMessage(address, Invocation.newRequest(function, arguments, {}), protocol=protocol)
+    self.__sendFrames(controlMessage.getContent())
+
+  def __respond(self, message, result):
+    responseMessage = Message.newDirectMessage(message.fromAddress, Invocation.newResponse(message.replyID, result), message.serialization, self.compression, self.compressionThreshold, message.getProtocol())
+    self.__transmit(responseMessage)
+    if message.idempotencyKey is not None:
+      self.__settleIdempotent(message.idempotencyKey, (result,))
+
+  def __respondError(self, message, fullErrorString):
+    errorMsg = Message.newDirectMessage(message.fromAddress, Invocation.newError(message.replyID, fullErrorString), message.serialization, self.compression, self.compressionThreshold, message.getProtocol())
+    self.__sendFrames(errorMsg.getContent())
+    if message.idempotencyKey is not None:
+      self.__settleIdempotent(message.idempotencyKey, None, fullErrorString)
+
+  def __deduplicate(self, message):
+    # Entries are [duplicates waiting, (result,) once succeeded, time], in the order of their times, see ``Idempotency``.
+    now = time.time()
+    while self.__idempotent:
+      key, entry = next(iter(self.__idempotent.items()))
+      if len(self.__idempotent) <= Idempotency.CACHE_SIZE and now - entry[2] < Idempotency.TTL:
+        break
+      self.__idempotent.pop(key)
+      for duplicate in entry[0]:
+        self.__respondError(duplicate, 'Idempotent request forgotten.')
+    entry = self.__idempotent.get(message.idempotencyKey)
+    if entry is None:
+      self.__idempotent[message.idempotencyKey] = [[], None, now]
+      return False
+    if entry[1] is None:
+      entry[0].append(message)
+    else:
+      self.__respond(message, entry[1][0])
+    return True
+
+  def __settleIdempotent(self, key, outcome, error=None):
+    entry = self.__idempotent.get(key)
+    if entry is None or entry[1] is not None:
+      return
+    duplicates = entry[0]
+    if outcome is None:
+      # Errors are not remembered, so that a retry runs again.
+      self.__idempotent.pop(key)
+    else:
+      entry[0], entry[1], entry[2] = [], outcome, time.time()
+      self.__idempotent.move_to_end(key)
+    for duplicate in duplicates:
+      if outcome is None:
+        self.__respondError(duplicate, error)
+      else:
+        self.__respond(duplicate, outcome[0])
+
+  def __onChunk(self, message):
+    arguments = message.getInvocation().getArguments()
+    key = (message.fromAddress, arguments[0] if arguments else None)
+    try:
+      transferID, index, data = arguments
+      if index == 0:
+        self.__transfers[key] = ChunkAssembler(message.getInvocation().getKeywordArguments(), self.chunkDirectory, self.maxTransferSize)
+      if key not in self.__transfers:
+        raise IFException(f'Transfer {transferID} not available.')
+      completed = self.__transfers[key].feed(index, data)
+      ack = Message.newDirectMessage(message.fromAddress, Invocation.newResponse(message.replyID, None), protocol=message.getProtocol())
+      self.__sendFrames(ack.getContent())
+      if completed:
+        self.__onMessage(self.__transfers.pop(key).frames(message.fromAddress))
     except BaseException as exception:
-      fullErrorString = traceback.format_exc()
-      errorMsg = Message.newDirectMessage(sourcePoint, Invocation.newError(message.messageID, fullErrorString))
-      self.__stream.send_multipart(errorMsg.getContent())
+      transfer = self.__transfers.pop(key, None)
+      if transfer is not None:
+        transfer.close()
+      errorMsg = Message.newDirectMessage(message.fromAddress, Invocation.newError(message.replyID, str(exception)), protocol=message.getProtocol())
+      self.__sendFrames(errorMsg.getContent())
+
+  def __purgeTransfers(self):
+    now = time.time()
+    for key in [key for key, transfer in self.__transfers.items() if now - transfer.lastTime > Chunking.IDLE_TIMEOUT]:
+      self.__transfers.pop(key).close()
+      self.logging.warning('Chunked transfer %s from %s expired.', key[1], key[0])
 
   def __onResponse(self, message):
     invocation = message.getInvocation()
-    correspondingID = invocation.getResponseID()
+    correspondingID = Message.toIDKey(invocation.getResponseID())
     self.__waitingMapLock.acquire()
-    if correspondingID in self.__waitingMap:
+    if self.__expiries:
+      self.__clearExpiry(correspondingID)
+    if correspondingID in self.__waitingMap and (invocation.isStream() or 'stream' in self.__waitingMap[correspondingID][0]):
+      self.__onStreamResponse(message, correspondingID)
+    elif correspondingID in self.__waitingMap:
       (futureEntry, runnable) = self.__waitingMap.pop(correspondingID)
       if invocation.isError():
         futureEntry['error'] = invocation.getError()
@@ -103,25 +467,309 @@ class IFWorker:
       logging.debug('ResponseID not recognized: %s', message)
     self.__waitingMapLock.release()
 
-  def send(self, msg):
+  def __onStreamResponse(self, message, correspondingID):
+    invocation = message.getInvocation()
+    (futureEntry, runnable) = self.__waitingMap[correspondingID]
+    stream = futureEntry.get('stream')
+    if stream is None:
+      address, protocol = message.fromAddress, message.getProtocol()
+      stream = RemoteStream(lambda function, arguments: self.__sendStreamControl(address, function, [correspondingID] + arguments, protocol))
+      futureEntry['stream'] = stream
+      futureEntry['result'] = stream
+      runnable()
+    if invocation.isError():
+      stream._fail(invocation.getError())
+    elif invocation.isStreamEnd():
+      stream._end(invocation.get(Invocation.KeyStreamEnd))
+    else:
+      stream._put(invocation.getStreamIndex(), invocation.getResult())
+    # Items sent in chunks may arrive after the end of the stream.
+    if invocation.isError() or stream._isComplete():
+      self.__waitingMap.pop(correspondingID)
+
+  def send(self, msg, chunked=True, timeout=None):
     """Send a message by the worker.
     
     Args:
         msg (Message): The message to send.
+        chunked (bool): If False, the message is sent in one piece regardless of ``chunkSize``.
+        timeout (float): If given, the future is completed with a ``'TIMEOUT'`` error when no response is received in this many seconds, and the target is asked to abort the request, see ``Expiry``. The message should carry the same timeout if the target accepts IF2.
 
     Returns:
         InvokeFuture: The future of the sending.
     """
-    mid = msg.messageID
+    mid = msg.idKey
     (future, onFinish, resultMap) = InvokeFuture.newFuture()
-    self.__waitingMapLock.acquire()
-    if mid in self.__waitingMap:
-      raise IFException("MessageID have been used.")
-    self.__waitingMap[mid] = (resultMap, onFinish)
-    self.__waitingMapLock.release()
-    self.__stream.send_multipart(msg.getContent())
+    mode, address, protocol = msg.getDistributingMode(), msg.distributingAddress, msg.getProtocol()
+    future._setCanceller(lambda error: self.__cancel(mid, mode, address, protocol, error))
+    windowed = self.__window is not None and not msg.isBrokerMessage()
+    if windowed:
+      # The loop thread is never blocked, since the responses that free the slots are handled on it.
+      if not self.__window.acquire(timeout, force=IFLoop.isLoopThread()):
+        raise IFException('TIMEOUT')
+      onFinish = self.__window.releasing(onFinish)
+    with self.__waitingMapLock:
+      if mid in self.__waitingMap:
+        if windowed:
+          self.__window.release()
+        raise IFException("MessageID have been used.")
+      self.__waitingMap[mid] = (resultMap, onFinish)
+    if timeout is not None:
+      self.__scheduleExpiry(mid, future, time.time() + timeout)
+    self.__transmit(msg, chunked)
     return future
 
+  def sendAsync(self, msg, chunked=True, reserved=False):
+    """Send a message by the worker, with an ``asyncio.Future`` for the response. It must be called in a running event loop.
+
+    The future is resolved on its loop from the response, without the locks of ``InvokeFuture``. Cancelling it, e.g., by ``asyncio.wait_for``, forgets the request and asks the target to abort it, see ``Expiry``.
+
+    Args:
+        msg (Message): The message to send.
+        chunked (bool): If False, the message is sent in one piece regardless of ``chunkSize``.
+        reserved (bool): True if a slot of the in-flight window has been reserved by ``reserve``. Otherwise a slot is taken without waiting.
+
+    Returns:
+        asyncio.Future: The future of the result. It raises ``IFRemoteException`` if the response is an error.
+    """
+    mid = msg.idKey
+    loop = asyncio.get_running_loop()
+    thread = threading.get_ident()
+    future = loop.create_future()
+    resultMap = {}
+
+    def onFinish():
+      if threading.get_ident() == thread:
+        IFWorker.__resolve(future, resultMap)
+      else:
+        loop.call_soon_threadsafe(IFWorker.__resolve, future, resultMap)
+
+    mode, address, protocol = msg.getDistributingMode(), msg.distributingAddress, msg.getProtocol()
+    future.add_done_callback(lambda future: future.cancelled() and self.__cancel(mid, mode, address, protocol, 'Cancelled'))
+    windowed = self.__window is not None and not msg.isBrokerMessage()
+    if windowed:
+      if not reserved:
+        self.__window.acquire(force=True)
+      onFinish = self.__window.releasing(onFinish)
+    with self.__waitingMapLock:
+      if mid in self.__waitingMap:
+        if windowed:
+          self.__window.release()
+        raise IFException("MessageID have been used.")
+      self.__waitingMap[mid] = (resultMap, onFinish)
+    self.__transmit(msg, chunked)
+    return future
+
+  def sendIdempotent(self, newMessage, target, timeout=None, retries=0, hedge=None):
+    """Send an idempotent request, which is retried after timeouts and hedged by duplicates, see ``Idempotency``.
+
+    Each attempt is a message of the same idempotency key, which is matched with its response by its own message ID. The first successful response completes the future, and the other attempts are cancelled.
+
+    Args:
+        newMessage (function): Called with the idempotency key to create the message of each attempt.
+        target (str): The name of the service, for the latencies that the delay of hedging is based on.
+        timeout (float): The timeout of each attempt in seconds. None for no timeout. The messages should carry the same timeout if the target accepts IF2.
+        retries (int): The number of times the request is retried after the timeout of the last attempt.
+        hedge (bool or float): If given, a duplicate is sent after this delay in seconds, or after ``hedgeDelayFor(target)`` if True, unless the request is done by then.
+
+    Returns:
+        InvokeFuture: The future of the request.
+    """
+    return IdempotentCall(self, newMessage, target, timeout, retries, hedge).start()
+
+  def hedgeDelayFor(self, target):
+    """Get the delay before a duplicate of an idempotent request to a target is sent, i.e., the 95th percentile of the latencies of the recent idempotent requests to it.
+
+    Args:
+        target (str): The name of the service.
+
+    Returns:
+        float: The delay in seconds. ``Idempotency.HEDGE_DELAY`` until ``Idempotency.SAMPLES`` requests are measured.
+    """
+    latencies = self.__latencies.get(target)
+    if latencies is None or len(latencies) < Idempotency.SAMPLES:
+      return Idempotency.HEDGE_DELAY
+    ordered = sorted(latencies)
+    return ordered[int(len(ordered) * 0.95)]
+
+  def _recordLatency(self, target, latency):
+    latencies = self.__latencies.get(target)
+    if latencies is None:
+      latencies = self.__latencies[target] = deque(maxlen=5 * Idempotency.SAMPLES)
+    latencies.append(latency)
+
+  async def reserve(self):
+    """Wait for a free slot in the in-flight window, see ``InFlightWindow``. The slot is taken by the next ``sendAsync`` with ``reserved=True``. It returns at once if the worker has no window.
+
+    Returns:
+        bool: True if a slot is reserved.
+    """
+    if self.__window is None:
+      return False
+    await self.__window.acquireAsync()
+    return True
+
+  @staticmethod
+  def __resolve(future, resultMap):
+    if future.done():
+      return
+    if 'error' in resultMap:
+      future.set_exception(IFRemoteException(resultMap['error']))
+    else:
+      future.set_result(resultMap.get('result'))
+
+  def __scheduleExpiry(self, mid, future, deadline):
+    # Each request with a timeout has a timer on the loop, which is removed when the request is responded, cancelled or aborted.
+    if not IFLoop.isLoopThread():
+      IFLoop.getInstance().add_callback(self.__scheduleExpiry, mid, future, deadline)
+      return
+    with self.__waitingMapLock:
+      if mid in self.__waitingMap:
+        self.__expiries[mid] = IFLoop.getInstance().call_later(max(deadline - time.time(), 0), future.cancel, 'TIMEOUT')
+
+  def __clearExpiry(self, mid):
+    # Called with the lock of the waiting map held.
+    handle = self.__expiries.pop(mid, None)
+    if handle is None:
+      return
+    if IFLoop.isLoopThread():
+      IFLoop.getInstance().remove_timeout(handle)
+    else:
+      IFLoop.getInstance().add_callback(IFLoop.getInstance().remove_timeout, handle)
+
+  def __cancel(self, mid, mode, address, protocol, error):
+    with self.__waitingMapLock:
+      entry = self.__waitingMap.get(mid)
+      if entry is None or 'stream' in entry[0]:
+        return False
+      self.__waitingMap.pop(mid)
+      self.__clearExpiry(mid)
+      (futureEntry, runnable) = entry
+      futureEntry['error'] = error
+      futureEntry['cancelled'] = True
+      runnable()
+    if mode != IFDefinition.DISTRIBUTING_MODE_BROKER:
+      cancellation = Message.newMessage(mode, address, Invocation.newRequest(Expiry.FUNCTION_CANCEL, [mid], {}), protocol=protocol)
+      IFLoop.getInstance().add_callback(self.__sendFrames, cancellation.getContent())
+    return True
+
+  def __transmit(self, msg, chunked=True):
+    if chunked and self.chunkSize and not msg.isBrokerMessage() and Chunking.payloadSize(msg) > self.chunkSize:
+      IFLoop.getInstance().add_callback(ChunkedTransfer(self, msg, self.chunkSize, self.__abort).sendNext)
+    else:
+      self.__sendFrames(msg.getContent())
+
+  def __sendFrames(self, frames):
+    # The stream belongs to the loop thread. Frames from other threads are queued, and one callback on the loop sends all that are queued by then. With coalesce, frames from the loop thread are queued as well, so that the small messages of an iteration are bundled.
+    self.__sentCount += 1
+    if IFLoop.isLoopThread() and not self.coalesce:
+      if self.__submissions:
+        self.__flush()
+      IFLoop.send(self.__stream, frames)
+      return
+    with self.__submissionLock:
+      self.__submissions.append(frames)
+      if self.__flushScheduled:
+        return
+      self.__flushScheduled = True
+    IFLoop.getInstance().add_callback(self.__flush)
+
+  def __flush(self):
+    with self.__submissionLock:
+      submissions = self.__submissions
+      self.__submissions = []
+      self.__flushScheduled = False
+    if self.__bundling and len(submissions) > 1:
+      submissions = Bundling.bundle(submissions)
+    for frames in submissions:
+      IFLoop.send(self.__stream, frames)
+
+  def __abort(self, msg, error):
+    with self.__waitingMapLock:
+      entry = self.__waitingMap.pop(msg.idKey, None)
+      self.__clearExpiry(msg.idKey)
+      if entry is not None:
+        (futureEntry, runnable) = entry
+        futureEntry['error'] = f'Chunked transfer failed: {error}'
+        runnable()
+      else:
+        logging.warning('Chunked transfer of message %s failed: %s', msg.messageID, error)
+
+  def __negotiateBrokerProtocol(self):
+    # The probe is sent in IF2, so that the broker learns that the worker accepts IF2. A broker that only supports IF1 drops it silently, thus the probe expires like a heartbeat, which forgets it, and the worker keeps IF1.
+    future = self.send(Message.newBrokerMessage(Invocation.newRequest('listProtocols', [], {}), protocol=IFDefinition.PROTOCOL_IF2), timeout=IFDefinition.HEARTBEAT_LIVETIME / 5)
+
+    def onComplete():
+      if future.isSuccess() and str(IFDefinition.PROTOCOL_IF2, encoding='UTF-8') in future.result():
+        self.__brokerProtocol = IFDefinition.PROTOCOL_IF2
+
+    future.onComplete(onComplete)
+
+  def __negotiateBundling(self):
+    # The broker forgets the agreement when the worker is lost or the broker restarts, thus it is asked again with each heartbeat. A broker that does not support bundles fails the request.
+    future = self.asynchronousInvoker().enableBundling()
+
+    def onComplete():
+      self.__bundling = future.isSuccess()
+
+    future.onComplete(onComplete)
+
+  def isBundling(self):
+    """Check whether the broker has agreed to exchange bundles with the worker, see ``coalesce``.
+
+    Returns:
+        bool: True if the small messages are sent in bundles.
+    """
+    return self.__bundling
+
+  def serializationFor(self, target):
+    """Get the serialization to use when invoking a target.
+
+    The capabilities of a service are queried from the broker at the first invocation, which uses the default codec and protocol, and are refreshed every ``IFDefinition.HEARTBEAT_LIVETIME`` seconds. Later invocations use the codec with the highest priority that both sides accept.
+
+    Args:
+        target (str): The name of the service. None or '' for the broker.
+
+    Returns:
+        str: The name of the codec.
+    """
+    if not target:
+      return CodecRegistry.DEFAULT
+    return self.__capabilitiesOf(target)[0]
+
+  def protocolFor(self, target):
+    """Get the protocol to use when invoking a target. See ``serializationFor`` for the negotiation.
+
+    Args:
+        target (str): The name of the service. None or '' for the broker.
+
+    Returns:
+        bytes: The protocol.
+    """
+    if not target:
+      return self.__brokerProtocol
+    return self.__capabilitiesOf(target)[1]
+
+  def __capabilitiesOf(self, target):
+    if self.codecs == [CodecRegistry.DEFAULT] and IFDefinition.PROTOCOL_IF2 not in self.protocols:
+      return IFWorker.__DEFAULT_CAPABILITIES
+    capabilities = self.__capabilities.get(target)
+    if capabilities is None or time.time() - capabilities[2] > IFDefinition.HEARTBEAT_LIVETIME:
+      capabilities = (IFWorker.__DEFAULT_CAPABILITIES if capabilities is None else capabilities[:2]) + (time.time(),)
+      self.__capabilities[target] = capabilities
+      future = self.asynchronousInvoker().getServiceCapabilities(target)
+
+      def onComplete():
+        if future.isSuccess() and future.result():
+          remote = future.result()
+          protocol = IFDefinition.PROTOCOL
+          if IFDefinition.PROTOCOL_IF2 in self.protocols and str(IFDefinition.PROTOCOL_IF2, encoding='UTF-8') in remote.get('Protocols', []):
+            protocol = IFDefinition.PROTOCOL_IF2
+          self.__capabilities[target] = (CodecRegistry.choose(self.codecs, remote.get('Codecs')), protocol, time.time())
+
+      future.onComplete(onComplete)
+    return capabilities
+
   def toMessageInvoker(self, target=None):
     """Create a invoker that generate Message objects only, without sending.
     
@@ -133,11 +781,15 @@ class IFWorker:
     """
     return DynamicRemoteObject(None, toMessage=True, blocking=False, target=target, timeout=None)
 
-  def asynchronousInvoker(self, target=None):
+  def asynchronousInvoker(self, target=None, compression=None, timeout=None, retries=0, hedge=None):
     """Create a non-blocking invoker.
 
     Args:
         target (str): The target of the invoker.
+        compression (str): The compression algorithm for this invoker. None to follow the worker, False to disable.
+        timeout (float): The timeout of the invocations in seconds, after which the futures are completed with a ``'TIMEOUT'`` error. None for no timeout.
+        retries (int): The number of times an invocation is retried after its timeout. The invocations are sent as idempotent, see ``sendIdempotent``.
+        hedge (bool or float): If given, a duplicate of an invocation is sent after this delay in seconds, or after ``hedgeDelayFor(target)`` if True, and the first response is taken. The invocations are sent as idempotent, see ``sendIdempotent``.
     
     Returns:
         AsyncRemoteObject: The invoker.
@@ -145,29 +797,94 @@ class IFWorker:
     Deprecated:
         This method is deprecated. Remove it in the future. Use asyncInvoker instead.
     """
-    return DynamicRemoteObject(self, toMessage=False, blocking=False, target=target, timeout=None)
+    return DynamicRemoteObject(self, toMessage=False, blocking=False, target=target, timeout=timeout, compression=compression, retries=retries, hedge=hedge)
 
-  def asyncInvoker(self, target=None):
+  def asyncInvoker(self, target=None, compression=None, timeout=None, retries=0, hedge=None):
     """Create an async invoker.
     
     Args:
         target (str): The target of the invoker.
+        compression (str): The compression algorithm for this invoker. None to follow the worker, False to disable.
+        timeout (float): The timeout of the invocations in seconds, after which ``IFException('TIMEOUT')`` is raised and the target is asked to abort the request. None for no timeout.
+        retries (int): The number of times an invocation is retried after its timeout, see ``asynchronousInvoker``.
+        hedge (bool or float): The delay of hedging the invocations, see ``asynchronousInvoker``.
         
     Returns:
         AsyncRemoteObject: The invoker.
     """
-    return AsyncRemoteObject(self, target=target, timeout=30)
+    return AsyncRemoteObject(self, target=target, timeout=timeout, compression=compression, retries=retries, hedge=hedge)
 
-  def blockingInvoker(self, target=None, timeout=None):
+  def blockingInvoker(self, target=None, timeout=None, compression=None, retries=0, hedge=None):
     """Create a blocking invoker.
     
     Args:
         target (str): The target of the invoker.
+        compression (str): The compression algorithm for this invoker. None to follow the worker, False to disable.
+        retries (int): The number of times an invocation is retried after its timeout, see ``asynchronousInvoker``.
+        hedge (bool or float): The delay of hedging the invocations, see ``asynchronousInvoker``.
         
     Returns:
         DynamicRemoteObject: The invoker.
     """
-    return DynamicRemoteObject(self, toMessage=False, blocking=True, target=target, timeout=timeout)
+    return DynamicRemoteObject(self, toMessage=False, blocking=True, target=target, timeout=timeout, compression=compression, retries=retries, hedge=hedge)
+
+  def batch(self, target=None, concurrent=False, timeout=None, compression=None):
+    """Create a batch invoker, which packs the calls to a target into one message.
+
+    Calls on the batch invoker are recorded and return ``InvokeFuture`` objects. The calls are sent in one request when the batch is submitted, and the results of all the calls come back in one response. Used as a context manager, the batch is submitted on exit and waited for::
+
+      with worker.batch('Device') as batch:
+        futures = [batch.readChannel(i) for i in range(16)]
+      values = [future.result() for future in futures]
+
+    Args:
+        target (str): The target of the invoker. None or '' for the broker.
+        concurrent (bool): If True, the target awaits the coroutine functions among the calls concurrently. Otherwise, the calls are performed in order.
+        timeout (float): The timeout for waiting the batch on exit of the context.
+        compression (str): The compression algorithm for this invoker. None to follow the worker, False to disable.
+
+    Returns:
+        BatchInvoker: The invoker.
+    """
+    return BatchInvoker(self, target, concurrent, self.timeout if timeout is None else timeout, compression)
+
+  def publish(self, topic, data):
+    """Publish data to a topic, see ``PubSub``. The publication is sent to the broker once, and is delivered to the subscribers of the topic by the broker. Nothing is responded.
+
+    Args:
+        topic (str): The topic.
+        data (object): The data to publish.
+
+    Returns:
+        None
+    """
+    self.__sendFrames(Message.newPublishMessage(topic, data, CodecRegistry.DEFAULT, self.compression, self.compressionThreshold).getContent())
+
+  def subscribe(self, topic, callback, highWaterMark=None):
+    """Subscribe to the topics that start with a prefix.
+
+    Args:
+        topic (str): The prefix of the topics. '' for all topics.
+        callback (function): Called as ``callback(topic, data)`` for each publication, in the loop of the worker. If it is a coroutine function, the publication is acknowledged after it is awaited.
+        highWaterMark (int): The maximum number of publications delivered to the worker but not yet handled. The broker drops the publications beyond it for this worker. ``PubSub.HIGH_WATER_MARK`` if None.
+
+    Returns:
+        None
+    """
+    self.__subscriptions[topic] = callback
+    self.blockingInvoker(timeout=self.timeout).subscribe(topic, highWaterMark)
+
+  def unsubscribe(self, topic):
+    """Unsubscribe from a prefix of topics.
+
+    Args:
+        topic (str): The prefix that was subscribed to.
+
+    Returns:
+        None
+    """
+    self.__subscriptions.pop(topic, None)
+    self.blockingInvoker(timeout=self.timeout).unsubscribe(topic)
 
   @classmethod
   def start(cls):
@@ -176,6 +893,15 @@ class IFWorker:
   def __getattr__(self, item):
     return InvokeTarget(self, item)
 
+  def _defaultInvoker(self, target):
+    # The invokers of ``worker.Service.function(...)`` are cached with their stubs, as long as the settings of the worker are unchanged.
+    key = (target, self.blocking, self.timeout, self.compression, self.compressionThreshold)
+    invoker = self.__defaultInvokers.get(key)
+    if invoker is None:
+      invoker = self.blockingInvoker(target, self.timeout) if self.blocking else self.asynchronousInvoker(target)
+      self.__defaultInvokers[key] = invoker
+    return invoker
+
   def close(self):
     """Close the worker. If the worker is a service, it will be unregistered.
     
@@ -184,6 +910,9 @@ class IFWorker:
     """
     self.__isService = False
     self.unregister()
+    for pool in self.__pools.values():
+      pool.shutdown(wait=False)
+    self.__pools = {}
 
   def bindService(self, serviceName, serviceObject, interfaces=None):
     """Bind the worker as a service.
@@ -201,9 +930,44 @@ class IFWorker:
     self.__isService = serviceName is not None
     self.__serviceName = serviceName
     self.__serviceObject = serviceObject
+    self.__dispatcher = Dispatcher(serviceObject)
     self.__interfaces = [] if interfaces is None else interfaces
 
 
+class ChunkedTransfer:
+  """Send a large message in chunks, see ``Chunking``. The chunks are sent on the loop, with at most ``Chunking.WINDOW`` of them unacknowledged."""
+
+  def __init__(self, worker, message, chunkSize, onFailure):
+    self.__worker = worker
+    self.__message = message
+    self.__chunks = Chunking.split(message, chunkSize)
+    self.__onFailure = onFailure
+    self.__inFlight = 0
+    self.__failed = False
+
+  def sendNext(self):
+    """Send chunks until the window is full or all chunks are sent."""
+    message = self.__message
+    while not self.__failed and self.__inFlight < Chunking.WINDOW:
+      invocation = next(self.__chunks, None)
+      if invocation is None:
+        return
+      self.__inFlight += 1
+      chunk = Message.newMessage(message.getDistributingMode(), message.distributingAddress, invocation, protocol=message.getProtocol())
+      future = self.__worker.send(chunk, chunked=False)
+      future.onComplete(lambda future=future: IFLoop.getInstance().add_callback(self.__onAck, future))
+
+  def __onAck(self, future):
+    self.__inFlight -= 1
+    if self.__failed:
+      return
+    if not future.isSuccess():
+      self.__failed = True
+      self.__onFailure(self.__message, future.exception())
+      return
+    self.sendNext()
+
+
 class InvokeTarget:
   def __init__(self, worker, item):
     self.__worker = worker
@@ -211,18 +975,60 @@ class InvokeTarget:
 
   def __getattr__(self, item):
     item = '{}'.format(item)
-    return self.__defaultInvoker(self.__name).__getattr__(item)
+    return self.__worker._defaultInvoker(self.__name).__getattr__(item)
 
   def __call__(self, *args, **kwargs):
-    invoker = self.__defaultInvoker('')
+    invoker = self.__worker._defaultInvoker('')
     func = invoker.__getattr__(self.__name)
     return func(*args, **kwargs)
 
-  def __defaultInvoker(self, target):
-    if self.__worker.blocking:
-      return self.__worker.blockingInvoker(target, self.__worker.timeout)
+
+class InvokeStub:
+  """A function of a target, cached by an invoker. The frames that do not change from call to call are encoded once in a ``MessageTemplate``, which is rebuilt only when the negotiated serialization or protocol of the target changes."""
+
+  def __init__(self, worker, target, function, compression, compressionThreshold, timeout, send=None):
+    self.__worker = worker
+    self.__target = target if target else None
+    self.__function = function
+    self.__compression = compression
+    self.__compressionThreshold = compressionThreshold
+    self.__timeout = timeout
+    self.__send = send
+    self.__template = None
+
+  def newMessage(self, args, kwargs, idempotencyKey=None):
+    """Create the message of a call.
+
+    Args:
+        args (list): The arguments of the call.
+        kwargs (dict): The keyword arguments of the call.
+        idempotencyKey (bytes): The idempotency key of the call, see ``Idempotency``. None if the call is not idempotent.
+
+    Returns:
+        Message: The message.
+    """
+    compression = None
+    if kwargs and Compression.KEYWORD in kwargs:
+      # The keyword overrides the compression of the invoker for this call, see ``Compression``. The kwargs are not modified, since they are reused by retries.
+      kwargs = dict(kwargs)
+      compression = kwargs.pop(Compression.KEYWORD)
+    if self.__worker is None:
+      serialization, protocol = CodecRegistry.DEFAULT, IFDefinition.PROTOCOL
     else:
-      return self.__worker.asynchronousInvoker(target)
+      serialization, protocol = self.__worker.serializationFor(self.__target), self.__worker.protocolFor(self.__target)
+    template = self.__template
+    if template is None or template.serialization != serialization or template.protocol != protocol:
+      # Only the targets that accept IF2 are known to parse a timeout in the serialization frame, see ``Expiry``. The others are expired by the worker alone.
+      timeout = self.__timeout if protocol == IFDefinition.PROTOCOL_IF2 else None
+      if self.__target is None:
+        template = Message.newTemplate(IFDefinition.DISTRIBUTING_MODE_BROKER, b'', serialization, self.__compression, self.__compressionThreshold, protocol, timeout)
+      else:
+        template = Message.newTemplate(IFDefinition.DISTRIBUTING_MODE_SERVICE, self.__target, serialization, self.__compression, self.__compressionThreshold, protocol, timeout)
+      self.__template = template
+    return template.newMessage(Invocation.newRequest(self.__function, args, kwargs), idempotencyKey, compression)
+
+  def __call__(self, *args, **kwargs):
+    return self.__send(self, args, kwargs)
 
 
 class RemoteObject(object):
@@ -234,72 +1040,451 @@ class RemoteObject(object):
 
 
 class DynamicRemoteObject(RemoteObject):
-  def __init__(self, worker, toMessage, blocking, target, timeout):
+  def __init__(self, worker, toMessage, blocking, target, timeout, compression=None, retries=0, hedge=None):
     super(DynamicRemoteObject, self).__init__(target)
     self.__worker = worker
     self.__target = target
     self.__toMessage = toMessage
     self.__blocking = blocking
     self.__timeout = timeout
+    self.__retries = retries
+    self.__hedge = hedge
+    self.__compression = (None if worker is None else worker.compression) if compression is None else compression
+    self.__compressionThreshold = None if worker is None else worker.compressionThreshold
+    self.__stubs = {}
     self.name = target
 
   def __getattr__(self, item):
     item = f'{item}'
+    stub = self.__stubs.get(item)
+    if stub is None:
+      stub = self.__stubs[item] = InvokeStub(self.__worker, self.__target, item, self.__compression, self.__compressionThreshold, self.__timeout, self.__invoke)
+    return stub
 
-    def invoke(*args, **kwargs):
-      invocation = Invocation.newRequest(item, args, kwargs)
-      if self.__target == '' or self.__target is None:
-        message = Message.newBrokerMessage(invocation)
-      else:
-        message = Message.newServiceMessage(self.__target, invocation)
-      if self.__toMessage:
-        return message
-      elif self.__blocking:
-        return self.__worker.send(message).sync(self.__timeout)
-      else:
-        return self.__worker.send(message)
-
-    return invoke
+  def __invoke(self, stub, args, kwargs):
+    if self.__toMessage:
+      return stub.newMessage(args, kwargs)
+    if self.__retries or self.__hedge:
+      future = self.__worker.sendIdempotent(lambda key: stub.newMessage(args, kwargs, key), self.__target, self.__timeout, self.__retries, self.__hedge)
+      return future.sync() if self.__blocking else future
+    message = stub.newMessage(args, kwargs)
+    if self.__blocking:
+      return self.__worker.send(message, timeout=self.__timeout).sync(self.__timeout)
+    else:
+      return self.__worker.send(message, timeout=self.__timeout)
 
   def __str__(self):
     return f"DynamicRemoteObject[{self.name}]"
 
 
 class AsyncRemoteObject(RemoteObject):
-  def __init__(self, worker, target, timeout):
+  def __init__(self, worker, target, timeout, compression=None, retries=0, hedge=None):
     super(AsyncRemoteObject, self).__init__(target)
     self.__worker = worker
     self.__target = target
     self._timeout = timeout
+    self.__retries = retries
+    self.__hedge = hedge
+    self.__compression = worker.compression if compression is None else compression
+    self.__stubs = {}
     self.name = target
 
   def __getattr__(self, item):
     item = f'{item}'
+    invoke = self.__stubs.get(item)
+    if invoke is not None:
+      return invoke
+    stub = InvokeStub(self.__worker, self.__target, item, self.__compression, self.__worker.compressionThreshold, self._timeout)
 
     async def invoke(*args, **kwargs):
-      invocation = Invocation.newRequest(item, args, kwargs)
-      if self.__target == '' or self.__target is None:
-        message = Message.newBrokerMessage(invocation)
-      else:
-        message = Message.newServiceMessage(self.__target, invocation)
-      invokeFuture = self.__worker.send(message)
-      queue = asyncio.Queue()
-      tobeAwait = queue.get()
+      if self.__retries or self.__hedge:
+        return await self.__worker.sendIdempotent(lambda key: stub.newMessage(args, kwargs, key), self.__target, self._timeout, self.__retries, self.__hedge)
+      message = stub.newMessage(args, kwargs)
+      reserved = not message.isBrokerMessage() and await self.__worker.reserve()
+      future = self.__worker.sendAsync(message, reserved=reserved)
+      if self._timeout is None:
+        return await future
+      try:
+        return await asyncio.wait_for(future, self._timeout)
+      except asyncio.TimeoutError:
+        raise IFException('TIMEOUT')
 
-      def onComplete():
-        queue.put_nowait(invokeFuture)
+    self.__stubs[item] = invoke
+    return invoke
 
-      invokeFuture.onComplete(onComplete)
-      invokeFuture = await tobeAwait
-      if invokeFuture.isSuccess():
-        return invokeFuture.result()
-      else:
-        raise invokeFuture.exception()
+  def __str__(self):
+    return f"AsyncRemoteObject[{self.name}]"
+
+
+class BatchInvoker(RemoteObject):
+  def __init__(self, worker, target, concurrent, timeout, compression=None):
+    super(BatchInvoker, self).__init__(target)
+    self.__worker = worker
+    self.__target = target
+    self.__concurrent = concurrent
+    self.__timeout = timeout
+    self.__compression = worker.compression if compression is None else compression
+    self.__calls = []
+    self.__entries = []
+    self.__future = None
+
+  def __getattr__(self, item):
+    item = f'{item}'
+
+    def invoke(*args, **kwargs):
+      if self.__future is not None:
+        raise IFException('Batch already submitted.')
+      (future, onFinish, resultMap) = InvokeFuture.newFuture()
+      self.__calls.append((item, args, kwargs))
+      self.__entries.append((resultMap, onFinish))
+      return future
 
     return invoke
 
+  def submit(self):
+    """Send the recorded calls in one request.
+
+    Returns:
+        InvokeFuture: The future of the batch, whose result is the list of ``[result, error]`` pairs. The futures of the calls are completed before it.
+    """
+    if self.__future is not None:
+      raise IFException('Batch already submitted.')
+    invocation = Invocation.newBatchRequest(self.__calls, self.__concurrent)
+    if self.__target == '' or self.__target is None:
+      message = Message.newBrokerMessage(invocation, 'Msgpack', self.__compression, self.__worker.compressionThreshold, self.__worker.protocolFor(None))
+    else:
+      message = Message.newServiceMessage(self.__target, invocation, self.__worker.serializationFor(self.__target), self.__compression, self.__worker.compressionThreshold, self.__worker.protocolFor(self.__target))
+    (future, onFinish, resultMap) = InvokeFuture.newFuture()
+    batchFuture = self.__worker.send(message, timeout=self.__timeout)
+
+    def onComplete():
+      if batchFuture.isSuccess():
+        for (entry, onCallFinish), (result, error) in zip(self.__entries, batchFuture.result()):
+          if error is None:
+            entry['result'] = result
+          else:
+            entry['error'] = error
+          onCallFinish()
+        resultMap['result'] = batchFuture.result()
+      else:
+        for entry, onCallFinish in self.__entries:
+          entry['error'] = batchFuture.exception().remoteTraceback
+          onCallFinish()
+        resultMap['error'] = batchFuture.exception().remoteTraceback
+      onFinish()
+
+    batchFuture.onComplete(onComplete)
+    self.__future = future
+    return future
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, tb):
+    if excType is None:
+      self.submit().sync(self.__timeout)
+
   def __str__(self):
-    return f"AsyncRemoteObject[{self.name}]"
+    return f"BatchInvoker[{self.name}]"
+
+
+class RemoteStream:
+  """An iterator over the items streamed by a remote generator, see ``Streaming``.
+
+  It is the result of invoking a service method that returns a generator or an async generator. Iterate it with ``for`` to block for each item, or with ``async for`` in a coroutine. Items are yielded in order. Credits are granted to the producer as the items are consumed, so that at most ``Streaming.WINDOW`` items are buffered. An error raised by the remote generator is raised as ``IFRemoteException`` after the items before it. Call ``close``, or use it as a context manager, to stop the remote generator early.
+  """
+
+  def __init__(self, control, timeout=None):
+    self.__control = control
+    self.__items = {}
+    self.__next = 0
+    self.__count = None
+    self.__received = 0
+    self.__closed = False
+    self.__error = None
+    self.__condition = threading.Condition()
+    self.__waiter = None
+    self.timeout = timeout
+
+  def _put(self, index, item):
+    with self.__condition:
+      if not self.__closed:
+        self.__items[index] = item
+      self.__received += 1
+      self.__notify()
+
+  def _end(self, count):
+    with self.__condition:
+      self.__count = count
+      self.__notify()
+
+  def _fail(self, error):
+    with self.__condition:
+      self.__error = error
+      self.__notify()
+
+  def _isComplete(self):
+    return self.__count is not None and self.__received >= self.__count
+
+  def __notify(self):
+    self.__condition.notify_all()
+    waiter = self.__waiter
+    if waiter is not None:
+      self.__waiter = None
+      waiter.get_loop().call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None))
+
+  def __isReady(self):
+    return self.__closed or self.__next in self.__items or self.__error is not None or (self.__count is not None and self.__next >= self.__count)
+
+  def __take(self, stopIteration):
+    if self.__closed:
+      raise stopIteration()
+    if self.__next in self.__items:
+      item = self.__items.pop(self.__next)
+      self.__next += 1
+      if self.__next % (Streaming.WINDOW // 2) == 0 and self.__count is None and self.__error is None:
+        self.__control(Streaming.FUNCTION_CREDIT, [Streaming.WINDOW // 2])
+      return item
+    if self.__error is not None:
+      raise IFRemoteException(self.__error)
+    raise stopIteration()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    with self.__condition:
+      if not self.__condition.wait_for(self.__isReady, self.timeout):
+        raise IFException('TIMEOUT')
+      return self.__take(StopIteration)
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    while True:
+      with self.__condition:
+        if self.__isReady():
+          return self.__take(StopAsyncIteration)
+        waiter = asyncio.get_running_loop().create_future()
+        self.__waiter = waiter
+      await asyncio.wait_for(waiter, self.timeout)
+
+  def close(self):
+    """Stop the remote generator if it is still producing."""
+    with self.__condition:
+      if self.__count is None and self.__error is None and not self.__closed:
+        self.__control(Streaming.FUNCTION_CANCEL, [])
+      self.__closed = True
+      self.__items.clear()
+      self.__notify()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, tb):
+    self.close()
+
+
+class IdempotentCall:
+  """An idempotent request, retried after timeouts and hedged by duplicates, see ``IFWorker.sendIdempotent``. The attempts are handled on the loop, each with its own timer of the timeout."""
+
+  def __init__(self, worker, newMessage, target, timeout, retries, hedge):
+    self.__worker = worker
+    self.__newMessage = newMessage
+    self.__target = target
+    self.__timeout = timeout
+    self.__retries = retries
+    self.__hedge = hedge
+    self.__key = Idempotency.newKey()
+    self.__attempts = {}
+    self.__lock = threading.Lock()
+    (self.__future, self.__onFinish, self.__resultMap) = InvokeFuture.newFuture()
+    self.__future._setCanceller(lambda error: self.__finish(None, error))
+
+  def start(self):
+    """Send the first attempt on the loop, and schedule the hedged duplicate.
+
+    Returns:
+        InvokeFuture: The future of the request.
+    """
+    if IFLoop.isLoopThread():
+      self.__begin()
+    else:
+      IFLoop.getInstance().add_callback(self.__begin)
+    return self.__future
+
+  def __begin(self):
+    self.__attempt()
+    if self.__hedge:
+      delay = self.__worker.hedgeDelayFor(self.__target) if self.__hedge is True else self.__hedge
+      IFLoop.getInstance().call_later(delay, self.__hedgeAttempt)
+
+  def __attempt(self):
+    # The attempt is sent without a timeout of the worker. Its own timer cancels it and sends the retry at once.
+    attempt = self.__worker.send(self.__newMessage(self.__key))
+    timer = None if self.__timeout is None else IFLoop.getInstance().call_later(self.__timeout, self.__onTimeout, attempt)
+    self.__attempts[attempt] = (time.time(), timer)
+    attempt.onComplete(lambda: IFLoop.getInstance().add_callback(self.__onAttempt, attempt))
+
+  def __hedgeAttempt(self):
+    if not self.__future.isDone():
+      self.__attempt()
+
+  def __onTimeout(self, attempt):
+    if self.__attempts.pop(attempt, None) is None or self.__future.isDone():
+      return
+    attempt.cancel('TIMEOUT')
+    self.__onFailure('TIMEOUT')
+
+  def __onAttempt(self, attempt):
+    entry = self.__attempts.pop(attempt, None)
+    if entry is None or self.__future.isDone():
+      return
+    (sentTime, timer) = entry
+    if timer is not None:
+      IFLoop.getInstance().remove_timeout(timer)
+    if attempt.isSuccess():
+      self.__worker._recordLatency(self.__target, time.time() - sentTime)
+      self.__finish((attempt.result(), attempt.warning()))
+    else:
+      self.__onFailure(attempt.exception().remoteTraceback)
+
+  def __onFailure(self, error):
+    if self.__attempts:
+      # Another attempt may still succeed.
+      return
+    if self.__retries > 0 and self.__timedOut(error):
+      self.__retries -= 1
+      self.__attempt()
+    else:
+      self.__finish(None, error)
+
+  @classmethod
+  def __timedOut(cls, error):
+    # The target may expire the request before the requester does, and responds with an error.
+    return error == 'TIMEOUT' or error.rstrip().endswith(Expiry.EXPIRED)
+
+  def __finish(self, outcome, error=None):
+    with self.__lock:
+      if self.__future.isDone() or 'error' in self.__resultMap or 'result' in self.__resultMap:
+        return False
+      if outcome is None:
+        self.__resultMap['error'] = error
+      else:
+        self.__resultMap['result'] = outcome[0]
+        if outcome[1] is not None:
+          self.__resultMap['warning'] = outcome[1]
+    self.__onFinish()
+    IFLoop.getInstance().add_callback(self.__cancelAttempts)
+    return True
+
+  def __cancelAttempts(self):
+    attempts, self.__attempts = self.__attempts, {}
+    for attempt, (sentTime, timer) in attempts.items():
+      if timer is not None:
+        IFLoop.getInstance().remove_timeout(timer)
+      attempt.cancel()
+
+
+class InFlightWindow:
+  """A limit of the requests in flight, shared by threads and coroutines.
+
+  A slot is taken for each request, and is released when the request is finished by its response, its cancellation or its failure. Threads block in ``acquire`` and coroutines await ``acquireAsync`` while all the slots are taken. The waiting coroutines are woken one at a time.
+  Blocked threads are woken once per iteration of the loop, after the responses handled in it have released their slots. Waking a thread for every released slot would let it send one request per wake-up, at the cost of a thread switch each, and would break the bundles of ``coalesce`` into single messages.
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.__inFlight = 0
+    self.__blocked = 0
+    self.__notifying = False
+    self.__condition = threading.Condition()
+    self.__waiters = deque()
+
+  @property
+  def inFlight(self):
+    """The number of slots taken."""
+    return self.__inFlight
+
+  def acquire(self, timeout=None, force=False):
+    """Take a slot, waiting until one is free.
+
+    Args:
+        timeout (float): The maximum time to wait in seconds. None to wait forever.
+        force (bool): If True, the slot is taken at once even if the window is full, e.g., on the loop thread, which must not be blocked.
+
+    Returns:
+        bool: True if a slot is taken, False on timeout.
+    """
+    with self.__condition:
+      if not force and self.__inFlight >= self.size:
+        self.__blocked += 1
+        try:
+          if not self.__condition.wait_for(lambda: self.__inFlight < self.size, timeout):
+            return False
+        finally:
+          self.__blocked -= 1
+      self.__inFlight += 1
+      return True
+
+  async def acquireAsync(self):
+    """Take a slot, awaiting until one is free."""
+    while True:
+      with self.__condition:
+        if self.__inFlight < self.size:
+          self.__inFlight += 1
+          return
+        waiter = asyncio.get_running_loop().create_future()
+        self.__waiters.append(waiter)
+      try:
+        await waiter
+      except asyncio.CancelledError:
+        # A wake-up is passed on if it was sent to a waiter that is cancelled.
+        if waiter.done() and not waiter.cancelled():
+          self.__wakeOne()
+        raise
+
+  def release(self):
+    """Release a slot."""
+    with self.__condition:
+      self.__inFlight -= 1
+      notify = self.__blocked > 0 and not self.__notifying
+      if notify:
+        self.__notifying = True
+    if notify:
+      IFLoop.getInstance().add_callback(self.__notifyBlocked)
+    self.__wakeOne()
+
+  def releasing(self, onFinish):
+    """Wrap a callback to release a slot after it is called."""
+
+    def wrapped():
+      try:
+        onFinish()
+      finally:
+        self.release()
+
+    return wrapped
+
+  def __notifyBlocked(self):
+    with self.__condition:
+      self.__notifying = False
+      self.__condition.notify(self.size - self.__inFlight)
+
+  def __wakeOne(self):
+    with self.__condition:
+      while self.__waiters:
+        waiter = self.__waiters.popleft()
+        if not waiter.done():
+          waiter.get_loop().call_soon_threadsafe(self.__wake, waiter)
+          return
+
+  def __wake(self, waiter):
+    if waiter.done():
+      self.__wakeOne()
+    else:
+      waiter.set_result(None)
 
 
 class InvokeFuture:
@@ -317,6 +1502,8 @@ class InvokeFuture:
     self.__metux = threading.Lock()
     self.__resultMap = {}
     self.__awaitSemaphore = threading.Semaphore(0)
+    self.__canceller = None
+    self.__expired = False
 
   def isDone(self):
     return self.__done
@@ -340,6 +1527,36 @@ class InvokeFuture:
       self.__onComplete()
     self.__metux.release()
 
+  def cancel(self, error='Cancelled'):
+    """Cancel the invocation if it is not done, see ``Expiry``. The future is completed with the error, and the target is asked to abort the request.
+
+    Args:
+        error (str): The error to complete the future with.
+
+    Returns:
+        bool: True if the invocation is cancelled.
+    """
+    if self.__done or self.__canceller is None:
+      return False
+    return self.__canceller(error)
+
+  def _setCanceller(self, canceller):
+    self.__canceller = canceller
+
+  def __await__(self):
+    # The future is awaited by a future of the running loop, which is resolved by the callback of completion.
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    self.onComplete(lambda: loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None)))
+    try:
+      yield from waiter.__await__()
+    except asyncio.CancelledError:
+      self.cancel()
+      raise
+    if self.isSuccess():
+      return self.__result
+    raise self.__exception
+
   def waitFor(self, timeout=None):
     # For Python 3 only.
     if self.__awaitSemaphore.acquire(True, timeout):
@@ -352,6 +1569,9 @@ class InvokeFuture:
     if self.waitFor(timeout):
       if self.isSuccess():
         return self.__result
+      if self.__expired:
+        # Expired by the timer of the worker, which races with the timeout of the wait.
+        raise IFException('TIMEOUT')
       if isinstance(self.__exception, BaseException):
         raise self.__exception
       raise IFException('Error state in InvokeFuture.')
@@ -365,6 +1585,7 @@ class InvokeFuture:
       self.__warning = self.__resultMap['warning']
     if self.__resultMap.__contains__('error'):
       self.__exception = IFRemoteException(self.__resultMap['error'])
+      self.__expired = self.__resultMap.get('cancelled', False) and self.__resultMap['error'] == 'TIMEOUT'
     if self.__onComplete is not None:
       self.__onComplete()
     self.__awaitSemaphore.release()
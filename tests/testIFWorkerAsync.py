@@ -4,9 +4,10 @@ import unittest
 import time
 from interactionfreepy import IFBroker
 from interactionfreepy import IFWorker
-from interactionfreepy import Message, IFException
+from interactionfreepy import Message, IFException, IFRemoteException, IFLoop
 from tornado.ioloop import IOLoop
 import threading
+import asyncio
 from asyncio import Queue
 from wrapt_timeout_decorator import timeout
 from tests.defines import Defines
@@ -38,6 +39,43 @@ class AsyncIFWorkerTest(unittest.TestCase):
 
         IOLoop.current().add_callback(test)
 
+    @timeout(Defines.timeout)
+    def testConcurrentInvocationsAndTimeouts(self):
+        class Target:
+            def __init__(self):
+                self.aborted = 0
+
+            def echo(self, value):
+                return value
+
+            async def slow(self):
+                try:
+                    await asyncio.sleep(2)
+                except asyncio.CancelledError:
+                    self.aborted += 1
+                    raise
+
+        target = Target()
+        service = IFWorker(AsyncIFWorkerTest.brokerAddress, 'AsyncTarget', target)
+        client = IFWorker(AsyncIFWorkerTest.brokerAddress)
+
+        async def test():
+            invoker = client.asyncInvoker('AsyncTarget')
+            results = await asyncio.gather(*[invoker.echo(i) for i in range(5000)])
+            self.assertEqual(results, list(range(5000)))
+            with self.assertRaises(IFRemoteException):
+                await invoker.missing()
+            with self.assertRaises(IFException):
+                await client.asyncInvoker('AsyncTarget', timeout=0.2).slow()
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(invoker.slow(), 0.2)
+            await asyncio.sleep(0.2)
+
+        asyncio.run_coroutine_threadsafe(test(), IFLoop.getInstance().asyncio_loop).result(10)
+        self.assertEqual(target.aborted, 2)
+        service.close()
+        client.close()
+
     def tearDown(self):
         pass
 
@@ -2,8 +2,11 @@ __author__ = 'Hwaipy'
 
 import unittest
 import time
+import os
+import tempfile
 from interactionfreepy import IFBroker
 from interactionfreepy import IFWorker
+from interactionfreepy.core import IFAddress
 from wrapt_timeout_decorator import timeout
 from tests.defines import Defines
 
@@ -40,6 +43,23 @@ class InitBrokerAndWorkerTest(unittest.TestCase):
         self.assertRaises(ValueError, lambda: IFBroker('udp://127.0.0.1'))
         self.assertRaises(ValueError, lambda: IFBroker('udp://127.0.0.1:1456'))
 
+    @timeout(Defines.timeout)
+    def testTransports(self):
+        self.assertEqual(IFAddress.parseAddress('ipc:///tmp/broker'), ['ipc', '/tmp/broker', None])
+        self.assertEqual(IFAddress.parseAddress('inproc://broker'), ['inproc', 'broker', None])
+        self.assertEqual(IFAddress.toEndpoint(IFAddress.parseAddress('127.0.0.1')), 'tcp://127.0.0.1:1061')
+        self.assertRaises(ValueError, lambda: IFBroker('ipc://'))
+        self.assertRaises(ValueError, lambda: IFBroker([]))
+
+        ipcAddress = 'ipc://' + os.path.join(tempfile.mkdtemp(), 'broker')
+        IFBroker(['tcp://127.0.0.1:1104', ipcAddress, 'inproc://IFBrokerTest'])
+        worker = IFWorker('inproc://IFBrokerTest', 'W5', '')
+        for address in ['127.0.0.1:1104', ipcAddress, 'inproc://IFBrokerTest']:
+            client = IFWorker(address)
+            self.assertEqual(client.listServiceNames(), ['W5'])
+            client.close()
+        worker.unregister()
+
     def tearDown(self):
         pass
 
@@ -2,7 +2,10 @@ __author__ = 'Hwaipy'
 
 import sys
 import unittest
-from interactionfreepy import Invocation, IFException
+import threading
+import asyncio
+from interactionfreepy import Invocation, IFException, Message
+from interactionfreepy.core import Dispatcher
 from wrapt_timeout_decorator import timeout
 from tests.defines import Defines
 
@@ -79,6 +82,118 @@ class InvocationTest(unittest.TestCase):
         self.assertEqual(m3.getResult(), None)
         self.assertEqual(m3.getResponseID(), b'0x01')
 
+    @timeout(Defines.timeout)
+    def testPositionalEnvelope(self):
+        request = Invocation.newRequest('heartbeat', [], {})
+        self.assertEqual(Invocation.toPositional(InvocationTest.sampleResponseContent), [1, 'ID1', [1, 'Res'], 'Something not good'])
+        self.assertEqual(Invocation.toPositional(InvocationTest.sampleErrorContent), [2, b'0x01', 'Fatal Error!', 'Something not good', {Invocation.KeyResult: [1, 'Res']}])
+        self.assertLess(len(request.serialize(protocol=b'IF2')), len(request.serialize()) / 4)
+        m1 = Invocation.deserialize(request.serialize(protocol=b'IF2'), protocol=b'IF2')
+        self.assertTrue(m1.isRequest())
+        self.assertEqual(m1.getFunction(), 'heartbeat')
+        self.assertEqual(m1.getArguments(), [])
+        self.assertEqual(m1.getKeywordArguments(), {})
+        m2 = Invocation.deserialize(Invocation.newResponse(3, False).serialize(protocol=b'IF2'), protocol=b'IF2')
+        self.assertTrue(m2.isResponse())
+        self.assertFalse(m2.isError())
+        self.assertEqual(m2.getResponseID(), 3)
+        self.assertEqual(m2.getResult(), False)
+        self.assertEqual(Invocation.toPositional({Invocation.KeyType: Invocation.ValueTypeRequest, Invocation.KeyFunciton: 'f', Invocation.KeyArguments: [0], Invocation.KeyKeyworkArguments: {}}), [0, 'f', [0]])
+        self.assertEqual(Invocation.toPositional({Invocation.KeyType: Invocation.ValueTypeResponse, Invocation.KeyRespopnseID: 1, Invocation.KeyResult: 0, Invocation.KeyWarning: ''}), [1, 1, 0, ''])
+        requestContent = {Invocation.KeyType: Invocation.ValueTypeRequest, Invocation.KeyFunciton: 'f', Invocation.KeyArguments: [0], Invocation.KeyKeyworkArguments: {'a': None}, 'Extra': 1}
+        for content in [InvocationTest.sampleResponseContent, InvocationTest.sampleErrorContent, requestContent, {'keyString': 'value1'}]:
+            self.assertEqual(Invocation.fromPositional(Invocation.toPositional(content)), content)
+
+    @timeout(Defines.timeout)
+    def testDispatcher(self):
+        class Target:
+            def __init__(self):
+                self.lookups = 0
+
+            def __getattribute__(self, name):
+                if name == 'add':
+                    object.__setattr__(self, 'lookups', object.__getattribute__(self, 'lookups') + 1)
+                return object.__getattribute__(self, name)
+
+            def add(self, a, b=1, *, c=0):
+                return a + b + c
+
+            def fail(self):
+                raise TypeError('takes 1 positional arguments but 3 were given')
+
+            async def later(self, value):
+                return value
+
+            def count(self, n):
+                yield from range(n)
+
+            async def cancelled(self):
+                raise asyncio.CancelledError()
+
+        def run(coroutine):
+            try:
+                coroutine.send(None)
+            except StopIteration as stop:
+                return stop.value
+            raise AssertionError('The coroutine is suspended.')
+
+        target = Target()
+        dispatcher = Dispatcher(target)
+        perform = lambda function, args, kwargs: run(Invocation.newRequest(function, args, kwargs).perform(dispatcher))
+        self.assertEqual(perform('add', [1], {}), 2)
+        self.assertEqual(perform('add', [1, 2], {'c': 3}), 6)
+        self.assertEqual(target.lookups, 1)
+        self.assertEqual(perform('later', ['v'], {}), 'v')
+        self.assertTrue(dispatcher.isSynchronous('add'))
+        self.assertFalse(dispatcher.isSynchronous('later'))
+        self.assertFalse(dispatcher.isSynchronous('absent'))
+        for (function, args, kwargs), error in [
+                (('add', [1, 2, 3], {}), 'Function [add] expects [2] arguments, but [3] were given.'),
+                (('add', [1], {'d': 1}), 'Keyword Argument [d] not availabel for function [add].'),
+                (('add', [], {'b': 1}), 'Argument [a] missing for function [add].'),
+                (('absent', [], {}), 'Function [absent] not available.')]:
+            with self.assertRaises(IFException) as context:
+                perform(function, args, kwargs)
+            self.assertEqual(str(context.exception), error)
+        self.assertRaises(TypeError, lambda: perform('fail', [], {}))
+        self.assertEqual(run(Invocation.newRequest('add', [], {'b': 2}).perform(target, 1)), 3)
+        with self.assertRaises(IFException) as context:
+            run(Invocation.newRequest('add', [2, 3], {}).perform(target, 1))
+        self.assertEqual(str(context.exception), 'Function [add] expects [1] arguments, but [2] were given.')
+        batch = Invocation.newBatchRequest([('add', [1], {}), ('count', [2], {}), ('absent', [], {})])
+        self.assertEqual(run(batch.perform(dispatcher)), [[2, None], [None, 'Function [count] returns a stream, which is not supported in a batch.'], [None, 'Function [absent] not available.']])
+        self.assertRaises(asyncio.CancelledError, lambda: run(Invocation.newBatchRequest([('add', [1], {}), ('cancelled', [], {})]).perform(dispatcher)))
+        performed = []
+
+        async def performer(invocation):
+            performed.append(invocation.getFunction())
+            return len(performed)
+
+        self.assertEqual(run(batch.perform(dispatcher, performer=performer)), [[1, None], [2, None], [3, None]])
+        self.assertEqual(performed, ['add', 'count', 'absent'])
+
+    @timeout(Defines.timeout)
+    def testMessageIDs(self):
+        ids = []
+
+        def build():
+            ids.extend([Message.newBrokerMessage(Invocation.newRequest('f', [], {})).idKey for i in range(2000)])
+
+        threads = [threading.Thread(target=build) for i in range(8)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        self.assertEqual(len(set(ids)), 16000)
+        self.assertTrue(all(isinstance(i, int) for i in ids))
+        self.assertEqual(Message.toIDKey('12'), 12)
+        self.assertEqual(Message.toIDKey(b'12'), 12)
+        self.assertEqual(Message.toIDKey(12), 12)
+        self.assertEqual(Message.toIDKey('ID1'), 'ID1')
+        message = Message.newBrokerMessage(Invocation.newRequest('f', [], {}), protocol=b'IF2')
+        self.assertEqual(message.replyID, int(message.messageID))
+        message = Message.newBrokerMessage(Invocation.newRequest('f', [], {}))
+        self.assertEqual(message.replyID, message.messageID)
+        self.assertIsInstance(message.replyID, str)
+
     def tearDown(self):
         pass
 
@@ -1,10 +1,15 @@
 __author__ = 'Hwaipy'
 
 import sys
+import array
 import unittest
 import msgpack
 from random import Random
-from interactionfreepy import Invocation
+from interactionfreepy import Invocation, IFException, Codec, CodecRegistry
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from wrapt_timeout_decorator import timeout
 from tests.defines import Defines
 
@@ -125,6 +130,91 @@ class InvocationSerializationTest(unittest.TestCase):
         self.assertEqual(unpacker.__next__(), InvocationSerializationTest.map)
         self.assertNotEqual(unpacker.__next__(), InvocationSerializationTest.map)
 
+    @timeout(Defines.timeout)
+    def testOutOfBandBuffers(self):
+        largeArray = array.array('d', range(10000))
+        smallArray = array.array('i', [1, 2, 3])
+        view = memoryview(bytes(range(256)) * 100)
+        invocation = Invocation.newRequest('f', [largeArray, smallArray], {'view': view})
+        buffers = []
+        serialized = invocation.serialize(buffers=buffers)
+        self.assertEqual(len(buffers), 2)
+        self.assertLess(len(serialized), 1000)
+        rebuilt = Invocation.deserialize(serialized, buffers=[b.tobytes() for b in buffers])
+        self.assertEqual(rebuilt.getArguments(), [largeArray, smallArray])
+        self.assertIsInstance(rebuilt.getKeywordArguments()['view'], memoryview)
+        self.assertEqual(rebuilt.getKeywordArguments()['view'], view)
+
+        inBand = Invocation.deserialize(invocation.serialize())
+        self.assertEqual(inBand.getArguments(), [largeArray, smallArray])
+        self.assertEqual(inBand.getKeywordArguments()['view'], view)
+
+        nested = [[view, {'views': (1, [view])}], {'deep': [[[view]]]}]
+        batch = Invocation.newBatchRequest([('f', [view, nested], {'view': view})])
+        for protocol in [None, b'IF2']:
+            buffers = []
+            serialized = batch.serialize(buffers=buffers, protocol=protocol)
+            self.assertEqual(len(buffers), 5)
+            call = Invocation.deserialize(serialized, buffers=[b.tobytes() for b in buffers], protocol=protocol).getArguments()[0][0]
+            views = [call[1][0], call[1][1][0][0], call[1][1][0][1]['views'][1][0], call[1][1][1]['deep'][0][0][0], call[2]['view']]
+            self.assertTrue(all(isinstance(v, memoryview) and v == view for v in views))
+        self.assertEqual(batch.getArguments()[0][0][1][1], nested)
+        self.assertIs(type(nested[0][1]['views'][1][0]), memoryview)
+
+    @unittest.skipIf(numpy is None, 'numpy not installed')
+    @timeout(Defines.timeout)
+    def testOutOfBandNdarray(self):
+        data = numpy.arange(60000, dtype='<f4').reshape(200, 300)
+        fortran = numpy.asfortranarray(numpy.arange(12, dtype='>i8').reshape(3, 4))
+        invocation = Invocation.newResponse('1', [data, fortran])
+        buffers = []
+        serialized = invocation.serialize(buffers=buffers)
+        self.assertEqual(len(buffers), 1)
+        frame = buffers[0].tobytes()
+        result = Invocation.deserialize(serialized, buffers=[frame]).getResult()
+        self.assertTrue(numpy.array_equal(result[0], data))
+        self.assertEqual(result[0].dtype, data.dtype)
+        self.assertTrue(numpy.shares_memory(result[0], numpy.frombuffer(frame, dtype='u1')))
+        self.assertTrue(numpy.array_equal(result[1], fortran))
+        self.assertEqual(result[1].dtype, fortran.dtype)
+
+    @timeout(Defines.timeout)
+    def testCodecs(self):
+        content = {Invocation.KeyType: Invocation.ValueTypeResponse, Invocation.KeyResult: [{1, 'a'}, 2 - 1j, 'text', array.array('h', range(1000))]}
+        for serialization in ['MsgpackExt', 'Pickle5']:
+            buffers = []
+            serialized = Invocation(content).serialize(serialization, buffers)
+            self.assertEqual(Invocation.deserialize(serialized, serialization.encode(), True, buffers=buffers), content)
+        self.assertRaises(IFException, lambda: Invocation(content).serialize('Unknown'))
+        self.assertEqual(CodecRegistry.choose(['Msgpack', 'MsgpackExt', 'Pickle5'], ['Pickle5', 'MsgpackExt']), 'Pickle5')
+        self.assertEqual(CodecRegistry.choose(['Msgpack', 'MsgpackExt'], ['Pickle5', 'Msgpack']), 'Msgpack')
+        self.assertEqual(CodecRegistry.choose(['MsgpackExt'], None), 'Msgpack')
+        self.assertNotIn('Pickle5', CodecRegistry.names(safeOnly=True))
+
+        class IncompleteCodec(Codec):
+            name = 'Incomplete'
+
+            def encode(self, content, buffers=None):
+                return b''
+
+        self.assertRaises(TypeError, lambda: CodecRegistry.register(IncompleteCodec()))
+        self.assertRaises(IFException, lambda: CodecRegistry.register(IncompleteCodec))
+        self.assertNotIn('Incomplete', CodecRegistry.names())
+
+    @timeout(Defines.timeout)
+    def testCachedPackerAndUnpacker(self):
+        serialized = Invocation(InvocationSerializationTest.map).serialize()
+        self.assertRaises(Exception, lambda: Invocation.deserialize(serialized[:-3]))
+        self.assertRaises(TypeError, lambda: Invocation({'Object': object()}).serialize())
+        self.assertEqual(Invocation.deserialize(serialized + serialized[:5], contentOnly=True), InvocationSerializationTest.map)
+        self.assertEqual(Invocation(InvocationSerializationTest.map).serialize(), serialized)
+        self.assertEqual(Invocation.deserialize(serialized, contentOnly=True), InvocationSerializationTest.map)
+        large = {'Large': 'x' * 100000}
+        self.assertEqual(Invocation.deserialize(Invocation(large).serialize(), contentOnly=True), large)
+        nested = {'Sets': [{1, 2}, {3, 4 + 1j}]}
+        self.assertRaises(TypeError, lambda: Invocation({'Sets': {object()}}).serialize('MsgpackExt'))
+        self.assertEqual(Invocation.deserialize(Invocation(nested).serialize('MsgpackExt'), 'MsgpackExt', True), nested)
+
     def tearDown(self):
         pass
 
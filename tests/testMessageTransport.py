@@ -5,10 +5,20 @@ import time
 import threading
 import string
 import queue
+import array
+import tempfile
+import os
+import mmap
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
 from interactionfreepy import IFBroker
+from interactionfreepy.broker import Manager, WebSocketZMQBridgeHandler
 from interactionfreepy import IFWorker
-from interactionfreepy import Message, IFException, IFRemoteException
+from interactionfreepy import Message, Invocation, IFException, IFRemoteException, IFLoop, IFDefinition, Execution
+from interactionfreepy.core import Chunking, ChunkAssembler, Streaming, Bundling, Idempotency
 from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+import asyncio
 from asyncio import Queue
 import traceback
 from random import Random
@@ -16,6 +26,40 @@ from wrapt_timeout_decorator import timeout
 from tests.defines import Defines
 
 
+class ExecutionTarget:
+  def __init__(self):
+    self.reads = 0
+
+  @Execution.inThread
+  def read(self, duration):
+    time.sleep(duration)
+    self.reads += 1
+    return threading.current_thread().name
+
+  def blockingRead(self, duration):
+    time.sleep(duration)
+    return threading.current_thread().name
+
+  def fast(self):
+    return threading.current_thread().name
+
+  @staticmethod
+  @Execution.inProcess
+  def crunch(n):
+    return [sum(range(n)), os.getpid()]
+
+
+class EchoTarget:
+  def echo(self, value):
+    return value
+
+  def size(self, value):
+    return memoryview(value).nbytes
+
+  def describe(self, view):
+    return [type(view).__name__, view.nbytes]
+
+
 class MessageTransportTest(unittest.TestCase):
   testPort = 20111
   brokerAddress = 'tcp://127.0.0.1:{}'.format(testPort)
@@ -27,6 +71,12 @@ class MessageTransportTest(unittest.TestCase):
   def setUp(self):
     pass
 
+  def newWorker(self, endpoint=None, **options):
+    """Create a worker that is closed when the test finishes."""
+    worker = IFWorker(MessageTransportTest.brokerAddress if endpoint is None else endpoint, **options)
+    self.addCleanup(worker.close)
+    return worker
+
   @timeout(Defines.timeout)
   def testConnectionOfSession(self):
     IFWorker(MessageTransportTest.brokerAddress)
@@ -201,6 +251,309 @@ class MessageTransportTest(unittest.TestCase):
     worker.close()
     checker.close()
 
+  @timeout(Defines.timeout)
+  def testInvokeOutOfBandBuffers(self):
+    class Target:
+      def scale(self, data, factor):
+        return array.array(data.typecode, [d * factor for d in data])
+
+      def describe(self, view):
+        return [type(view).__name__, view.nbytes]
+
+    worker = self.newWorker(serviceObject=Target(), serviceName="OOB")
+    checker = self.newWorker()
+    data = array.array('d', range(5000))
+    message = checker.toMessageInvoker('OOB').scale(data, 2)
+    self.assertEqual(len(message.getContent()), 8)
+    self.assertEqual(checker.OOB.scale(data, 2), array.array('d', [d * 2 for d in data]))
+    self.assertEqual(checker.OOB.describe(memoryview(b'0' * 100000)), ['memoryview', 100000])
+    with checker.batch('OOB') as batch:
+      described = batch.describe(memoryview(b'0' * 100000))
+    self.assertEqual(described.result(), ['memoryview', 100000])
+
+  @timeout(Defines.timeout)
+  def testCodecNegotiation(self):
+    worker = self.newWorker(serviceObject=EchoTarget(), serviceName="CodecNegotiation", codecs=['MsgpackExt'])
+    checker = self.newWorker(codecs=['MsgpackExt', 'Pickle5'])
+    metas = [meta for meta in checker.listServiceMeta() if meta['ServiceName'] == 'CodecNegotiation']
+    self.assertEqual(metas[0]['Codecs'], ['MsgpackExt', 'Msgpack'])
+    self.assertEqual(checker.CodecNegotiation.echo(1), 1)
+    while checker.serializationFor('CodecNegotiation') == 'Msgpack':
+      time.sleep(0.05)
+    self.assertEqual(checker.serializationFor('CodecNegotiation'), 'MsgpackExt')
+    self.assertEqual(checker.CodecNegotiation.echo({1, 2}), {1, 2})
+    pickleMessage = Message.newServiceMessage('CodecNegotiation', Invocation.newRequest('echo', [1], {}), 'Pickle5')
+    try:
+      checker.send(pickleMessage).sync(2)
+      self.fail('No exception raised.')
+    except IFRemoteException as e:
+      self.assertTrue(e.__str__().__contains__('Serialization Pickle5 not accepted.'))
+
+  @timeout(Defines.timeout)
+  def testCompression(self):
+    repetitive = 'Channel 1: OK; Channel 2: OK; ' * 10000
+    compressed = Message.newServiceMessage('Compression', Invocation.newRequest('echo', [repetitive], {}), 'Msgpack', 'zlib')
+    self.assertEqual(compressed.getContent()[5], b'Msgpack+zlib')
+    self.assertEqual(compressed.compression, b'zlib')
+    self.assertLess(len(compressed.getInvocation(False)), len(repetitive) / 10)
+    self.assertEqual(compressed.getInvocation().getArguments(), [repetitive])
+    small = Message.newServiceMessage('Compression', Invocation.newRequest('echo', ['OK'], {}), 'Msgpack', 'zlib')
+    self.assertEqual(small.getContent()[5], b'Msgpack')
+    self.assertIsNone(small.compression)
+
+    worker = self.newWorker(serviceObject=EchoTarget(), serviceName="Compression", compression='zlib')
+    checker = self.newWorker(compression='lzma', compressionThreshold=1000)
+    self.assertEqual(checker.Compression.echo(repetitive), repetitive)
+    self.assertEqual(checker.blockingInvoker('Compression', compression=False).echo(repetitive), repetitive)
+    perCall = checker.toMessageInvoker('Compression').echo(repetitive, IFCompression='zlib')
+    self.assertEqual(perCall.getContent()[5], b'Msgpack+zlib')
+    self.assertEqual(perCall.getInvocation().getKeywordArguments(), {})
+    self.assertEqual(checker.toMessageInvoker('Compression').echo(repetitive).getContent()[5], b'Msgpack')
+    self.assertEqual(checker.Compression.echo(repetitive, IFCompression=False), repetitive)
+    self.assertEqual(checker.asynchronousInvoker('Compression', compression=False).echo(repetitive, IFCompression='zlib').sync(), repetitive)
+    self.assertEqual(asyncio.run_coroutine_threadsafe(checker.asyncInvoker('Compression').echo(repetitive, IFCompression='lzma'), IFLoop.getInstance().asyncio_loop).result(5), repetitive)
+    self.assertRaises(IFException, lambda: checker.Compression.echo(repetitive, IFCompression='gzip'))
+
+  @timeout(Defines.timeout)
+  def testCachedStubs(self):
+    worker = self.newWorker(serviceObject=EchoTarget(), serviceName="CachedStubs")
+    checker = self.newWorker()
+    self.assertIs(checker.CachedStubs.echo, checker.CachedStubs.echo)
+    self.assertEqual([checker.CachedStubs.echo(i) for i in range(10)], list(range(10)))
+    invoker = checker.blockingInvoker('CachedStubs', timeout=2)
+    self.assertIs(invoker.echo, invoker.echo)
+    self.assertEqual(invoker.echo('a'), 'a')
+    checker.blocking = False
+    self.assertEqual(checker.CachedStubs.echo(1).sync(), 1)
+
+    template = Message.newTemplate(b'Service', 'CachedStubs', 'Msgpack', 'zlib', None, None, 1.5)
+    m1, m2 = template.newMessage(Invocation.newRequest('echo', [1], {})), template.newMessage(Invocation.newRequest('echo', ['x' * 100000], {}))
+    self.assertNotEqual(m1.messageID, m2.messageID)
+    self.assertEqual(m1.getContent()[3:6], [b'Service', b'CachedStubs', b'Msgpack@1.500'])
+    self.assertEqual(m2.getContent()[5], b'Msgpack+zlib@1.500')
+    self.assertEqual(m2.getInvocation().getArguments(), ['x' * 100000])
+    messages = checker.toMessageInvoker('CachedStubs')
+    self.assertIs(messages.echo(1).getContent()[5], messages.echo(2).getContent()[5])
+
+  @timeout(Defines.timeout)
+  def testProtocolNegotiation(self):
+    legacy = self.newWorker(serviceObject=EchoTarget(), serviceName="LegacyIF1", protocols=['IF1'])
+    modern = self.newWorker(serviceObject=EchoTarget(), serviceName="ModernIF2")
+    checker = self.newWorker()
+    while checker.protocolFor(None) != b'IF2':
+      time.sleep(0.05)
+    self.assertEqual(checker.protocol(), 'IF1')
+    self.assertEqual(checker.listProtocols(), ['IF1', 'IF2'])
+    self.assertEqual(checker.LegacyIF1.echo('a'), 'a')
+    self.assertEqual(checker.ModernIF2.echo('b'), 'b')
+    while checker.protocolFor('ModernIF2') != b'IF2':
+      checker.ModernIF2.echo('c')
+      time.sleep(0.1)
+    self.assertEqual(checker.ModernIF2.echo({'d': [1, None]}), {'d': [1, None]})
+    self.assertEqual(checker.protocolFor('LegacyIF1'), b'IF1')
+    self.assertEqual(legacy.protocolFor(None), b'IF1')
+    self.assertEqual(legacy.ModernIF2.echo('e'), 'e')
+
+  @timeout(Defines.timeout)
+  def testLegacyBroker(self):
+    # A broker of an earlier version answers the requests in IF1, and drops the messages of other protocols silently.
+    address = 'tcp://127.0.0.1:{}'.format(MessageTransportTest.testPort + 40)
+    socket = zmq.Context.instance().socket(zmq.ROUTER)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.bind(address)
+    received, stopped = [], threading.Event()
+
+    def serve():
+      while not stopped.is_set():
+        if not socket.poll(50):
+          continue
+        frames = socket.recv_multipart()
+        received.append(frames[2])
+        if frames[2] != IFDefinition.PROTOCOL:
+          continue
+        message = Message(frames[1:], outgoing=True)
+        response = Message.newDirectMessage(b'', Invocation.newResponse(message.messageID, message.getInvocation().getFunction()))
+        socket.send_multipart([frames[0], b'', IFDefinition.PROTOCOL, response.getContent()[2], b'Broker'] + response.getContent()[5:])
+      socket.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    self.addCleanup(thread.join)
+    self.addCleanup(stopped.set)
+    worker = self.newWorker(address)
+    self.assertEqual(worker.blockingInvoker(timeout=2).anything(), 'anything')
+    time.sleep(IFDefinition.HEARTBEAT_LIVETIME / 5 + 0.5)
+    self.assertIn(IFDefinition.PROTOCOL_IF2, received)
+    self.assertEqual(worker.protocolFor(None), IFDefinition.PROTOCOL)
+    self.assertEqual(worker.blockingInvoker(timeout=2).another(), 'another')
+
+  @timeout(Defines.timeout)
+  def testTimeoutToLegacyPeer(self):
+    # A service of an earlier version sends IF1 only, and rejects a serialization frame other than its codec, e.g. one with a timeout.
+    registered, stopped = threading.Event(), threading.Event()
+
+    def serve():
+      socket = zmq.Context.instance().socket(zmq.DEALER)
+      socket.setsockopt(zmq.LINGER, 0)
+      socket.connect(MessageTransportTest.brokerAddress)
+      socket.send_multipart(Message.newBrokerMessage(Invocation.newRequest('registerAsService', ['LegacyPeer', ['echo']], {})).getContent())
+      while not stopped.is_set():
+        if not socket.poll(50):
+          continue
+        message = Message(socket.recv_multipart(), outgoing=False)
+        if message.getContent()[4] != b'Msgpack':
+          invocation = Invocation.newError(message.replyID, 'Serialization not accepted.')
+        else:
+          invocation = message.getInvocation()
+          if invocation.isResponse():
+            registered.set()
+            continue
+          if invocation.getFunction() == 'echo':
+            invocation = Invocation.newResponse(message.replyID, invocation.getArguments()[0])
+          else:
+            invocation = Invocation.newError(message.replyID, f'Function [{invocation.getFunction()}] not available.')
+        socket.send_multipart(Message.newDirectMessage(message.fromAddress, invocation).getContent())
+      socket.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    self.addCleanup(thread.join)
+    self.addCleanup(stopped.set)
+    self.assertTrue(registered.wait(5))
+    checker = self.newWorker()
+    while checker.protocolFor(None) != b'IF2':
+      time.sleep(0.05)
+    for i in range(3):
+      self.assertEqual(checker.blockingInvoker('LegacyPeer', timeout=2).echo(i), i)
+      self.assertEqual(checker.asynchronousInvoker('LegacyPeer', timeout=2).echo(i).sync(), i)
+      time.sleep(0.1)
+    self.assertEqual(checker.protocolFor('LegacyPeer'), b'IF1')
+    try:
+      checker.blockingInvoker('LegacyPeer', timeout=2).absent()
+      self.fail('No exception raised.')
+    except IFRemoteException as e:
+      self.assertIn('Function [absent] not available.', str(e))
+
+  @timeout(Defines.timeout)
+  def testChunkedTransfer(self):
+    payload = array.array('d', range(300000))
+    chunks = list(Chunking.split(Message.newServiceMessage('Chunked', Invocation.newRequest('echo', [payload], {})), 100000))
+    self.assertEqual(len(chunks), 25)
+    self.assertEqual(chunks[0].getKeywordArguments()['Sizes'][1], 2400000)
+    with tempfile.TemporaryDirectory() as directory:
+      worker = self.newWorker(serviceObject=EchoTarget(), serviceName="Chunked", chunkSize=100000, chunkDirectory=directory)
+      checker = self.newWorker(chunkSize=65536)
+      self.assertEqual(checker.Chunked.echo(payload), payload)
+      self.assertEqual(checker.Chunked.size(memoryview(b'x' * 1000000)), 1000000)
+      self.assertEqual(checker.Chunked.echo('small'), 'small')
+      try:
+        checker.blockingInvoker('ChunkedAbsent', timeout=5).echo(payload)
+        self.fail('No exception raised.')
+      except IFRemoteException as e:
+        self.assertIn('Chunked transfer failed', str(e))
+      limited = self.newWorker(serviceObject=EchoTarget(), serviceName="ChunkedLimited", maxTransferSize=1000000)
+      self.assertEqual(checker.ChunkedLimited.size(b'x' * 200000), 200000)
+      try:
+        checker.ChunkedLimited.echo(payload)
+        self.fail('No exception raised.')
+      except IFRemoteException as e:
+        self.assertIn('exceeds the limit of 1000000 bytes', str(e))
+    meta = chunks[0].getKeywordArguments()
+    self.assertRaises(IFException, ChunkAssembler, dict(meta, Sizes=[1, -1]))
+    self.assertRaises(IFException, ChunkAssembler, meta, maxSize=1000)
+    assembler = ChunkAssembler(meta, spoolThreshold=1000)
+    for index, chunk in enumerate(chunks):
+      assembler.feed(index, chunk.getArguments()[2])
+    frames = assembler.frames(b'Sender')
+    self.assertIsInstance(frames[-1].obj, mmap.mmap)
+    self.assertEqual(bytes(frames[-1]), payload.tobytes())
+    assembler.close()
+
+  @timeout(Defines.timeout)
+  def testBatchInvoke(self):
+    class Target:
+      def __init__(self):
+        self.calls = []
+
+      def read(self, channel):
+        self.calls.append(channel)
+        return channel * 10
+
+      async def slow(self, delay):
+        await asyncio.sleep(delay)
+        return delay
+
+      def fail(self):
+        raise ValueError('bad channel')
+
+      def count(self, n):
+        yield from range(n)
+
+    target = Target()
+    worker = self.newWorker(serviceObject=target, serviceName="Batch")
+    checker = self.newWorker()
+    with checker.batch('Batch') as batch:
+      futures = [batch.read(i) for i in range(20)]
+      failed = batch.fail()
+      missing = batch.noSuchFunction()
+      stream = batch.count(3)
+    self.assertEqual([future.result() for future in futures], [i * 10 for i in range(20)])
+    self.assertEqual(target.calls, list(range(20)))
+    self.assertFalse(failed.isSuccess())
+    self.assertIn('bad channel', str(failed.exception()))
+    self.assertIn('Function [noSuchFunction] not available.', str(missing.exception()))
+    self.assertIn('Function [count] returns a stream, which is not supported in a batch.', str(stream.exception()))
+    startTime = time.time()
+    with checker.batch('Batch', concurrent=True) as batch:
+      slows = [batch.slow(0.5) for i in range(4)]
+    self.assertLess(time.time() - startTime, 1.5)
+    self.assertEqual([future.result() for future in slows], [0.5] * 4)
+    batch = checker.batch()
+    protocol = batch.protocol()
+    self.assertEqual(batch.submit().sync(2), [['IF1', None]])
+    self.assertEqual(protocol.result(), 'IF1')
+    self.assertRaises(IFException, batch.submit)
+
+  @timeout(Defines.timeout)
+  def testStreamingResults(self):
+    class Target:
+      def __init__(self):
+        self.produced = 0
+
+      def count(self, n):
+        for i in range(n):
+          self.produced += 1
+          yield i
+
+      async def countAsync(self, n):
+        for i in range(n):
+          await asyncio.sleep(0)
+          yield {'index': i}
+
+      def broken(self):
+        yield 1
+        raise ValueError('acquisition failed')
+
+    target = Target()
+    worker = self.newWorker(serviceObject=target, serviceName="Streaming")
+    checker = self.newWorker()
+    self.assertEqual(list(checker.Streaming.count(100)), list(range(100)))
+    self.assertEqual(list(checker.Streaming.count(0)), [])
+    with checker.Streaming.count(1000) as stream:
+      self.assertEqual(next(stream), 0)
+      time.sleep(0.5)
+      self.assertLessEqual(target.produced - 100, Streaming.WINDOW + 1)
+    self.assertEqual(list(stream), [])
+    stream = checker.Streaming.broken()
+    self.assertEqual(next(stream), 1)
+    self.assertRaises(IFRemoteException, lambda: next(stream))
+
+    async def consume():
+      return [item async for item in await checker.asyncInvoker('Streaming').countAsync(50)]
+
+    items = asyncio.run_coroutine_threadsafe(consume(), IFLoop.getInstance().asyncio_loop).result(5)
+    self.assertEqual(items, [{'index': i} for i in range(50)])
+
   @timeout(Defines.timeout)
   def testDisconnectService(self):
     serviceName = 'DSWorker1'
@@ -264,6 +617,579 @@ class MessageTransportTest(unittest.TestCase):
     worker.close()
     checker.close()
 
+  @timeout(Defines.timeout)
+  def testZeroCopyBroker(self):
+    address = 'tcp://127.0.0.1:{}'.format(MessageTransportTest.testPort + 10)
+    IFBroker(address, zeroCopy=True)
+    worker = self.newWorker(address, serviceObject=EchoTarget(), serviceName="ZeroCopy")
+    checker = self.newWorker(address)
+    self.assertEqual(checker.ZeroCopy.echo('small'), 'small')
+    self.assertEqual(checker.ZeroCopy.describe(memoryview(b'0' * 200000)), ['memoryview', 200000])
+    data = array.array('d', range(50000))
+    self.assertEqual(checker.ZeroCopy.echo(data), data)
+    self.assertIn('ZeroCopy', checker.listServiceNames())
+
+  @timeout(Defines.timeout)
+  def testReplicaPool(self):
+    class Target:
+      def __init__(self, name):
+        self.name = name
+
+      async def slow(self, value):
+        await asyncio.sleep(0.3)
+        return [self.name, value]
+
+      def size(self, data):
+        return [self.name, len(data)]
+
+      def count(self, n):
+        for i in range(n):
+          yield [self.name, i]
+
+    workers = [self.newWorker(serviceObject=Target(f'R{i}'), serviceName="Pool", replica=True) for i in range(3)]
+    checker = self.newWorker(chunkSize=10000)
+    self.assertEqual(len(checker.getReplicasOfService('Pool')), 3)
+    futures = [checker.asynchronousInvoker('Pool').slow(i) for i in range(6)]
+    results = [future.sync(5) for future in futures]
+    self.assertEqual([result[1] for result in results], list(range(6)))
+    self.assertEqual(sorted(result[0] for result in results), ['R0', 'R0', 'R1', 'R1', 'R2', 'R2'])
+    futures = [checker.asynchronousInvoker('Pool').size(b'0' * 100000) for i in range(3)]
+    self.assertEqual([future.sync(5)[1] for future in futures], [100000] * 3)
+    items = list(checker.Pool.count(40))
+    self.assertEqual([item[1] for item in items], list(range(40)))
+    self.assertEqual(len(set(item[0] for item in items)), 1)
+
+    future = checker.asynchronousInvoker('Pool').slow('in flight')
+    time.sleep(0.05)
+    workers[0].close()
+    workers[1].close()
+    self.assertEqual(future.sync(5)[1], 'in flight')
+    self.assertEqual(checker.Pool.slow('left'), ['R2', 'left'])
+    self.assertEqual(checker.getReplicasOfService('Pool'), [checker.getAddressOfService('Pool')])
+    workers[2].close()
+    self.assertNotIn('Pool', checker.listServiceNames())
+
+  @timeout(Defines.timeout)
+  def testConcurrencyLimit(self):
+    class Target:
+      def __init__(self):
+        self.running = 0
+        self.maxRunning = 0
+
+      async def slow(self, value):
+        self.running += 1
+        self.maxRunning = max(self.maxRunning, self.running)
+        await asyncio.sleep(0.3)
+        self.running -= 1
+        return value
+
+    target = Target()
+    worker = self.newWorker(serviceObject=target, serviceName="Limited", concurrency=2, queueSize=3)
+    checker = self.newWorker()
+    futures = [checker.asynchronousInvoker('Limited').slow(i) for i in range(8)]
+    self.assertTrue(futures[-1].waitFor(0.2))
+    self.assertIn('Service [Limited] overloaded', futures[-1].exception().remoteTraceback)
+    meta = [meta for meta in checker.listServiceMeta() if meta['ServiceName'] == 'Limited'][0]
+    self.assertEqual(meta['Queue']['Concurrency'], 2)
+    self.assertEqual(meta['Queue']['In Flight'], 2)
+    self.assertEqual(meta['Queue']['Queued'], 3)
+    self.assertEqual(meta['Queue']['Rejected'], 3)
+    for future in futures:
+      future.waitFor(5)
+    self.assertEqual([future.result() for future in futures[:5]], list(range(5)))
+    self.assertTrue(all(not future.isSuccess() for future in futures[5:]))
+    self.assertEqual(target.maxRunning, 2)
+    status = [meta for meta in checker.listServiceMeta() if meta['ServiceName'] == 'Limited'][0]['Queue']
+    self.assertEqual([status['Queued'], status['Dispatched'], status['In Flight']], [0, 3, 0])
+    self.assertGreater(status['Average Wait'], 0.2)
+
+  @timeout(Defines.timeout)
+  def testExpiryAndCancellation(self):
+    class Target:
+      def __init__(self):
+        self.started = []
+        self.aborted = []
+
+      async def slow(self, value, duration=1):
+        self.started.append(value)
+        try:
+          await asyncio.sleep(duration)
+        except asyncio.CancelledError:
+          self.aborted.append(value)
+          raise
+        return value
+
+    def waitFor(condition):
+      deadline = time.time() + 5
+      while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+
+    target = Target()
+    worker = self.newWorker(serviceObject=target, serviceName='Expiring', concurrency=1, queueSize=5)
+    checker = self.newWorker()
+    self.assertRaises(IFException, lambda: checker.blockingInvoker('Expiring', timeout=0.2).slow(0))
+    waitFor(lambda: target.aborted == [0])
+    self.assertEqual(target.aborted, [0])
+
+    running = checker.asynchronousInvoker('Expiring').slow(1)
+    waitFor(lambda: 1 in target.started)
+    queued = checker.asynchronousInvoker('Expiring').slow(2)
+    expiring = checker.send(Message.newServiceMessage('Expiring', Invocation.newRequest('slow', [3], {}), timeout=0.2), timeout=0.2)
+    time.sleep(0.1)
+    self.assertTrue(queued.cancel())
+    self.assertFalse(queued.cancel())
+    self.assertIn('Cancelled', queued.exception().remoteTraceback)
+    time.sleep(0.25)
+    self.assertTrue(running.cancel())
+    waitFor(lambda: expiring.isDone())
+    self.assertIn('TIMEOUT', expiring.exception().remoteTraceback)
+    waitFor(lambda: 1 in target.aborted)
+    self.assertEqual(checker.asynchronousInvoker('Expiring').slow(4, 0).sync(2), 4)
+    self.assertEqual(target.started, [0, 1, 4])
+    status = [meta for meta in checker.listServiceMeta() if meta['ServiceName'] == 'Expiring'][0]['Queue']
+    self.assertEqual(status['Expired'], 2)
+
+  @timeout(Defines.timeout)
+  def testPromptTimeout(self):
+    worker = self.newWorker(serviceObject=ExecutionTarget(), serviceName='Stalling', executions={'blockingRead': Execution.THREAD})
+    checker = self.newWorker()
+    for invoke in [lambda: checker.asynchronousInvoker('Stalling', timeout=0.3).blockingRead(1), lambda: checker.send(Message.newServiceMessage('Stalling', Invocation.newRequest('blockingRead', [1], {}), timeout=0.3), timeout=0.3)]:
+      startTime = time.time()
+      future = invoke()
+      self.assertTrue(future.waitFor(2))
+      self.assertLess(time.time() - startTime, 0.4)
+      self.assertIn('TIMEOUT', future.exception().remoteTraceback)
+      self.assertRaises(IFException, future.sync)
+    startTime = time.time()
+    self.assertRaises(IFException, lambda: checker.blockingInvoker('Stalling', timeout=0.3).blockingRead(1))
+    self.assertLess(time.time() - startTime, 0.4)
+
+  @timeout(Defines.timeout)
+  def testWindowAndBundling(self):
+    small = [Message.newServiceMessage('S', Invocation.newRequest('f', [i], {})).getContent() for i in range(5)]
+    large = Message.newServiceMessage('S', Invocation.newRequest('f', ['x' * 2000], {})).getContent()
+    buffered = Message.newServiceMessage('S', Invocation.newRequest('f', [array.array('d', range(1000))], {})).getContent()
+    packed = Bundling.bundle(small[:3] + [large] + small[3:4] + [buffered] + small[4:])
+    self.assertEqual(len(packed), 5)
+    self.assertEqual(packed[0][3], Bundling.DISTRIBUTING_MODE)
+    self.assertEqual(Bundling.unbundle(packed[0][6]), small[:3])
+    self.assertEqual(packed[1:], [large, small[3], buffered, small[4]])
+    self.assertRaises(IFException, lambda: Bundling.unbundle(packed[0][6][:-1]))
+
+    class Target:
+      def __init__(self):
+        self.running = 0
+        self.maximum = 0
+
+      async def slow(self, value):
+        self.running += 1
+        self.maximum = max(self.maximum, self.running)
+        await asyncio.sleep(0.05)
+        self.running -= 1
+        return value
+
+      def echo(self, value):
+        return value
+
+    target = Target()
+    worker = self.newWorker(serviceObject=target, serviceName='Windowed', coalesce=True)
+    checker = self.newWorker(window=4, coalesce=True)
+    invoker = checker.asynchronousInvoker('Windowed')
+    futures = [invoker.slow(i) for i in range(20)]
+    self.assertEqual([future.sync(5) for future in futures], list(range(20)))
+    self.assertEqual(target.maximum, 4)
+
+    async def gather():
+      asyncInvoker = checker.asyncInvoker('Windowed')
+      return await asyncio.gather(*[asyncInvoker.slow(i) for i in range(20)])
+
+    target.maximum = 0
+    self.assertEqual(asyncio.run_coroutine_threadsafe(gather(), IFLoop.getInstance().asyncio_loop).result(5), list(range(20)))
+    self.assertEqual(target.maximum, 4)
+    futures = [invoker.echo(i) for i in range(500)]
+    self.assertEqual([future.sync(5) for future in futures], list(range(500)))
+    self.assertEqual(checker.Windowed.echo('x' * 5000), 'x' * 5000)
+
+  @timeout(Defines.timeout)
+  def testBundlingNegotiation(self):
+    worker = self.newWorker(coalesce=True)
+    plain = self.newWorker()
+    startTime = time.time()
+    while not worker.isBundling() and time.time() - startTime < 2:
+      time.sleep(0.05)
+    self.assertTrue(worker.isBundling())
+    self.assertFalse(plain.isBundling())
+    invoker = worker.blockingInvoker()
+    self.assertTrue(invoker.enableBundling(False))
+    self.assertFalse(invoker.enableBundling(False))
+    # The broker has forgotten the agreement, as after a restart. The worker asks again with its next heartbeat.
+    time.sleep(IFDefinition.HEARTBEAT_LIVETIME * 3 / 5)
+    self.assertTrue(invoker.enableBundling())
+
+  @timeout(Defines.timeout)
+  def testIdempotentRetriesAndHedging(self):
+    class Target:
+      def __init__(self, name, state):
+        self.name = name
+        self.state = state
+
+      async def read(self, value, stalls=1):
+        self.state['calls'].append(self.name)
+        if len(self.state['calls']) <= stalls:
+          await asyncio.sleep(1)
+        return value
+
+      def fail(self):
+        self.state['calls'].append(self.name)
+        if len(self.state['calls']) == 1:
+          raise IFException('First call fails.')
+        return len(self.state['calls'])
+
+      def items(self, count):
+        self.state['calls'].append(self.name)
+        yield from range(count)
+
+    state = {'calls': []}
+    single = self.newWorker(serviceObject=Target('S', state), serviceName='Deduplicated')
+    checker = self.newWorker()
+    key = Idempotency.newKey()
+    futures = [checker.send(Message.newServiceMessage('Deduplicated', Invocation.newRequest('read', [i, 0], {}), idempotencyKey=key)) for i in range(2)]
+    self.assertEqual([future.sync(2) for future in futures], [0, 0])
+    self.assertEqual(checker.send(Message.newServiceMessage('Deduplicated', Invocation.newRequest('read', [2, 0], {}), idempotencyKey=key)).sync(2), 0)
+    self.assertEqual(len(state['calls']), 1)
+    state['calls'] = []
+    key = Idempotency.newKey()
+    self.assertRaises(IFRemoteException, lambda: checker.send(Message.newServiceMessage('Deduplicated', Invocation.newRequest('fail', [], {}), idempotencyKey=key)).sync(2))
+    self.assertEqual(checker.send(Message.newServiceMessage('Deduplicated', Invocation.newRequest('fail', [], {}), idempotencyKey=key)).sync(2), 2)
+    key = Idempotency.newKey()
+    streams = [checker.send(Message.newServiceMessage('Deduplicated', Invocation.newRequest('items', [3], {}), idempotencyKey=key)) for i in range(2)]
+    for stream in streams:
+      self.assertRaises(IFRemoteException, lambda: stream.sync(2))
+      self.assertIn('Streams are not supported for idempotent requests.', stream.exception().remoteTraceback)
+    single.close()
+
+    replicas = [self.newWorker(serviceObject=Target(f'R{i}', state), serviceName='Hedged', replica=True) for i in range(2)]
+
+    state['calls'] = []
+    startTime = time.time()
+    self.assertEqual(checker.blockingInvoker('Hedged', hedge=0.2).read('hedged'), 'hedged')
+    self.assertLess(time.time() - startTime, 0.9)
+    self.assertEqual(len(set(state['calls'])), 2)
+
+    state['calls'] = []
+    startTime = time.time()
+    self.assertEqual(checker.blockingInvoker('Hedged', timeout=0.3, retries=1).read('retried'), 'retried')
+    self.assertLess(time.time() - startTime, 0.9)
+    self.assertEqual(len(state['calls']), 2)
+    state['calls'] = []
+    self.assertRaises(IFRemoteException, lambda: checker.blockingInvoker('Hedged', timeout=0.3, retries=1).read('failed', 2))
+
+    async def hedged():
+      return await checker.asyncInvoker('Hedged', hedge=True).read('async', 0)
+
+    self.assertEqual(asyncio.run_coroutine_threadsafe(hedged(), IFLoop.getInstance().asyncio_loop).result(2), 'async')
+    self.assertEqual(checker.hedgeDelayFor('Hedged'), Idempotency.HEDGE_DELAY)
+
+  @timeout(Defines.timeout)
+  def testRetriesOnBlockingReplicas(self):
+    class Target:
+      def __init__(self, calls):
+        self.calls = calls
+
+      @Execution.inThread
+      def read(self, value):
+        self.calls.append(value)
+        if len(self.calls) == 1:
+          time.sleep(1)
+        return value
+
+    calls = []
+    replicas = [self.newWorker(serviceObject=Target(calls), serviceName='Blocking', replica=True) for i in range(2)]
+    checker = self.newWorker()
+    startTime = time.time()
+    self.assertEqual(checker.blockingInvoker('Blocking', timeout=0.3, retries=1).read('retried'), 'retried')
+    self.assertLess(time.time() - startTime, 0.5)
+    self.assertEqual(calls, ['retried', 'retried'])
+    time.sleep(0.8)
+    del calls[:]
+    startTime = time.time()
+    self.assertEqual(checker.asynchronousInvoker('Blocking', hedge=0.1).read('hedged').sync(2), 'hedged')
+    self.assertLess(time.time() - startTime, 0.3)
+
+  @timeout(Defines.timeout)
+  def testPublishSubscribe(self):
+    received = queue.Queue()
+    gate = asyncio.Event()
+
+    async def slowCallback(topic, data):
+      await gate.wait()
+
+    subscriber = self.newWorker()
+    slow = self.newWorker()
+    publisher = self.newWorker()
+    subscriber.subscribe('Counter.', lambda topic, data: received.put((topic, data)))
+    slow.subscribe('Counter', slowCallback, highWaterMark=5)
+    for i in range(20):
+      publisher.publish('Counter.A', i)
+    publisher.publish('Other', 'ignored')
+    self.assertEqual([received.get(timeout=2) for i in range(20)], [('Counter.A', i) for i in range(20)])
+
+    def subscribers():
+      return {entry['Address']: entry for entry in publisher.listSubscribers()}
+
+    time.sleep(0.2)
+    self.assertTrue(received.empty())
+    slowAddress = [address for address, entry in subscribers().items() if entry['High Water Mark'] == 5][0]
+    self.assertEqual([subscribers()[slowAddress][key] for key in ['Delivered', 'Dropped', 'Unacknowledged']], [5, 15, 5])
+    IFLoop.getInstance().add_callback(gate.set)
+    time.sleep(0.2)
+    self.assertEqual(subscribers()[slowAddress]['Unacknowledged'], 0)
+    publisher.publish('Counter.B', 'again')
+    self.assertEqual(received.get(timeout=2), ('Counter.B', 'again'))
+    subscriber.unsubscribe('Counter.')
+    publisher.publish('Counter.C', 'unsubscribed')
+    time.sleep(0.2)
+    self.assertTrue(received.empty())
+    self.assertEqual(subscribers()[slowAddress]['Delivered'], 7)
+    for worker in [subscriber, slow, publisher]:
+      worker.close()
+    self.assertEqual(publisher.listSubscribers(), [])
+
+  @timeout(Defines.timeout)
+  def testPublishOverWebSocket(self):
+    address = 'tcp://127.0.0.1:{}'.format(MessageTransportTest.testPort + 30)
+    webSocketPort = MessageTransportTest.testPort + 31
+    IFBroker(address).startWebSocket(webSocketPort, '/ws/')
+    publisher = self.newWorker(address)
+    subscribed = threading.Event()
+
+    async def client():
+      connection = await websocket_connect(f'ws://127.0.0.1:{webSocketPort}/ws/')
+
+      async def receive():
+        frames = []
+        while True:
+          data = await connection.read_message()
+          frames.append(data[1:])
+          if data[0] == 0:
+            return Message(frames, outgoing=False)
+
+      frames = Message.newBrokerMessage(Invocation.newRequest('subscribe', ['Scope'], {})).getContent()
+      for frame in frames[:-1]:
+        await connection.write_message(b'\x01' + frame, binary=True)
+      await connection.write_message(b'\x00' + frames[-1], binary=True)
+      await receive()
+      subscribed.set()
+      publication = await receive()
+      return connection, publication.getInvocation().getArguments()
+
+    future = asyncio.run_coroutine_threadsafe(client(), IFLoop.getInstance().asyncio_loop)
+    self.assertTrue(subscribed.wait(5))
+    publisher.publish('Scope.1', [1, 2, 3])
+    connection, arguments = future.result(5)
+    self.assertEqual(arguments, ['Scope.1', [1, 2, 3]])
+    time.sleep(0.1)
+    entry = publisher.listSubscribers()[0]
+    self.assertEqual([entry['Topics'], entry['Delivered'], entry['Unacknowledged']], [['Scope'], 1, 0])
+    IFLoop.getInstance().add_callback(connection.close)
+    time.sleep(0.2)
+    self.assertEqual(publisher.listSubscribers(), [])
+
+  @timeout(Defines.timeout)
+  def testCoalescedWebSocketBridge(self):
+    frames = [b'', b'IF1', b'\x00' * 70000, b'x']
+    self.assertEqual(WebSocketZMQBridgeHandler.splitFrames(WebSocketZMQBridgeHandler.coalesceFrames(frames)), frames)
+    self.assertRaises(IFException, lambda: WebSocketZMQBridgeHandler.splitFrames(WebSocketZMQBridgeHandler.coalesceFrames(frames)[:-1]))
+    address = 'tcp://127.0.0.1:{}'.format(MessageTransportTest.testPort + 32)
+    webSocketPort = MessageTransportTest.testPort + 33
+    IFBroker(address).startWebSocket(webSocketPort, '/ws/', coalesce=True, sendQueueSize=2)
+    service = self.newWorker(address, serviceObject=EchoTarget(), serviceName='BridgedEcho')
+
+    async def client():
+      connection = await websocket_connect(f'ws://127.0.0.1:{webSocketPort}/ws/')
+      requests = [Message.newServiceMessage('BridgedEcho', Invocation.newRequest('echo', [i], {})) for i in range(20)]
+      for request in requests:
+        await connection.write_message(WebSocketZMQBridgeHandler.coalesceFrames(request.getContent()), binary=True)
+      results = {}
+      for request in requests:
+        response = Message(WebSocketZMQBridgeHandler.splitFrames(await connection.read_message()), outgoing=False)
+        results[response.getInvocation().getResponseID()] = response.getInvocation().getResult()
+      connection.close()
+      return [results[request.messageID] for request in requests]
+
+    future = asyncio.run_coroutine_threadsafe(client(), IFLoop.getInstance().asyncio_loop)
+    self.assertEqual(future.result(5), list(range(20)))
+
+  @timeout(Defines.timeout)
+  def testExecutors(self):
+    target = ExecutionTarget()
+    service = self.newWorker(serviceName='ExecutionService', serviceObject=target, executions={'blockingRead': Execution.THREAD}, poolSize=2)
+    client = self.newWorker()
+    invoker = client.asynchronousInvoker('ExecutionService')
+    reads = [invoker.read(0.5), invoker.blockingRead(0.5)]
+    start = time.time()
+    self.assertFalse(client.ExecutionService.fast().startswith('IFWorker'))
+    self.assertLess(time.time() - start, 0.4)
+    self.assertTrue(all(name.startswith('IFWorker') for name in [read.sync(2) for read in reads]))
+    self.assertEqual(target.reads, 1)
+    with client.batch('ExecutionService') as batch:
+      names = [batch.read(0), batch.blockingRead(0), batch.fast()]
+    self.assertEqual([name.result().startswith('IFWorker') for name in names], [True, True, False])
+    self.assertRaises(IFRemoteException, lambda: client.ExecutionService.read())
+    total, pid = client.blockingInvoker('ExecutionService', timeout=10).crunch(1000)
+    self.assertEqual(total, sum(range(1000)))
+    self.assertNotEqual(pid, os.getpid())
+
+  @timeout(Defines.timeout)
+  def testFederation(self):
+    class Target:
+      def __init__(self, name):
+        self.name = name
+
+      def whoami(self, data=b''):
+        return [self.name, len(data)]
+
+      def count(self, n):
+        for i in range(n):
+          yield i
+
+    def waitFor(condition):
+      deadline = time.time() + 5
+      while not condition() and time.time() < deadline:
+        time.sleep(0.1)
+
+    addresses = ['tcp://127.0.0.1:{}'.format(MessageTransportTest.testPort + 20 + i) for i in range(3)]
+    brokers = [IFBroker(address, peerID=f'Node{i}') for i, address in enumerate(addresses)]
+    brokers[0].peer(addresses[1])
+    brokers[1].peer(addresses[2])
+    brokers[2].peer(addresses[0])
+    workers = [self.newWorker(address, serviceObject=Target(f'S{i}'), serviceName=f'Federated{i}') for i, address in enumerate(addresses)]
+    checker = self.newWorker(addresses[0], chunkSize=10000)
+    names = ['Federated0', 'Federated1', 'Federated2']
+    waitFor(lambda: set(names) <= set(checker.listServiceNames()))
+    self.assertEqual(checker.Federated1.whoami(), ['S1', 0])
+    self.assertEqual(checker.Federated2.whoami(b'0' * 100000), ['S2', 100000])
+    self.assertEqual(list(checker.Federated2.count(40)), list(range(40)))
+    metas = {meta['ServiceName']: meta for meta in checker.listServiceMeta() if meta['ServiceName']}
+    self.assertEqual(metas['Federated1']['Peer'], 'Node1')
+    self.assertNotIn('Peer', metas['Federated0'])
+    self.assertTrue(checker.getAddressOfService('Federated2').startswith(b'IFPeer:Node2|'))
+    remoteChecker = self.newWorker(addresses[2])
+    waitFor(lambda: set(names) <= set(remoteChecker.listServiceNames()))
+    self.assertEqual(remoteChecker.Federated0.whoami(), ['S0', 0])
+
+    workers[1].close()
+    waitFor(lambda: 'Federated1' not in checker.listServiceNames())
+    self.assertNotIn('Federated1', checker.listServiceNames())
+    self.assertRaises(IFRemoteException, lambda: checker.Federated1.whoami())
+
+  @timeout(Defines.timeout)
+  def testPiggybackedHeartbeats(self):
+    class CountingManager(Manager):
+      def __init__(self):
+        super().__init__()
+        self.heartbeats = {}
+
+      def heartbeat(self, sourcePoint):
+        self.heartbeats[sourcePoint] = self.heartbeats.get(sourcePoint, 0) + 1
+        return super().heartbeat(sourcePoint)
+
+    address = 'tcp://127.0.0.1:{}'.format(MessageTransportTest.testPort + 40)
+    manager = CountingManager()
+    IFBroker(address, manager=manager)
+    service = self.newWorker(address, serviceObject=EchoTarget(), serviceName='PiggybackedService')
+    serviceAddress = service.getAddressOfService('PiggybackedService')
+    workers, points = [], []
+    for i in range(2):
+      known = set(manager.heartbeats)
+      workers.append(self.newWorker(address))
+      workers[-1].time()
+      points.append((set(manager.heartbeats) - known).pop())
+    (busy, idle), (busyPoint, idlePoint) = workers, points
+    # The first invocation queries the capabilities of the service from the broker.
+    self.assertEqual(busy.PiggybackedService.echo(0), 0)
+    initial = dict(manager.heartbeats)
+    deadline = time.time() + 4.5
+    while time.time() < deadline:
+      self.assertEqual(busy.PiggybackedService.echo(1), 1)
+      time.sleep(0.05)
+    self.assertEqual(manager.heartbeats[busyPoint], initial[busyPoint])
+    self.assertEqual(manager.heartbeats[serviceAddress], initial[serviceAddress])
+    self.assertGreater(manager.heartbeats[idlePoint], initial[idlePoint])
+    self.assertIn('PiggybackedService', idle.listServiceNames())
+
+  @timeout(Defines.timeout)
+  def testLoopSendKeepsOrder(self):
+    # The sending socket blocks after a few messages, so that some wait in the queue of its stream while later ones are sent. The echoes arrive while the sender is still sending.
+    context = zmq.Context.instance()
+    sender, receiver = context.socket(zmq.PAIR), context.socket(zmq.PAIR)
+    sender.setsockopt(zmq.SNDHWM, 4)
+    receiver.setsockopt(zmq.RCVHWM, 4)
+    receiver.bind('inproc://testLoopSendKeepsOrder')
+    sender.connect('inproc://testLoopSendKeepsOrder')
+    count = 500
+    echoes = []
+    done = threading.Event()
+
+    def onEcho(frames):
+      echoes.append(int(frames[0]))
+      if len(echoes) == count:
+        done.set()
+
+    def start():
+      senderStream, receiverStream = ZMQStream(sender), ZMQStream(receiver)
+      receiverStream.on_recv(lambda frames: IFLoop.send(receiverStream, frames))
+      senderStream.on_recv(onEcho)
+      self.addCleanup(lambda: IFLoop.getInstance().add_callback(lambda: (senderStream.close(), receiverStream.close())))
+      sendFrom(senderStream, 0)
+
+    def sendFrom(senderStream, begin):
+      for i in range(begin, min(begin + 7, count)):
+        IFLoop.send(senderStream, [str(i).encode()])
+      if begin + 7 < count:
+        IFLoop.getInstance().add_callback(sendFrom, senderStream, begin + 7)
+
+    IFLoop.getInstance().add_callback(start)
+    self.assertTrue(done.wait(5))
+    self.assertEqual(echoes, list(range(count)))
+
+  @timeout(Defines.timeout)
+  def testSubmissionFromManyThreads(self):
+    class Recorder:
+      def __init__(self):
+        self.records = {}
+
+      def record(self, thread, index):
+        self.records.setdefault(thread, []).append(index)
+        return index
+
+    recorder = Recorder()
+    service = self.newWorker(serviceObject=recorder, serviceName='SubmissionRecorder')
+    client = self.newWorker()
+    self.assertEqual(client.SubmissionRecorder.record(-1, 0), 0)
+    threadCount, callCount = 64, 50
+    barrier = threading.Barrier(threadCount)
+    errors = []
+
+    def submit(thread):
+      try:
+        invoker = client.asynchronousInvoker('SubmissionRecorder')
+        barrier.wait()
+        futures = [invoker.record(thread, i) for i in range(callCount - 1)]
+        self.assertEqual(client.blockingInvoker('SubmissionRecorder').record(thread, callCount - 1), callCount - 1)
+        self.assertEqual([future.sync() for future in futures], list(range(callCount - 1)))
+      except BaseException as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(threadCount)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(errors, [])
+    for thread in range(threadCount):
+      self.assertEqual(recorder.records[thread], list(range(callCount)))
+
   @timeout(Defines.timeout)
   def testInvokeOtherClientRemotely(self):
     class Target: